@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+多模型平行編譯
+讀取 batch_input_params.json 的 models 列表，每個模型在獨立的子程序中
+依各自的 input_params 執行定點分析，最後把所有模型合併編譯成一個 .nef
+（--per-model-nef 另外為每個模型編譯單獨的 .nef，會增加一次編譯時間）
+
+每個模型的輸出寫到 <output-dir>/<id>/，ktc 的訊息記錄在 <output-dir>/<id>/build.log；
+ktc 呼叫透過 ktc_backend.py，--backend local 可在沒有工具鏈容器的機器上測試
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ktc_backend import BACKENDS, DEFAULT_PLATFORM, get_backend
+
+DEFAULT_OUTPUT_DIR = 'build'
+
+
+def load_batch_config(config_path):
+    """
+    讀取 batch_input_params.json，模型與 input_params 路徑轉為絕對路徑
+
+    Returns:
+        (models, config)
+    """
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+    models = []
+    for model in config['models']:
+        models.append({
+            'id': int(model['id']),
+            'version': str(model.get('version', '0000')),
+            'path': os.path.join(base_dir, model['path']),
+            'input_params': os.path.join(base_dir, model.get('input_params', 'input_params.json')),
+        })
+    return models, config
+
+
+def _redirect_output(log_path):
+    """
+    將子程序的 stdout / stderr（含 C 層輸出）導向 log 檔
+
+    Returns:
+        (log 檔, 原本的狀態)，交給 _restore_output 還原
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2), sys.stdout, sys.stderr)
+    log = open(log_path, 'w', encoding='utf-8')
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    sys.stdout = sys.stderr = log
+    return log, saved
+
+
+def _restore_output(log, saved):
+    """還原 fd 1 / 2 並關閉 log 檔（pool 的 worker 會繼續處理下一個模型）"""
+    stdout_fd, stderr_fd, sys.stdout, sys.stderr = saved
+    log.flush()
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    os.close(stdout_fd)
+    os.close(stderr_fd)
+    log.close()
+
+
+def build_model(model, backend_name, platform, output_dir, threads, skip_analysis, per_model_nef=False):
+    """
+    在子程序中處理單一模型：定點分析（→ per_model_nef 時再編譯單模型 .nef）
+
+    Returns:
+        結果 dict（含各步驟耗時與 log 路徑，失敗時含 error）
+    """
+    model_dir = os.path.join(output_dir, str(model['id']))
+    os.makedirs(model_dir, exist_ok=True)
+    log_path = os.path.join(model_dir, 'build.log')
+    result = dict(model, log=log_path, timings={})
+    log, saved = _redirect_output(log_path)
+    try:
+        backend = get_backend(backend_name, platform)
+        source = model['path']
+        if not skip_analysis:
+            start_time = time.perf_counter()
+            source = backend.analysis(model['path'], model['input_params'], model_dir,
+                                      model_id=model['id'], version=model['version'], threads=threads)
+            result['timings']['analysis'] = time.perf_counter() - start_time
+            result['bie'] = source
+
+        if per_model_nef:
+            start_time = time.perf_counter()
+            result['nef'] = backend.compile([{'id': model['id'], 'version': model['version'], 'path': source}],
+                                            model_dir)
+            result['timings']['compile'] = time.perf_counter() - start_time
+        result['compile_source'] = source
+    except Exception as e:
+        traceback.print_exc()
+        result['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        _restore_output(log, saved)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='依 batch_input_params.json 平行分析 / 編譯多個模型，並合併成單一 .nef',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+使用範例:
+  # 在 Kneron 工具鏈容器中
+  python batch_compile.py batch_input_params.json
+
+  # 使用本地替身測試流程
+  python batch_compile.py batch_input_params.json --backend local
+        """
+    )
+    parser.add_argument('config', nargs='?', default='batch_input_params.json',
+                        help='批次設定檔 (預設: batch_input_params.json)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='同時處理的模型數 (預設: min(模型數, CPU 核心數 / thread_num))')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='每個模型定點分析的執行緒數 (預設: 設定檔的 thread_num)')
+    parser.add_argument('--platform', type=str, default=DEFAULT_PLATFORM, help=f'目標平台 (預設: {DEFAULT_PLATFORM})')
+    parser.add_argument('--skip-analysis', action='store_true', help='跳過定點分析，直接編譯 ONNX')
+    parser.add_argument('--per-model-nef', action='store_true',
+                        help='另外為每個模型編譯單獨的 .nef (<output-dir>/<id>/)，預設只產生合併的 .nef')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='ktc',
+                        help='ktc 呼叫的實作 (預設: ktc，local 為本地替身)')
+    parser.add_argument('--output-dir', type=str, default=DEFAULT_OUTPUT_DIR,
+                        help=f'輸出目錄 (預設: {DEFAULT_OUTPUT_DIR})')
+    args = parser.parse_args()
+
+    models, config = load_batch_config(args.config)
+    if not models:
+        print(f"❌ 錯誤：{args.config} 中沒有任何模型")
+        sys.exit(1)
+    ids = [model['id'] for model in models]
+    if len(set(ids)) != len(ids):
+        print(f"❌ 錯誤：模型 ID 重複: {ids}")
+        sys.exit(1)
+    for model in models:
+        for key in ('path', 'input_params'):
+            if not os.path.exists(model[key]) and not (key == 'input_params' and args.skip_analysis):
+                print(f"❌ 錯誤：模型 {model['id']} 找不到 {key}: {model[key]}")
+                sys.exit(1)
+
+    try:
+        backend = get_backend(args.backend, args.platform)
+    except RuntimeError as e:
+        print(f"❌ 錯誤：{e}")
+        sys.exit(1)
+
+    threads = args.threads or int(config.get('thread_num', 1))
+    jobs = args.jobs or max(1, min(len(models), (os.cpu_count() or 1) // threads))
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    print("=" * 60)
+    print(f"多模型編譯 (backend: {args.backend}，平台: {args.platform})")
+    print("=" * 60)
+    print(f"模型: {len(models)} 個，同時處理 {jobs} 個，每個 {threads} 執行緒")
+
+    start_time = time.perf_counter()
+    results = []
+    # spawn：每個模型在乾淨的程序中執行，ktc 的全域狀態與輸出不會互相干擾
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=ctx) as executor:
+        futures = {
+            executor.submit(build_model, model, args.backend, args.platform, output_dir, threads,
+                            args.skip_analysis, args.per_model_nef): model
+            for model in models
+        }
+        for future in as_completed(futures):
+            model = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = dict(model, timings={}, error=f"子程序失敗: {e}")
+            results.append(result)
+            timings = '，'.join(f"{k} {v:.1f}s" for k, v in result['timings'].items())
+            if 'error' in result:
+                print(f"  ❌ 模型 {model['id']}: {result['error']} (log: {result.get('log')})")
+            else:
+                print(f"  ✓ 模型 {model['id']}: {timings or '略過定點分析'}")
+
+    failed = [r for r in results if 'error' in r]
+    if failed:
+        print(f"\n❌ {len(failed)} 個模型失敗，不產生合併的 .nef")
+        sys.exit(1)
+
+    # 依設定檔的順序合併編譯
+    results.sort(key=lambda r: ids.index(r['id']))
+    print("\n正在合併編譯所有模型...")
+    combine_start = time.perf_counter()
+    nef_path = backend.compile([{'id': r['id'], 'version': r['version'], 'path': r['compile_source']}
+                                for r in results], output_dir)
+    combine_time = time.perf_counter() - combine_start
+
+    summary = {
+        'config': os.path.abspath(args.config),
+        'backend': args.backend,
+        'platform': args.platform,
+        'jobs': jobs,
+        'threads': threads,
+        'nef': nef_path,
+        'combine_seconds': combine_time,
+        'total_seconds': time.perf_counter() - start_time,
+        'models': results,
+    }
+    summary_path = os.path.join(output_dir, 'batch_summary.json')
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    print(f"\n{'='*60}")
+    print(f"✓ 合併的 .nef: {nef_path}")
+    print(f"✓ 各模型耗時與 log: {summary_path}")
+    print(f"總耗時 {summary['total_seconds']:.1f} 秒")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+ONNX 模型效能基準測試
+對 compare_models.MODELS 中的每個模型，掃描不同的 batch 大小與執行緒數，
+量測 p50/p90/p99 延遲、吞吐量 (張/秒) 與峰值記憶體 (RSS)
+
+每個組合在獨立的子程序中執行，峰值 RSS 才不會受到前一個組合影響；
+不使用 .ort_cache 優化圖快取，每次都完整優化，結果不受快取狀態影響。
+結果可存成 JSON，並與先前保存的 baseline 比較，找出效能退化
+（例如 replace_reducemean.py 之類的計算圖改寫造成的變慢）
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+# compare_models 匯入時已設置 Windows 的輸出編碼
+from compare_models import MODELS
+from ort_session import create_session
+
+
+def peak_rss_mb():
+    """目前程序的峰值常駐記憶體 (MB)，無法取得時回傳 None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 單位為 KB，macOS 為 bytes
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+
+def run_case(model_path, batch_size, threads, warmup, iterations, graph_opt_level):
+    """
+    執行單一組合的基準測試（在子程序中呼叫）
+
+    Returns:
+        結果 dict；模型不支援此 batch 大小時回傳含 'skipped' 的 dict
+    """
+    # 不使用優化圖快取：載入快取與重新優化的記憶體用量不同，會讓 RSS 比較失準
+    session = create_session(model_path, intra_op_threads=threads, graph_opt_level=graph_opt_level,
+                             cache_dir=None)
+    model_input = session.get_inputs()[0]
+    batch_dim = model_input.shape[0]
+    if isinstance(batch_dim, int) and batch_dim > 0 and batch_dim != batch_size:
+        return {'skipped': f'模型的 batch 維度固定為 {batch_dim}'}
+
+    rng = np.random.default_rng(0)
+    inputs = {model_input.name: rng.standard_normal((batch_size, 3, 224, 224), dtype=np.float32)}
+
+    for _ in range(warmup):
+        session.run(None, inputs)
+
+    latencies = np.empty(iterations, dtype=np.float64)
+    total_start = time.perf_counter()
+    for i in range(iterations):
+        start = time.perf_counter()
+        session.run(None, inputs)
+        latencies[i] = (time.perf_counter() - start) * 1000
+    total_time = time.perf_counter() - total_start
+
+    return {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(latencies.mean()),
+        'images_per_sec': batch_size * iterations / total_time,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _run_case_star(case_args):
+    return run_case(*case_args)
+
+
+def run_isolated(case_args):
+    """在全新的子程序中執行 run_case，確保峰值 RSS 只反映這個組合"""
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(_run_case_star, (case_args,))
+
+
+def compare_results(current, baseline, tolerance):
+    """
+    將本次結果與 baseline 比較
+
+    以 (模型檔名, batch 大小, 執行緒數) 對齊；p50 延遲或峰值 RSS 增加、
+    或吞吐量下降超過 tolerance（比例）即視為退化
+
+    Returns:
+        退化項目列表
+    """
+    def key(result):
+        return os.path.basename(result['model_path']), result['batch_size'], result['threads']
+
+    baseline_map = {key(r): r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        base = baseline_map.get(key(result))
+        if base is None:
+            continue
+        checks = [
+            ('p50_ms', result['p50_ms'] > base['p50_ms'] * (1 + tolerance)),
+            ('images_per_sec', result['images_per_sec'] < base['images_per_sec'] * (1 - tolerance)),
+        ]
+        if result.get('peak_rss_mb') and base.get('peak_rss_mb'):
+            checks.append(('peak_rss_mb', result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance)))
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append({
+                    'model': key(result)[0],
+                    'batch_size': result['batch_size'],
+                    'threads': result['threads'],
+                    'metric': metric,
+                    'baseline': base[metric],
+                    'current': result[metric],
+                    'change_pct': (result[metric] / base[metric] - 1) * 100,
+                })
+    return regressions
+
+
+def print_regressions(regressions, tolerance):
+    print(f"\n{'='*80}")
+    print(f"與 baseline 比較 (容許誤差 {tolerance*100:.0f}%)")
+    print(f"{'='*80}")
+    if not regressions:
+        print("✅ 沒有發現效能退化")
+        return
+    for r in regressions:
+        print(f"❌ {r['model']} batch={r['batch_size']} threads={r['threads']}: "
+              f"{r['metric']} {r['baseline']:.2f} → {r['current']:.2f} ({r['change_pct']:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ONNX 模型延遲 / 吞吐量 / 記憶體基準測試',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+使用範例:
+  # 測試 compare_models.py 中的所有模型並保存 baseline
+  python benchmark.py --output bench_baseline.json
+
+  # 修改計算圖後重新測試，並與 baseline 比較（有退化時結束碼為 1）
+  python benchmark.py --output bench_new.json --baseline bench_baseline.json
+
+  # 只比較兩個已保存的結果
+  python benchmark.py --compare bench_new.json --baseline bench_baseline.json
+        """
+    )
+    parser.add_argument(
+        '-m', '--models',
+        nargs='+',
+        default=None,
+        help='要測試的模型路徑 (預設: compare_models.py 中的 MODELS)'
+    )
+    parser.add_argument(
+        '--batch-sizes',
+        nargs='+',
+        type=int,
+        default=[1, 4, 8],
+        help='要掃描的 batch 大小，固定 batch 的模型只測試其 batch 大小 (預設: 1 4 8)'
+    )
+    parser.add_argument(
+        '--threads',
+        nargs='+',
+        type=int,
+        default=[1, os.cpu_count() or 1],
+        help='要掃描的 intra-op 執行緒數 (預設: 1 與 CPU 核心數)'
+    )
+    parser.add_argument('--warmup', type=int, default=5, help='每個組合的暖機次數 (預設: 5)')
+    parser.add_argument('--iterations', type=int, default=30, help='每個組合的計時次數 (預設: 30)')
+    parser.add_argument(
+        '--graph-opt-level',
+        choices=['disable', 'basic', 'extended', 'all'],
+        default='all',
+        help='ORT 圖優化等級 (預設: all)'
+    )
+    parser.add_argument('-o', '--output', type=str, default=None, help='將結果寫入 JSON 檔')
+    parser.add_argument('--baseline', type=str, default=None, help='與此 baseline JSON 比較')
+    parser.add_argument(
+        '--compare',
+        type=str,
+        default=None,
+        metavar='RESULT_JSON',
+        help='不執行測試，只將 RESULT_JSON 與 --baseline 比較'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.10,
+        help='判定為退化的變化比例 (預設: 0.10，即 10%%)'
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        if not args.baseline:
+            print("❌ 錯誤：--compare 需要搭配 --baseline")
+            sys.exit(1)
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(current, baseline, args.tolerance)
+        print_regressions(regressions, args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+    models = {os.path.basename(p): p for p in args.models} if args.models else MODELS
+    thread_counts = sorted(set(args.threads))
+    batch_sizes = sorted(set(args.batch_sizes))
+
+    print("=" * 80)
+    print("ONNX 模型效能基準測試")
+    print("=" * 80)
+    print(f"batch 大小: {batch_sizes}，執行緒數: {thread_counts}，"
+          f"暖機 {args.warmup} 次，計時 {args.iterations} 次")
+
+    results = []
+    for model_name, model_path in models.items():
+        if not os.path.exists(model_path):
+            print(f"\n⚠️  跳過 {model_name}: 找不到 {model_path}")
+            continue
+        print(f"\n📦 {model_name} ({model_path})")
+        print(f"  {'batch':>5s} {'threads':>7s} {'p50 ms':>9s} {'p90 ms':>9s} {'p99 ms':>9s} "
+              f"{'張/秒':>9s} {'RSS MB':>8s}")
+        for threads in thread_counts:
+            for batch_size in batch_sizes:
+                case_args = (model_path, batch_size, threads, args.warmup, args.iterations,
+                             args.graph_opt_level)
+                try:
+                    result = run_isolated(case_args)
+                except Exception as e:
+                    print(f"  {batch_size:>5d} {threads:>7d} ❌ 失敗: {e}")
+                    continue
+                if 'skipped' in result:
+                    continue
+                rss = f"{result['peak_rss_mb']:.1f}" if result['peak_rss_mb'] else 'N/A'
+                print(f"  {batch_size:>5d} {threads:>7d} {result['p50_ms']:>9.2f} {result['p90_ms']:>9.2f} "
+                      f"{result['p99_ms']:>9.2f} {result['images_per_sec']:>9.1f} {rss:>8s}")
+                results.append(dict(model=model_name, model_path=model_path,
+                                    batch_size=batch_size, threads=threads, **result))
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'onnxruntime': __import__('onnxruntime').__version__,
+            'warmup': args.warmup,
+            'iterations': args.iterations,
+            'graph_opt_level': args.graph_opt_level,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n✓ 結果已保存到: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(report, baseline, args.tolerance)
+        print_regressions(regressions, args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+.pth → .nef 的增量建置流程
+把原本手動依序執行的腳本:
+    train_resnet50.py → fix_onnx_export.py → merge_onnx_external_data.py → ants_bees_convert.py
+    → fix_reducemean_properly.py → run_fp_analysis.py → direct_compile.py
+建模成 DAG，每個階段的輸出依「輸入檔內容 + 參數 + 相關程式碼」的雜湊值快取在 .build_cache/，
+輸入沒有改變的階段直接沿用快取。上游重跑但輸出內容不變時，下游也不會重跑
+
+ktc 相關階段（優化、定點分析、編譯）透過 ktc_backend.py 呼叫，
+--backend local 可在沒有工具鏈容器的機器上以本地替身測試整個流程
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import onnx
+
+from ktc_backend import BACKENDS, DEFAULT_PLATFORM, copy_output, get_backend
+from tensor_cache import file_digest
+
+DEFAULT_CACHE_DIR = '.build_cache'
+DEFAULT_OUTPUT_DIR = 'build'
+# train_resnet50.py 寫出的最佳權重 (checkpointing.DEFAULT_CHECKPOINT_DIR/best.pt)；
+# 不從 checkpointing 匯入，從既有 ONNX 開始 (--onnx) 時不需要 torch
+DEFAULT_WEIGHTS = os.path.join('checkpoints', 'best.pt')
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Output:
+    """指向某個階段的某個輸出，用來在階段之間連線"""
+
+    def __init__(self, stage, key):
+        self.stage = stage
+        self.key = key
+
+    def __repr__(self):
+        return f"{self.stage}.{self.key}"
+
+
+class Stage:
+    """
+    建置階段
+
+    Args:
+        name: 階段名稱
+        func: func(inputs, params, work_dir, backend) -> {輸出名稱: work_dir 中的路徑}
+        inputs: {輸入名稱: 檔案/資料夾路徑 或 Output}
+        params: 會影響輸出的參數（納入快取鍵）
+        code: 此階段依賴的程式碼檔案（內容改變時重跑）
+    """
+
+    def __init__(self, name, func, inputs, params=None, code=()):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.params = params or {}
+        self.code = list(code)
+
+    @property
+    def dependencies(self):
+        return [value.stage for value in self.inputs.values() if isinstance(value, Output)]
+
+
+class DigestCache:
+    """
+    檔案內容雜湊的快取（以 大小 + mtime 判斷是否需要重新計算）
+    .onnx 檔會一併納入其外部數據檔
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+
+    def file(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self._entries.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = file_digest(path)
+        self._entries[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def artifact(self, path):
+        """檔案、.onnx（含外部數據）或資料夾的內容雜湊"""
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    digest.update(os.path.relpath(full, path).replace(os.sep, '/').encode())
+                    digest.update(self.file(full).encode())
+            return digest.hexdigest()
+
+        digest = self.file(path)
+        if path.endswith('.onnx'):
+            model = onnx.load(path, load_external_data=False)
+            base_dir = os.path.dirname(os.path.abspath(path))
+            locations = sorted({entry.value for init in model.graph.initializer
+                                for entry in init.external_data if entry.key == 'location'})
+            if locations:
+                combined = hashlib.sha256(digest.encode())
+                for location in locations:
+                    combined.update(location.encode())
+                    combined.update(self.file(os.path.join(base_dir, location)).encode())
+                digest = combined.hexdigest()
+        return digest
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class Pipeline:
+    """依拓撲順序執行階段，輸入未改變的階段沿用快取"""
+
+    def __init__(self, stages, backend, cache_dir=DEFAULT_CACHE_DIR):
+        self.stages = {stage.name: stage for stage in stages}
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.digests = DigestCache(os.path.join(cache_dir, 'digests.json'))
+        self.outputs = {}
+
+    def order(self, target=None):
+        """拓撲排序；指定 target 時只包含 target 與其上游"""
+        ordered = []
+        visiting = set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"階段之間有循環依賴: {name}")
+            visiting.add(name)
+            for dependency in self.stages[name].dependencies:
+                visit(dependency)
+            visiting.discard(name)
+            ordered.append(name)
+
+        for name in ([target] if target else self.stages):
+            visit(name)
+        return ordered
+
+    def _resolve(self, stage):
+        inputs = {}
+        for key, value in stage.inputs.items():
+            inputs[key] = self.outputs[value.stage][value.key] if isinstance(value, Output) else value
+        return inputs
+
+    def stage_key(self, stage, inputs):
+        """快取鍵: 階段名稱、參數、backend 與目標平台、輸入內容與程式碼的雜湊"""
+        description = {
+            'stage': stage.name,
+            'params': stage.params,
+            'backend': [self.backend.name, self.backend.platform],
+            'inputs': {key: self.digests.artifact(path) for key, path in inputs.items()},
+            'code': {path: self.digests.file(os.path.join(SCRIPT_DIR, path)) for path in stage.code},
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def run_stage(self, stage, force=False):
+        """
+        執行單一階段（或沿用快取）
+
+        Returns:
+            (是否使用快取, 花費秒數)
+        """
+        inputs = self._resolve(stage)
+        for key, path in inputs.items():
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"{stage.name}: 找不到輸入 {key} = {path}")
+
+        key = self.stage_key(stage, inputs)
+        stage_dir = os.path.join(self.cache_dir, stage.name, key[:16])
+        manifest_path = os.path.join(stage_dir, 'manifest.json')
+
+        if force and os.path.isdir(stage_dir):
+            shutil.rmtree(stage_dir)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.outputs[stage.name] = {k: os.path.join(stage_dir, v) for k, v in manifest['outputs'].items()}
+            return True, 0.0
+
+        # 在暫存目錄中執行，成功後再改名，中斷時不會留下不完整的快取
+        work_dir = f'{stage_dir}.{os.getpid()}.tmp'
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        start_time = time.perf_counter()
+        try:
+            outputs = stage.func(inputs, stage.params, work_dir, self.backend)
+            elapsed = time.perf_counter() - start_time
+            manifest = {
+                'stage': stage.name,
+                'key': key,
+                'backend': [self.backend.name, self.backend.platform],
+                'params': stage.params,
+                'inputs': inputs,
+                'outputs': {k: os.path.relpath(v, work_dir) for k, v in outputs.items()},
+                'elapsed': elapsed,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            with open(os.path.join(work_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2, ensure_ascii=False)
+            if os.path.isdir(stage_dir):
+                shutil.rmtree(stage_dir)
+            os.replace(work_dir, stage_dir)
+        finally:
+            if os.path.isdir(work_dir):
+                shutil.rmtree(work_dir)
+
+        self.outputs[stage.name] = {k: os.path.join(stage_dir, v) for k, v in manifest['outputs'].items()}
+        return False, elapsed
+
+    def run(self, target=None, force=()):
+        """
+        執行到 target（預設全部）
+
+        Returns:
+            最後一個階段的輸出 {名稱: 路徑}
+        """
+        order = self.order(target)
+        try:
+            for name in order:
+                print(f"\n▶ {name}")
+                cached, elapsed = self.run_stage(self.stages[name], force=name in force)
+                for key, path in self.outputs[name].items():
+                    print(f"  {key}: {path}")
+                print(f"  {'✓ 使用快取' if cached else f'✓ 完成 ({elapsed:.1f} 秒)'}")
+        finally:
+            self.digests.save()
+        return self.outputs[order[-1]]
+
+
+# ----------------------------------------------------------------------
+# 階段實作
+# ----------------------------------------------------------------------
+def export_stage(inputs, params, work_dir, backend):
+    from fix_onnx_export import export_onnx
+
+    output = os.path.join(work_dir, 'ants_bees.onnx')
+    export_onnx(output, [inputs['weights']], dynamic_batch=params['dynamic_batch'],
+                opset_version=params['opset_version'])
+    return {'onnx': output}
+
+
+def merge_stage(inputs, params, work_dir, backend):
+    from merge_onnx_external_data import merge_external_data
+
+    output = os.path.join(work_dir, 'ants_bees_merged.onnx')
+    merge_external_data(inputs['onnx'], output)
+    return {'onnx': output}
+
+
+def optimize_stage(inputs, params, work_dir, backend):
+    output = os.path.join(work_dir, 'ants_bees_opt.onnx')
+    backend.optimize(inputs['onnx'], output)
+    return {'onnx': output}
+
+
+def fix_reducemean_stage(inputs, params, work_dir, backend):
+    from onnx_rewrite import ReduceMeanToGlobalAveragePool, rewrite_model_file
+
+    output = os.path.join(work_dir, 'ants_bees_opt_fixed.onnx')
+    rewrite_model_file(inputs['onnx'], output, [ReduceMeanToGlobalAveragePool()])
+    return {'onnx': output}
+
+
+def analysis_stage(inputs, params, work_dir, backend):
+    bie_path = backend.analysis(inputs['onnx'], inputs['input_params'], work_dir,
+                                model_id=params['model_id'], version=params['version'],
+                                threads=params['threads'])
+    return {'bie': copy_output(bie_path, work_dir)}
+
+
+def compile_stage(inputs, params, work_dir, backend):
+    source = inputs.get('bie') or inputs['onnx']
+    nef_path = backend.compile([{'id': params['model_id'], 'version': params['version'], 'path': source}],
+                               work_dir)
+    return {'nef': copy_output(nef_path, work_dir)}
+
+
+def calibration_folder(input_params_path):
+    with open(input_params_path, 'r', encoding='utf-8') as f:
+        params = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(input_params_path))
+    return os.path.join(base_dir, params['model_info']['model_inputs'][0]['input_image_folder'])
+
+
+def default_stages(weights=None, onnx_path=None, input_params='input_params.json',
+                   model_id=100, version='0000', threads=1, skip_analysis=False, opset_version=11):
+    """
+    預設流程：export → merge → optimize → fix_reducemean → analysis → compile
+
+    onnx_path 不為 None 時跳過 export，從既有的 ONNX 開始；
+    skip_analysis 對應 direct_compile.py 的做法（直接編譯 ONNX）
+    """
+    stages = []
+    if onnx_path is None:
+        stages.append(Stage('export', export_stage, {'weights': weights},
+                            params={'dynamic_batch': False, 'opset_version': opset_version},
+                            code=['fix_onnx_export.py']))
+        source = Output('export', 'onnx')
+    else:
+        source = onnx_path
+
+    stages += [
+        Stage('merge', merge_stage, {'onnx': source}, code=['merge_onnx_external_data.py']),
+        Stage('optimize', optimize_stage, {'onnx': Output('merge', 'onnx')},
+              code=['ktc_backend.py', 'onnx_rewrite.py']),
+        Stage('fix_reducemean', fix_reducemean_stage, {'onnx': Output('optimize', 'onnx')},
+              code=['onnx_rewrite.py']),
+    ]
+    compile_params = {'model_id': model_id, 'version': version}
+    if skip_analysis:
+        stages.append(Stage('compile', compile_stage, {'onnx': Output('fix_reducemean', 'onnx')},
+                            params=compile_params, code=['ktc_backend.py']))
+    else:
+        stages += [
+            Stage('analysis', analysis_stage,
+                  {'onnx': Output('fix_reducemean', 'onnx'), 'input_params': input_params,
+                   'images': calibration_folder(input_params)},
+                  params=dict(compile_params, threads=threads),
+                  code=['ktc_backend.py', 'preprocessing.py']),
+            Stage('compile', compile_stage, {'bie': Output('analysis', 'bie')},
+                  params=compile_params, code=['ktc_backend.py']),
+        ]
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='.pth → .nef 增量建置（未改變的階段沿用快取）',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+使用範例:
+  # 完整流程（在 Kneron 工具鏈容器中），使用 train_resnet50.py 的 checkpoints/best.pt
+  python build_pipeline.py
+
+  # 指定其他權重檔
+  python build_pipeline.py --weights ants_bees_model.pth
+
+  # 從既有的 ONNX 開始，使用本地替身測試流程
+  python build_pipeline.py --onnx ants_bees.onnx --backend local
+
+  # 只執行到 fix_reducemean，並強制重跑 optimize
+  python build_pipeline.py --onnx ants_bees.onnx --until fix_reducemean --force optimize
+        """
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--weights', type=str, default=DEFAULT_WEIGHTS,
+                        help=f'訓練好的權重檔 (預設: train_resnet50.py 寫出的 {DEFAULT_WEIGHTS})')
+    source.add_argument('--onnx', type=str, default=None, help='從既有的 ONNX 開始（跳過 export）')
+    parser.add_argument('--input-params', type=str, default='input_params.json',
+                        help='定點分析設定 (預設: input_params.json)')
+    parser.add_argument('--model-id', type=int, default=100, help='模型 ID (預設: 100)')
+    parser.add_argument('--version', type=str, default='0000', help='模型版本 (預設: 0000)')
+    parser.add_argument('--platform', type=str, default=DEFAULT_PLATFORM, help=f'目標平台 (預設: {DEFAULT_PLATFORM})')
+    parser.add_argument('--threads', type=int, default=1, help='定點分析的執行緒數 (預設: 1)')
+    parser.add_argument('--skip-analysis', action='store_true',
+                        help='跳過定點分析，直接編譯 ONNX（同 direct_compile.py）')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='ktc',
+                        help='ktc 階段的實作 (預設: ktc，local 為本地替身)')
+    parser.add_argument('--until', type=str, default=None, help='只執行到此階段')
+    parser.add_argument('--force', nargs='+', default=[], metavar='STAGE', help='忽略快取，重跑這些階段')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help=f'快取目錄 (預設: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--output-dir', type=str, default=DEFAULT_OUTPUT_DIR,
+                        help=f'最後產物的複製目的地 (預設: {DEFAULT_OUTPUT_DIR})')
+    args = parser.parse_args()
+
+    try:
+        backend = get_backend(args.backend, args.platform)
+    except RuntimeError as e:
+        print(f"❌ 錯誤：{e}")
+        sys.exit(1)
+
+    if args.onnx is None and not os.path.exists(args.weights):
+        print(f"❌ 錯誤：找不到權重檔 {args.weights}，請先執行 train_resnet50.py，或以 --weights / --onnx 指定來源")
+        sys.exit(1)
+
+    stages = default_stages(weights=args.weights, onnx_path=args.onnx, input_params=args.input_params,
+                            model_id=args.model_id, version=args.version, threads=args.threads,
+                            skip_analysis=args.skip_analysis)
+    pipeline = Pipeline(stages, backend, args.cache_dir)
+    if args.until and args.until not in pipeline.stages:
+        print(f"❌ 錯誤：未知的階段 {args.until}（可用: {', '.join(pipeline.stages)}）")
+        sys.exit(1)
+
+    print("=" * 60)
+    print(f"建置流程 (backend: {backend.name})")
+    print("=" * 60)
+    print(" → ".join(pipeline.order(args.until)))
+
+    start_time = time.perf_counter()
+    try:
+        outputs = pipeline.run(args.until, force=set(args.force))
+    except Exception as e:
+        print(f"\n❌ 建置失敗: {e}")
+        sys.exit(1)
+
+    print(f"\n{'='*60}")
+    for key, path in outputs.items():
+        print(f"✓ {key}: {copy_output(path, args.output_dir)}")
+    print(f"總耗時 {time.perf_counter() - start_time:.1f} 秒")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
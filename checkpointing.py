@@ -0,0 +1,195 @@
+"""
+訓練 checkpoint（背景寫檔）
+每個 epoch 結束時在主執行緒取得權重快照（複製到 CPU），寫入磁碟交給背景執行緒，
+訓練不必等待 torch.save。同一個檔案尚未寫出時又有新的快照，只保留最新的一份。
+檔案依排入的順序寫出（取代的快照排到最後），save_epoch 先排 best 再排 last，
+所以 last.pt 記錄的 best_acc 對應的權重一定已經寫進 best.pt
+
+    last.pt  最後一個 epoch：模型、optimizer、scheduler、best_acc 與訓練設定（--resume 由此接續）
+    best.pt  驗證準確度最佳的模型
+
+訓練設定 (config) 記錄會改變模型形狀或訓練目標的參數（剪枝比例、student 架構等），
+與目前的設定不同時不能接續
+
+只訓練部分參數時（例如凍結 backbone 只訓練 fc），快照只包含 optimizer 中的參數與所有 buffer
+（BatchNorm 的 running statistics 在 train 模式下仍會更新），並標記 partial=True；
+載入時以 ImageNet 預訓練權重為基礎，再以 strict=False 套用
+"""
+import copy
+import os
+import threading
+
+import torch
+
+DEFAULT_CHECKPOINT_DIR = 'checkpoints'
+
+
+def trainable_state_names(model, optimizer):
+    """
+    快照需要包含的 state_dict key：optimizer 中的參數與所有 buffer
+
+    Returns:
+        (key 集合, 是否為部分快照)
+    """
+    optimized = {id(p) for group in optimizer.param_groups for p in group['params']}
+    params = dict(model.named_parameters())
+    names = {name for name, p in params.items() if id(p) in optimized}
+    names.update(name for name, _ in model.named_buffers())
+    return names, len(names & params.keys()) < len(params)
+
+
+def snapshot_state(model, names=None):
+    """複製 state_dict（或其中的 names）到 CPU，之後模型繼續訓練也不會影響快照"""
+    return {name: tensor.detach().to('cpu', copy=True)
+            for name, tensor in model.state_dict().items() if names is None or name in names}
+
+
+def config_mismatch(checkpoint, config):
+    """checkpoint 記錄的訓練設定與 config 不同時回傳說明，相同時回傳 None"""
+    saved = checkpoint.get('config')
+    if saved == config:
+        return None
+    return f"checkpoint 的訓練設定 {saved} 與目前的設定 {config} 不同"
+
+
+def load_model_state(model, state_dict, partial):
+    """partial 快照只覆蓋其中的 key"""
+    missing, unexpected = model.load_state_dict(state_dict, strict=not partial)
+    if unexpected:
+        raise RuntimeError(f"checkpoint 中有模型沒有的權重: {unexpected[:5]}")
+    return model
+
+
+class AsyncCheckpointer:
+    """
+    背景執行緒寫出 checkpoint
+
+    Args:
+        directory: checkpoint 目錄
+
+    使用方式:
+        checkpointer = AsyncCheckpointer('checkpoints')
+        checkpointer.save('last', {...})
+        checkpointer.close()   # 等待所有檔案寫完
+    """
+
+    def __init__(self, directory=DEFAULT_CHECKPOINT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._writing = False
+        self.error = None
+        # 已成功寫出的 checkpoint 名稱
+        self.written = set()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, f'{name}.pt')
+
+    def save(self, name, state):
+        """排入寫檔佇列（state 必須已是快照，不能再被訓練修改）"""
+        if self.error is not None:
+            raise RuntimeError(f"先前的 checkpoint 寫入失敗: {self.error}")
+        with self._condition:
+            # 先移除舊的快照，新的排到佇列最後，維持排入的先後順序
+            self._pending.pop(name, None)
+            self._pending[name] = state
+            self._condition.notify()
+
+    def load(self, name):
+        """讀取 checkpoint，不存在時回傳 None"""
+        self.wait()
+        path = self.path(name)
+        if not os.path.exists(path):
+            return None
+        return torch.load(path, map_location='cpu')
+
+    def wait(self):
+        """等待佇列中的 checkpoint 全部寫完"""
+        with self._condition:
+            while self._pending or self._writing:
+                self._condition.wait()
+        if self.error is not None:
+            raise RuntimeError(f"checkpoint 寫入失敗: {self.error}")
+
+    def close(self):
+        self.wait()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                name = next(iter(self._pending))
+                state = self._pending.pop(name)
+                self._writing = True
+            try:
+                # 先寫到暫存檔再改名，中斷時不會留下不完整的 checkpoint
+                tmp_path = f'{self.path(name)}.{os.getpid()}.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, self.path(name))
+                self.written.add(name)
+            except Exception as e:
+                self.error = e
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+
+def training_state(model, optimizer, scheduler, names, partial, epoch, best_acc, best_epoch, config=None):
+    """last.pt 的內容（全部為快照）"""
+    return {
+        'config': config,
+        'epoch': epoch,
+        'state_dict': snapshot_state(model, names),
+        'partial': partial,
+        'optimizer': copy.deepcopy(optimizer.state_dict()),
+        'scheduler': scheduler.state_dict(),
+        'best_acc': best_acc,
+        'best_epoch': best_epoch,
+    }
+
+
+def resume_training(checkpointer, model, optimizer, scheduler, names, config=None):
+    """
+    從 last.pt 接續：載入模型、optimizer 與 scheduler
+
+    Returns:
+        (start_epoch, best_acc, best_epoch, 最佳權重快照)；last.pt 不存在時為 None
+
+    Raises:
+        ValueError: last.pt 記錄的訓練設定與 config 不同
+    """
+    last = checkpointer.load('last')
+    if last is None:
+        return None
+    mismatch = config_mismatch(last, config)
+    if mismatch:
+        raise ValueError(f"{checkpointer.path('last')}: {mismatch}")
+    load_model_state(model, last['state_dict'], last['partial'])
+    optimizer.load_state_dict(last['optimizer'])
+    scheduler.load_state_dict(last['scheduler'])
+    best = checkpointer.load('best')
+    best_state = best['state_dict'] if best is not None else snapshot_state(model, names)
+    print(f"[Resume] 從 epoch {last['epoch'] + 1} 接續，目前最佳驗證準確度 {last['best_acc']:.4f}")
+    return last['epoch'] + 1, last['best_acc'], last['best_epoch'], best_state
+
+
+def save_epoch(checkpointer, model, optimizer, scheduler, names, partial, epoch, best_acc, best_epoch,
+               best_state=None, config=None):
+    """epoch 結束時排入 last.pt；這個 epoch 的準確度提升時（best_state 不為 None）同時排入 best.pt"""
+    if best_state is not None:
+        checkpointer.save('best', {'epoch': epoch, 'state_dict': best_state, 'partial': partial,
+                                   'val_acc': best_acc, 'config': config})
+    checkpointer.save('last', training_state(model, optimizer, scheduler, names, partial,
+                                             epoch, best_acc, best_epoch, config))
@@ -1,12 +1,21 @@
 """
 比較三個模型的推論結果
 分析優化過程對模型精度的影響
+
+每個模型只建立一次 Session；每張圖片只預處理一次，所有模型共用同一份張量。
+預設評估整個 data/val，標籤取自資料夾名稱（與 datasets.ImageFolder 相同：依名稱排序）
 """
-import onnxruntime as rt
-import numpy as np
-from PIL import Image
+import argparse
 import os
 import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from preprocessing import IMAGE_EXTENSIONS, new_batch
+from tensor_cache import TensorCache, DEFAULT_CACHE_DIR
+from ort_session import add_session_args, create_session, session_kwargs_from_args
 
 # 設置輸出編碼（Windows 兼容）
 if sys.platform == 'win32':
@@ -20,140 +29,212 @@ MODELS = {
     '修復模型': 'ants_bees_opt_fixed.onnx'
 }
 
-# 測試圖片
-TEST_IMAGES = [
-    ('螞蟻', 'data/val/ants/10308379_1b6c72e180.jpg'),
-    ('蜜蜂', 'data/val/bees/2525379273_dcb26a516d.jpg'),
-]
-
 CLASSES = ['Ant (螞蟻)', 'Bee (蜜蜂)']
 
-def preprocess(image_path):
-    """預處理圖片"""
-    img = Image.open(image_path).convert('RGB')
-    img = img.resize((256, 256))
-    left = (256 - 224) / 2
-    top = (256 - 224) / 2
-    right = (256 + 224) / 2
-    bottom = (256 + 224) / 2
-    img = img.crop((left, top, right, bottom))
-    
-    img_data = np.array(img).astype('float32') / 255.0
-    mean = np.array([0.485, 0.456, 0.406], dtype='float32')
-    std = np.array([0.229, 0.224, 0.225], dtype='float32')
-    img_data = (img_data - mean) / std
-    img_data = img_data.astype('float32')
-    img_data = img_data.transpose(2, 0, 1)
-    img_data = np.expand_dims(img_data, axis=0)
-    return img_data
-
-def run_inference(model_path, image_path):
-    """執行推論"""
-    if not os.path.exists(model_path):
-        return None, None, None
-    
-    try:
-        session = rt.InferenceSession(model_path)
-        input_name = session.get_inputs()[0].name
-        
-        input_data = preprocess(image_path)
-        output = session.run(None, {input_name: input_data})
-        raw_result = output[0][0]
-        
-        # 計算 Softmax
-        exp_result = np.exp(raw_result - np.max(raw_result))
-        probabilities = exp_result / np.sum(exp_result)
-        
-        predicted_idx = np.argmax(probabilities)
-        predicted_class = CLASSES[predicted_idx]
-        confidence = probabilities[predicted_idx]
-        
-        return raw_result, probabilities, predicted_class
-    except Exception as e:
-        return None, None, str(e)
-
-print("=" * 80)
-print("模型比較測試")
-print("=" * 80)
-
-# 檢查模型文件
-print("\n📦 檢查模型文件:")
-for name, path in MODELS.items():
-    exists = os.path.exists(path)
-    size = os.path.getsize(path) / (1024*1024) if exists else 0
-    print(f"  {name:10s}: {path:30s} {'✓' if exists else '✗'} ({size:.1f} MB)")
-
-# 測試每個模型
-results = {}
-for model_name, model_path in MODELS.items():
-    if not os.path.exists(model_path):
-        continue
-    
-    print(f"\n{'='*80}")
-    print(f"測試模型: {model_name} ({model_path})")
-    print(f"{'='*80}")
-    
-    results[model_name] = {}
-    
-    for label, image_path in TEST_IMAGES:
-        if not os.path.exists(image_path):
-            print(f"  ⚠️  跳過：找不到圖片 {image_path}")
+
+def collect_dataset(data_dir):
+    """
+    收集 data_dir/<類別>/ 下的所有圖片
+
+    Returns:
+        image_paths: 圖片路徑列表
+        labels: 對應的類別索引 (np.int64)
+        class_names: 依名稱排序的資料夾名稱
+    """
+    data_dir = Path(data_dir)
+    class_names = sorted(d.name for d in data_dir.iterdir() if d.is_dir())
+    image_paths = []
+    labels = []
+    for label, class_name in enumerate(class_names):
+        for path in sorted((data_dir / class_name).iterdir()):
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                image_paths.append(str(path))
+                labels.append(label)
+    return image_paths, np.array(labels, dtype=np.int64), class_names
+
+
+def load_tensors(image_paths, tensor_cache):
+    """
+    將所有圖片預處理成一個 (N, 3, 224, 224) 陣列（所有模型共用）
+
+    Returns:
+        tensors: 成功載入的張量
+        valid: 布林陣列，標示每張圖片是否載入成功
+    """
+    tensors = new_batch(len(image_paths))
+    valid = np.zeros(len(image_paths), dtype=bool)
+    count = 0
+    for i, image_path in enumerate(image_paths):
+        try:
+            tensor_cache.load_into(image_path, tensors, count)
+            valid[i] = True
+            count += 1
+        except Exception as e:
+            print(f"  ⚠️  跳過無法讀取的圖片 {image_path}: {e}")
+    return tensors[:count], valid
+
+
+def softmax(logits):
+    """對最後一維計算 Softmax"""
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def evaluate_model(session, tensors, batch_size):
+    """
+    以已建立的 Session 推論所有張量
+
+    Returns:
+        logits: (N, num_classes)
+        elapsed: 推論總時間（秒，不含 Session 建立）
+    """
+    input_name = session.get_inputs()[0].name
+    batch_dim = session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim > 0:
+        # 固定 batch 的模型只能依模型的 batch 大小推論
+        batch_size = batch_dim
+
+    outputs = []
+    start_time = time.perf_counter()
+    for start in range(0, len(tensors), batch_size):
+        batch = tensors[start:start + batch_size]
+        outputs.append(session.run(None, {input_name: batch})[0])
+    elapsed = time.perf_counter() - start_time
+    return np.concatenate(outputs, axis=0), elapsed
+
+
+def summarize(logits, labels):
+    """計算準確度、平均置信度差異 (top-1 與 top-2 概率差) 與各類別準確度"""
+    probabilities = softmax(logits)
+    predictions = probabilities.argmax(axis=1)
+    sorted_probs = np.sort(probabilities, axis=1)
+    margins = (sorted_probs[:, -1] - sorted_probs[:, -2]) * 100
+    correct = predictions == labels
+    per_class = {
+        label: correct[labels == label].mean() * 100 if np.any(labels == label) else 0.0
+        for label in np.unique(labels)
+    }
+    return {
+        'predictions': predictions,
+        'correct': int(correct.sum()),
+        'total': len(labels),
+        'accuracy': correct.mean() * 100,
+        'mean_margin': margins.mean(),
+        'per_class': per_class,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比較原始、優化、修復模型在驗證集上的表現')
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default='data/val',
+        help='驗證集資料夾，子資料夾名稱即為類別 (預設: data/val)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=16,
+        help='動態 batch 模型每次推論的圖片數量 (預設: 16)'
+    )
+    parser.add_argument(
+        '--tensor-cache',
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help=f'預處理張量快取目錄 (預設: {DEFAULT_CACHE_DIR})'
+    )
+    parser.add_argument(
+        '--show-errors',
+        action='store_true',
+        help='列出每個模型分類錯誤的圖片'
+    )
+    add_session_args(parser)
+    args = parser.parse_args()
+
+    print("=" * 80)
+    print("模型比較測試")
+    print("=" * 80)
+
+    # 檢查模型文件
+    print("\n📦 檢查模型文件:")
+    for name, path in MODELS.items():
+        exists = os.path.exists(path)
+        size = os.path.getsize(path) / (1024*1024) if exists else 0
+        print(f"  {name:10s}: {path:30s} {'✓' if exists else '✗'} ({size:.1f} MB)")
+
+    # 預處理（只做一次，所有模型共用）
+    if not os.path.isdir(args.data_dir):
+        print(f"\n❌ 錯誤：找不到驗證集資料夾 {args.data_dir}")
+        sys.exit(1)
+    image_paths, labels, class_names = collect_dataset(args.data_dir)
+    if not image_paths:
+        print(f"\n❌ 錯誤：在 {args.data_dir} 中找不到圖片")
+        sys.exit(1)
+
+    print(f"\n🖼️  預處理 {len(image_paths)} 張圖片 (類別: {class_names})...")
+    start_time = time.perf_counter()
+    with TensorCache(args.tensor_cache) as tensor_cache:
+        tensors, valid = load_tensors(image_paths, tensor_cache)
+        print(f"  完成，花費 {time.perf_counter() - start_time:.2f} 秒 "
+              f"(快取命中 {tensor_cache.hits}，未命中 {tensor_cache.misses})")
+    image_paths = [p for p, ok in zip(image_paths, valid) if ok]
+    labels = labels[valid]
+
+    # 測試每個模型（每個模型只建立一次 Session）
+    results = {}
+    for model_name, model_path in MODELS.items():
+        if not os.path.exists(model_path):
             continue
-        
-        raw_result, probabilities, predicted = run_inference(model_path, image_path)
-        
-        if raw_result is None:
-            print(f"  ❌ 推論失敗: {predicted}")
+
+        print(f"\n{'='*80}")
+        print(f"測試模型: {model_name} ({model_path})")
+        print(f"{'='*80}")
+
+        try:
+            start_time = time.perf_counter()
+            session = create_session(model_path, **session_kwargs_from_args(args))
+            load_time = time.perf_counter() - start_time
+            logits, infer_time = evaluate_model(session, tensors, args.batch_size)
+        except Exception as e:
+            print(f"  ❌ 推論失敗: {e}")
             continue
-        
-        # 計算置信度差異
-        sorted_probs = sorted(probabilities, reverse=True)
-        confidence_diff = (sorted_probs[0] - sorted_probs[1]) * 100 if len(sorted_probs) > 1 else 0
-        
-        # 判斷是否正確
-        is_correct = (label == '螞蟻' and predicted == CLASSES[0]) or \
-                     (label == '蜜蜂' and predicted == CLASSES[1])
-        
-        status = "✓" if is_correct else "✗"
-        
-        print(f"\n  {status} 測試圖片: {label} ({os.path.basename(image_path)})")
-        print(f"     原始輸出: {raw_result}")
-        print(f"     概率分佈:")
-        for i, (cls, prob) in enumerate(zip(CLASSES, probabilities)):
-            marker = " ←" if i == np.argmax(probabilities) else ""
-            print(f"       {cls}: {prob*100:.2f}%{marker}")
-        print(f"     預測結果: {predicted}")
-        print(f"     置信度差異: {confidence_diff:.2f}%")
-        
-        results[model_name][label] = {
-            'raw': raw_result,
-            'probabilities': probabilities,
-            'predicted': predicted,
-            'correct': is_correct,
-            'confidence_diff': confidence_diff
-        }
-
-# 總結
-print(f"\n{'='*80}")
-print("測試總結")
-print(f"{'='*80}")
-
-print("\n準確度統計:")
-for model_name in results.keys():
-    correct_count = sum(1 for r in results[model_name].values() if r['correct'])
-    total_count = len(results[model_name])
-    accuracy = correct_count / total_count * 100 if total_count > 0 else 0
-    print(f"  {model_name:10s}: {correct_count}/{total_count} ({accuracy:.1f}%)")
-
-print("\n平均置信度差異:")
-for model_name in results.keys():
-    avg_diff = np.mean([r['confidence_diff'] for r in results[model_name].values()])
-    print(f"  {model_name:10s}: {avg_diff:.2f}%")
-
-print("\n⚠️  問題分析:")
-print("  1. 如果優化模型和修復模型的準確度下降，說明優化過程可能破壞了模型")
-print("  2. 如果置信度差異很小（<10%），說明模型不確定，可能是優化導致的精度損失")
-print("  3. 建議：使用原始模型 ants_bees.onnx 進行部署，或重新進行優化")
-
-print("\n" + "="*80)
 
+        summary = summarize(logits, labels)
+        summary['load_time'] = load_time
+        summary['infer_time'] = infer_time
+        results[model_name] = summary
+
+        print(f"  準確度: {summary['correct']}/{summary['total']} ({summary['accuracy']:.1f}%)")
+        for label, accuracy in summary['per_class'].items():
+            print(f"    {class_names[label]:10s}: {accuracy:.1f}%")
+        print(f"  平均置信度差異: {summary['mean_margin']:.2f}%")
+        print(f"  Session 建立: {load_time:.3f} 秒，推論: {infer_time:.3f} 秒 "
+              f"({len(tensors) / infer_time:.1f} 張/秒)")
+
+        if args.show_errors:
+            for path, label, prediction in zip(image_paths, labels, summary['predictions']):
+                if prediction != label:
+                    print(f"    ✗ {os.path.basename(path)}: {CLASSES[label]} → {CLASSES[prediction]}")
+
+    # 總結
+    print(f"\n{'='*80}")
+    print("測試總結")
+    print(f"{'='*80}")
+
+    print(f"\n{'模型':10s} {'準確度':>14s} {'平均置信度差異':>14s} {'Session 建立':>12s} {'推論時間':>10s}")
+    for model_name, summary in results.items():
+        accuracy = f"{summary['correct']}/{summary['total']} ({summary['accuracy']:.1f}%)"
+        print(f"{model_name:10s} {accuracy:>14s} {summary['mean_margin']:>13.2f}% "
+              f"{summary['load_time']:>11.3f}s {summary['infer_time']:>9.3f}s")
+
+    print("\n⚠️  問題分析:")
+    print("  1. 如果優化模型和修復模型的準確度下降，說明優化過程可能破壞了模型")
+    print("  2. 如果置信度差異很小（<10%），說明模型不確定，可能是優化導致的精度損失")
+    print("  3. 建議：使用原始模型 ants_bees.onnx 進行部署，或重新進行優化")
+
+    print("\n" + "="*80)
+
+
+if __name__ == "__main__":
+    main()
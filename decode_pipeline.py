@@ -0,0 +1,95 @@
+"""
+平行圖片解碼管線 (producer/consumer)
+多個解碼 worker 在背景執行 JPEG 解碼、調整大小與中心裁切，
+推論迴圈依原始順序取出結果；同時在處理中的圖片數量受 queue_depth 限制，
+因此記憶體用量不會隨資料夾大小成長
+
+PIL 的解碼與 resize 會釋放 GIL，使用執行緒即可讓多核心同時工作，
+也能與 session.run 重疊執行
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from preprocessing import load_image
+
+
+def default_num_workers():
+    """預設解碼 worker 數量：CPU 核心數"""
+    return os.cpu_count() or 1
+
+
+def _safe_load(loader, image_path):
+    """執行 loader，將例外包裝為回傳值，避免單張圖片失敗中斷整個管線"""
+    try:
+        return loader(image_path), None
+    except Exception as e:
+        return None, e
+
+
+class DecodePipeline:
+    """
+    依序產出 (image_path, image, error) 的解碼管線
+
+    Args:
+        image_paths: 圖片路徑列表
+        num_workers: 解碼 worker 數量；0 表示在呼叫端執行緒中逐張解碼
+        queue_depth: 最多同時在處理（已提交但尚未被取出）的圖片數量
+        loader: 解碼函數，預設為 preprocessing.load_image（回傳 uint8 HWC）
+
+    使用方式:
+        with DecodePipeline(paths, num_workers=4, queue_depth=16) as pipeline:
+            for image_path, image, error in pipeline:
+                ...
+    """
+
+    def __init__(self, image_paths, num_workers=None, queue_depth=16, loader=load_image):
+        self.image_paths = list(image_paths)
+        self.num_workers = default_num_workers() if num_workers is None else max(0, num_workers)
+        self.queue_depth = max(1, queue_depth)
+        self.loader = loader
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """停止 worker，尚未開始的工作會被取消"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for image_path in self.image_paths:
+                image, error = _safe_load(self.loader, image_path)
+                yield image_path, image, error
+            return
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.num_workers, thread_name_prefix='decode'
+        )
+        # 依提交順序排列的有界佇列：取出最前面的結果後再補上一張
+        pending = deque()
+        paths = iter(self.image_paths)
+        try:
+            for image_path in paths:
+                pending.append((image_path, self._executor.submit(_safe_load, self.loader, image_path)))
+                if len(pending) >= self.queue_depth:
+                    break
+
+            while pending:
+                image_path, future = pending.popleft()
+                next_path = next(paths, None)
+                if next_path is not None:
+                    pending.append((next_path, self._executor.submit(_safe_load, self.loader, next_path)))
+                image, error = future.result()
+                yield image_path, image, error
+        finally:
+            self.close()
@@ -0,0 +1,65 @@
+"""
+知識蒸餾：以微調好的 ResNet50 為 teacher，訓練較小的 student
+student 同時學習 teacher 的 soft logits（溫度 T 的 softmax）與真實標籤：
+
+    loss = alpha * T^2 * KL(softmax(teacher / T) || softmax(student / T)) + (1 - alpha) * CE(student, label)
+
+T^2 讓 soft target 的梯度大小不隨溫度改變（Hinton et al., 2015）
+"""
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import models
+
+STUDENTS = ('resnet18', 'mobilenet_v2')
+DEFAULT_TEMPERATURE = 4.0
+DEFAULT_ALPHA = 0.7
+
+
+def build_student(arch, num_classes=2):
+    """建立 ImageNet 預訓練的 student，分類層換成 num_classes 類"""
+    if arch == 'resnet18':
+        try:
+            model = models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1)
+        except AttributeError:
+            model = models.resnet18(pretrained=True)
+        model.fc = nn.Linear(model.fc.in_features, num_classes)
+    elif arch == 'mobilenet_v2':
+        try:
+            model = models.mobilenet_v2(weights=models.MobileNet_V2_Weights.IMAGENET1K_V1)
+        except AttributeError:
+            model = models.mobilenet_v2(pretrained=True)
+        model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
+    else:
+        raise ValueError(f"不支援的 student: {arch}（可用: {', '.join(STUDENTS)}）")
+    return model
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature=DEFAULT_TEMPERATURE, alpha=DEFAULT_ALPHA):
+    soft = F.kl_div(F.log_softmax(student_logits.float() / temperature, dim=1),
+                    F.softmax(teacher_logits.float() / temperature, dim=1),
+                    reduction='batchmean') * (temperature ** 2)
+    hard = F.cross_entropy(student_logits.float(), labels)
+    return alpha * soft + (1 - alpha) * hard
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure_latency(model, device, iterations=20, warmup=3):
+    """batch=1 在 device 上的平均前向傳播時間（毫秒）；GPU 會等待運算完成再計時"""
+    model.eval()
+    dummy_input = torch.randn(1, 3, 224, 224, device=device)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(dummy_input)
+        _synchronize(device)
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            model(dummy_input)
+        _synchronize(device)
+    return (time.perf_counter() - start_time) / iterations * 1000
@@ -0,0 +1,212 @@
+"""
+凍結 backbone 的特徵快取（只訓練 fc 時使用）
+backbone 不更新時，每個 epoch 重新跑 ResNet50 只是在重算同樣的特徵。
+這裡把 2048 維的 pooled 特徵算一次存進記憶體映射的 .npy，之後 fc 直接在特徵上訓練
+
+訓練集的隨機增強 (RandomResizedCrop / Flip) 預先為每張圖片抽樣 K 個 view，
+每個 epoch 每張圖片隨機取其中一個，保留資料增強的效果；驗證集只有一個 view
+
+檔案結構 (feature_dir/<key>/):
+    train_features.npy  (N, K, 2048) float32
+    train_labels.npy    (N,) int64
+    val_features.npy    (M, 1, 2048) float32
+    val_labels.npy      (M,) int64
+    meta.json           建立參數
+
+key 包含 backbone 權重、圖片清單（路徑、大小、修改時間）、transforms、K 與精度（bf16），任何一項改變都會重新計算。
+特徵以 eval 模式計算（BatchNorm 使用 running statistics），與匯出的 ONNX 一致；
+mixed_precision 時前向傳播以 bfloat16 autocast + channels_last 執行，存檔仍為 float32
+"""
+import copy
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+DEFAULT_FEATURE_DIR = '.feature_cache'
+DEFAULT_VIEWS = 8
+
+
+def backbone_digest(model):
+    """backbone（fc 以外）權重與 buffer 的雜湊值"""
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        if name.startswith('fc.'):
+            continue
+        digest.update(name.encode())
+        digest.update(str(tuple(tensor.shape)).encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def dataset_signature(dataset):
+    """ImageFolder 的圖片清單與 transforms（路徑、大小、修改時間）；ShardDataset 使用自己的 signature()"""
+    if hasattr(dataset, 'signature'):
+        return dataset.signature()
+    digest = hashlib.sha256(repr(dataset.transform).encode())
+    for path, label in dataset.samples:
+        stat = os.stat(path)
+        digest.update(f'{path};{label};{stat.st_size};{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def cache_key(model, datasets, views, seed, mixed_precision=False):
+    digest = hashlib.sha256()
+    digest.update(f'backbone={backbone_digest(model)};views={views};seed={seed}'.encode())
+    if mixed_precision:
+        digest.update(b';precision=bf16')
+    for phase in ('train', 'val'):
+        digest.update(f'{phase}={dataset_signature(datasets[phase])}'.encode())
+    return digest.hexdigest()[:16]
+
+
+class _Backbone(nn.Module):
+    """去掉 fc 的 ResNet：輸出 flatten 後的 pooled 特徵"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        m = self.model
+        x = m.maxpool(m.relu(m.bn1(m.conv1(x))))
+        x = m.layer4(m.layer3(m.layer2(m.layer1(x))))
+        return torch.flatten(m.avgpool(x), 1)
+
+
+def _extract(backbone, dataset, views, out, labels, device, batch_size, num_workers, mixed_precision=False):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    memory_format = torch.channels_last if mixed_precision else torch.contiguous_format
+    for view in range(views):
+        offset = 0
+        for inputs, targets in loader:
+            with torch.no_grad(), torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                                                 enabled=mixed_precision):
+                features = backbone(inputs.to(device, memory_format=memory_format)).float().cpu().numpy()
+            out[offset:offset + len(features), view] = features
+            labels[offset:offset + len(features)] = targets.numpy()
+            offset += len(features)
+
+
+def build_feature_store(model, datasets, device, feature_dir=DEFAULT_FEATURE_DIR, views=DEFAULT_VIEWS,
+                        seed=0, batch_size=32, num_workers=0, mixed_precision=False):
+    """
+    計算（或沿用快取的）train / val 特徵
+
+    Returns:
+        特徵資料夾路徑
+    """
+    key = cache_key(model, datasets, views, seed, mixed_precision)
+    store_dir = os.path.join(feature_dir, key)
+    if os.path.exists(os.path.join(store_dir, 'meta.json')):
+        print(f"[Features] 沿用快取的特徵: {store_dir}")
+        return store_dir
+
+    print(f"[Features] 計算 backbone 特徵（train {views} 個 view，val 1 個）...")
+    start_time = time.time()
+    os.makedirs(feature_dir, exist_ok=True)
+    # 先寫到暫存資料夾，完成後再改名，中斷時不會留下不完整的快取
+    work_dir = f'{store_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+
+    was_training = model.training
+    backbone = _Backbone(model).eval()
+    torch.manual_seed(seed)
+    try:
+        for phase, phase_views in (('train', views), ('val', 1)):
+            dataset = datasets[phase]
+            num_features = model.fc.in_features
+            features = np.lib.format.open_memmap(os.path.join(work_dir, f'{phase}_features.npy'), mode='w+',
+                                                 dtype=np.float32, shape=(len(dataset), phase_views, num_features))
+            labels = np.lib.format.open_memmap(os.path.join(work_dir, f'{phase}_labels.npy'), mode='w+',
+                                               dtype=np.int64, shape=(len(dataset),))
+            _extract(backbone, dataset, phase_views, features, labels, device, batch_size, num_workers,
+                     mixed_precision)
+            features.flush()
+            labels.flush()
+            del features, labels
+        meta = {'views': views, 'seed': seed, 'precision': 'bf16' if mixed_precision else 'fp32',
+                'classes': datasets['train'].classes,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(os.path.join(work_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2, ensure_ascii=False)
+        os.replace(work_dir, store_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        model.train(was_training)
+
+    print(f"[Features] 完成，花費 {time.time() - start_time:.1f} 秒: {store_dir}")
+    return store_dir
+
+
+def load_feature_store(store_dir):
+    """以記憶體映射開啟特徵：{phase: (features, labels)}"""
+    return {phase: (np.load(os.path.join(store_dir, f'{phase}_features.npy'), mmap_mode='r'),
+                    np.load(os.path.join(store_dir, f'{phase}_labels.npy'), mmap_mode='r'))
+            for phase in ('train', 'val')}
+
+
+def train_fc_on_features(fc, store, num_epochs=25, lr=0.001, momentum=0.9, step_size=7, gamma=0.1,
+                         batch_size=4, seed=0):
+    """
+    在快取的特徵上訓練 fc（超參數與 train_resnet50.py 的 fc 微調相同）
+
+    Returns:
+        載入最佳驗證準確度權重的 fc
+    """
+    since = time.time()
+    rng = np.random.default_rng(seed)
+    fc = fc.cpu()
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(fc.parameters(), lr=lr, momentum=momentum)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=step_size, gamma=gamma)
+
+    train_features, train_labels = store['train']
+    val_features = torch.from_numpy(np.ascontiguousarray(store['val'][0][:, 0]))
+    val_labels = torch.from_numpy(np.asarray(store['val'][1]))
+    num_train, num_views = train_features.shape[:2]
+    labels = torch.from_numpy(np.asarray(train_labels))
+
+    best_fc_wts = copy.deepcopy(fc.state_dict())
+    best_acc = 0.0
+    for epoch in range(num_epochs):
+        # 每張圖片隨機取一個預先增強的 view
+        views = rng.integers(0, num_views, num_train)
+        features = torch.from_numpy(train_features[np.arange(num_train), views])
+        order = torch.from_numpy(rng.permutation(num_train))
+
+        fc.train()
+        running_loss = 0.0
+        running_corrects = 0
+        for start in range(0, num_train, batch_size):
+            index = order[start:start + batch_size]
+            optimizer.zero_grad()
+            outputs = fc(features[index])
+            loss = criterion(outputs, labels[index])
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * len(index)
+            running_corrects += (outputs.argmax(1) == labels[index]).sum().item()
+        scheduler.step()
+
+        fc.eval()
+        with torch.no_grad():
+            val_outputs = fc(val_features)
+            val_loss = criterion(val_outputs, val_labels).item()
+            val_acc = (val_outputs.argmax(1) == val_labels).double().mean().item()
+        print(f'Epoch {epoch + 1}/{num_epochs}  train Loss: {running_loss / num_train:.4f} '
+              f'Acc: {running_corrects / num_train:.4f}  val Loss: {val_loss:.4f} Acc: {val_acc:.4f}')
+        if val_acc > best_acc:
+            best_acc = val_acc
+            best_fc_wts = copy.deepcopy(fc.state_dict())
+
+    print(f'\n訓練完成，花費時間: {(time.time() - since) * 1000:.0f} 毫秒')
+    print(f'最佳驗證準確度: {best_acc:4f}')
+    fc.load_state_dict(best_fc_wts)
+    return fc
@@ -7,88 +7,163 @@ import torch.nn as nn
 from torchvision import models
 import onnx
 import os
+import sys
+import argparse
 
-# 載入訓練好的模型權重（如果有的話）
-# 這裡我們重新創建模型結構並導出
+WEIGHT_FILES = ['checkpoints/best.pt', 'ants_bees_model.pth', 'model.pth', 'best_model.pth']
 
-print("=" * 60)
-print("重新導出兼容的 ONNX 模型")
-print("=" * 60)
 
-# 創建模型結構
-print("正在創建 ResNet50 模型結構...")
-try:
-    model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
-except AttributeError:
-    model = models.resnet50(pretrained=True)
+def build_model(weight_files=None):
+    """
+    建立 ResNet50 (2 類) 並載入第一個存在的權重檔
 
-model.fc = nn.Linear(model.fc.in_features, 2)
+    Args:
+        weight_files: 依序嘗試的權重檔；None 表示使用 WEIGHT_FILES，
+            找不到或載入失敗時退回 ImageNet 預訓練權重。明確指定時不會退回，
+            權重檔都不存在或載入失敗會拋出例外
 
-# 載入權重（如果之前有保存）
-weight_files = ['ants_bees_model.pth', 'model.pth', 'best_model.pth']
-weight_loaded = False
+    Returns:
+        (model, 載入的權重檔路徑或 None)
+    """
+    explicit = weight_files is not None
+    if not explicit:
+        weight_files = WEIGHT_FILES
 
-for weight_file in weight_files:
+    print("正在創建 ResNet50 模型結構...")
     try:
-        if os.path.exists(weight_file):
+        model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
+    except AttributeError:
+        model = models.resnet50(pretrained=True)
+
+    model.fc = nn.Linear(model.fc.in_features, 2)
+
+    # 載入權重（如果之前有保存）
+    for weight_file in weight_files:
+        if not os.path.exists(weight_file):
+            continue
+        try:
             checkpoint = torch.load(weight_file, map_location='cpu')
             if isinstance(checkpoint, dict) and 'state_dict' in checkpoint:
-                model.load_state_dict(checkpoint['state_dict'])
+                # train_resnet50.py 凍結 backbone 時的 checkpoint 只含 fc 與 BN 統計量（partial）
+                model.load_state_dict(checkpoint['state_dict'], strict=not checkpoint.get('partial', False))
             else:
                 model.load_state_dict(checkpoint)
-            print(f"[OK] 已載入訓練好的權重: {weight_file}")
-            weight_loaded = True
-            break
-    except Exception as e:
-        continue
-
-if not weight_loaded:
+        except Exception as e:
+            if explicit:
+                raise RuntimeError(f"無法載入權重檔 {weight_file}: {e}") from e
+            continue
+        print(f"[OK] 已載入訓練好的權重: {weight_file}")
+        model.eval()
+        return model, weight_file
+
+    if explicit:
+        raise FileNotFoundError(f"找不到權重檔: {', '.join(weight_files)}")
     print("[WARNING] 未找到權重文件，將使用 ImageNet 預訓練權重")
     print("  注意：這將使用預訓練權重而非訓練好的螞蟻/蜜蜂分類權重")
     print("  建議：先運行 train_resnet50.py 訓練模型")
+    model.eval()
+    return model, None
+
+
+def export_onnx(output_file, weight_files=None, dynamic_batch=False, opset_version=11):
+    """
+    導出 ONNX 模型
+
+    Args:
+        output_file: 輸出路徑
+        weight_files: 依序嘗試載入的權重檔（見 build_model）
+        dynamic_batch: 是否將 batch 維度設為動態
+        opset_version: ONNX opset 版本
+
+    Returns:
+        output_file
+    """
+    model, _ = build_model(weight_files)
+
+    # 創建虛擬輸入
+    dummy_input = torch.randn(1, 3, 224, 224)
+
+    if dynamic_batch:
+        # 第 0 維（batch）設為動態，其餘維度固定
+        dynamic_axes = {'input': {0: 'batch_size'}, 'output': {0: 'batch_size'}}
+    else:
+        dynamic_axes = None  # 不使用動態軸（Kneron 工具鏈需要固定形狀）
+
+    print(f"\n正在導出 ONNX 模型到: {output_file}")
+    print(f"使用參數: opset_version={opset_version}, do_constant_folding=True")
+    if dynamic_axes:
+        print("動態 batch 維度: 啟用")
+
+    torch.onnx.export(
+        model,
+        dummy_input,
+        output_file,
+        input_names=['input'],
+        output_names=['output'],
+        opset_version=opset_version,  # 使用較低的 opset 版本
+        do_constant_folding=True,  # 啟用常量折疊
+        dynamic_axes=dynamic_axes,
+        export_params=True,
+        verbose=False
+    )
+
+    print(f"[OK] ONNX 模型已導出: {output_file}")
+
+    # 檢查導出的模型
+    print("\n檢查導出的模型...")
+    try:
+        model_onnx = onnx.load(output_file)
+        print(f"  IR 版本: {model_onnx.ir_version}")
+        if model_onnx.opset_import:
+            for opset in model_onnx.opset_import:
+                print(f"  Opset 版本: {opset.version}")
+
+        # 驗證模型
+        onnx.checker.check_model(model_onnx)
+        print("  [OK] 模型驗證通過")
+    except Exception as e:
+        print(f"  ⚠ 模型檢查警告: {e}")
+    return output_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description='重新導出兼容的 ONNX 模型')
+    parser.add_argument(
+        '--dynamic-batch',
+        action='store_true',
+        help='匯出動態 batch 維度的模型 (ants_bees_dynamic.onnx)，供 inference_local.py --batch-size 使用；'
+             'Kneron 編譯流程請使用預設的固定 batch 模型'
+    )
+    parser.add_argument(
+        '--weights',
+        nargs='+',
+        default=None,
+        help=f'依序嘗試載入的權重檔，全部失敗時報錯 '
+             f'(預設: {" ".join(WEIGHT_FILES)}，找不到時使用 ImageNet 預訓練權重)'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        type=str,
+        default=None,
+        help='輸出路徑 (預設: ants_bees_compatible.onnx，動態 batch 為 ants_bees_dynamic.onnx)'
+    )
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("重新導出兼容的 ONNX 模型")
+    print("=" * 60)
+
+    output_file = args.output or ("ants_bees_dynamic.onnx" if args.dynamic_batch else "ants_bees_compatible.onnx")
+    try:
+        export_onnx(output_file, args.weights, dynamic_batch=args.dynamic_batch)
+    except (FileNotFoundError, RuntimeError) as e:
+        print(f"❌ 錯誤：{e}")
+        sys.exit(1)
+
+    print("\n" + "=" * 60)
+    print("完成！")
+    print("=" * 60)
 
-model.eval()
-
-# 創建虛擬輸入
-dummy_input = torch.randn(1, 3, 224, 224)
-
-# 導出 ONNX（使用兼容的參數）
-output_file = "ants_bees_compatible.onnx"
-
-print(f"\n正在導出 ONNX 模型到: {output_file}")
-print("使用參數: opset_version=11, do_constant_folding=True")
-
-torch.onnx.export(
-    model,
-    dummy_input,
-    output_file,
-    input_names=['input'],
-    output_names=['output'],
-    opset_version=11,  # 使用較低的 opset 版本
-    do_constant_folding=True,  # 啟用常量折疊
-    dynamic_axes=None,  # 不使用動態軸
-    export_params=True,
-    verbose=False
-)
-
-print(f"[OK] ONNX 模型已導出: {output_file}")
-
-# 檢查導出的模型
-print("\n檢查導出的模型...")
-try:
-    model_onnx = onnx.load(output_file)
-    print(f"  IR 版本: {model_onnx.ir_version}")
-    if model_onnx.opset_import:
-        for opset in model_onnx.opset_import:
-            print(f"  Opset 版本: {opset.version}")
-    
-    # 驗證模型
-    onnx.checker.check_model(model_onnx)
-    print("  [OK] 模型驗證通過")
-except Exception as e:
-    print(f"  ⚠ 模型檢查警告: {e}")
-
-print("\n" + "=" * 60)
-print("完成！")
-print("=" * 60)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+訓練資料的預解碼 shard
+datasets.ImageFolder 每個 epoch 都要重新解碼 data/train 與 data/val 的每張 JPEG；
+這裡一次把圖片解碼並縮小成 uint8 陣列，存成記憶體映射的 .npy，訓練時只做剩下的隨機增強
+
+    train: 短邊縮放到 SIZE（預設 256，保持長寬比）再取中央 SIZE x SIZE，訓練時再做 RandomResizedCrop(224) / Flip
+    val:   與 train_resnet50.py 的 Resize(256) + CenterCrop(224) 相同，訓練時只剩 ToTensor / Normalize
+
+與直接讀 JPEG 的差異只在 train：RandomResizedCrop 從中央正方形（而非整張原圖）取樣，
+長邊兩側超出正方形的部分不會被取到，小範圍的 crop 也是從 SIZE 解析度放大，而非原圖解析度
+
+檔案結構 (shard_dir/):
+    train_images.npy  (N, SIZE, SIZE, 3) uint8
+    train_labels.npy  (N,) int64
+    val_images.npy    (M, 224, 224, 3) uint8
+    val_labels.npy    (M,) int64
+    meta.json         類別、來源圖片清單與轉換參數
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from decode_pipeline import default_num_workers
+from preprocessing import IMAGE_EXTENSIONS
+
+DEFAULT_SHARD_DIR = 'data_shards'
+TRAIN_SIZE = 256
+VAL_RESIZE = 256
+VAL_CROP = 224
+SHARD_FILES = ('meta.json', 'train_images.npy', 'train_labels.npy', 'val_images.npy', 'val_labels.npy')
+
+
+def scan_image_folder(root):
+    """與 ImageFolder 相同的規則：子資料夾名稱排序後作為類別"""
+    classes = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+    samples = []
+    for label, name in enumerate(classes):
+        for dirpath, _, filenames in sorted(os.walk(os.path.join(root, name))):
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                    samples.append((os.path.join(dirpath, filename), label))
+    return classes, samples
+
+
+def load_train_image(path, size=TRAIN_SIZE):
+    """短邊縮放到 size（保持長寬比）後取中央 size x size"""
+    return load_val_image(path, resize=size, crop=size)
+
+
+def load_val_image(path, resize=VAL_RESIZE, crop=VAL_CROP):
+    """與 torchvision 的 Resize(resize) + CenterCrop(crop) 相同（短邊縮放到 resize，保持長寬比）"""
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        width, height = img.size
+        if width <= height:
+            new_size = (resize, int(resize * height / width))
+        else:
+            new_size = (int(resize * width / height), resize)
+        img = img.resize(new_size, Image.BILINEAR)
+        left = int(round((new_size[0] - crop) / 2.0))
+        top = int(round((new_size[1] - crop) / 2.0))
+        return np.asarray(img.crop((left, top, left + crop, top + crop)), dtype=np.uint8)
+
+
+def _write_split(samples, loader, shape, images_path, labels_path, num_workers):
+    images = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8, shape=(len(samples),) + shape)
+    labels = np.lib.format.open_memmap(labels_path, mode='w+', dtype=np.int64, shape=(len(samples),))
+
+    def convert(index):
+        path, label = samples[index]
+        images[index] = loader(path)
+        labels[index] = label
+
+    # PIL 的解碼與 resize 會釋放 GIL，執行緒即可平行
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        list(executor.map(convert, range(len(samples))))
+    images.flush()
+    labels.flush()
+
+
+def is_shard_dir(path):
+    """path 是否為 build_shards 產生的 shard 資料夾（只含 meta.json 與 shard 的 .npy）"""
+    if not os.path.isdir(path):
+        return False
+    entries = set(os.listdir(path))
+    return {'meta.json', 'train_images.npy', 'val_images.npy'} <= entries and entries <= set(SHARD_FILES)
+
+
+def build_shards(data_dir, shard_dir=DEFAULT_SHARD_DIR, train_size=TRAIN_SIZE, num_workers=None):
+    """
+    將 data_dir/train 與 data_dir/val 轉換成 shard
+
+    shard_dir 已存在時只會取代先前產生的 shard 資料夾，其他資料夾不會被刪除
+
+    Returns:
+        meta dict
+
+    Raises:
+        FileExistsError: shard_dir 已存在且不是 shard 資料夾
+    """
+    if os.path.lexists(shard_dir) and not is_shard_dir(shard_dir):
+        raise FileExistsError(f"{shard_dir} 已存在且不是 shard 資料夾，請指定新的或既有的 shard 輸出路徑")
+    num_workers = num_workers or default_num_workers()
+    parent = os.path.dirname(os.path.abspath(shard_dir))
+    os.makedirs(parent, exist_ok=True)
+    # 先寫到暫存資料夾，完成後再改名，中斷時不會留下不完整的 shard
+    work_dir = f'{os.path.abspath(shard_dir)}.{os.getpid()}.tmp'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+
+    meta = {'train_size': train_size, 'val_resize': VAL_RESIZE, 'val_crop': VAL_CROP, 'splits': {}}
+    try:
+        for split in ('train', 'val'):
+            classes, samples = scan_image_folder(os.path.join(data_dir, split))
+            if split == 'train':
+                loader, shape = (lambda p: load_train_image(p, train_size)), (train_size, train_size, 3)
+            else:
+                loader, shape = load_val_image, (VAL_CROP, VAL_CROP, 3)
+            start_time = time.perf_counter()
+            _write_split(samples, loader, shape, os.path.join(work_dir, f'{split}_images.npy'),
+                         os.path.join(work_dir, f'{split}_labels.npy'), num_workers)
+            print(f"  ✓ {split}: {len(samples)} 張，{len(samples) * int(np.prod(shape)) / (1024 * 1024):.1f} MB，"
+                  f"{time.perf_counter() - start_time:.1f} 秒")
+            meta['classes'] = classes
+            meta['splits'][split] = {
+                'count': len(samples),
+                'shape': list(shape),
+                'samples': [[os.path.relpath(path, data_dir), label] for path, label in samples],
+            }
+        with open(os.path.join(work_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2, ensure_ascii=False)
+        if os.path.lexists(shard_dir):
+            # 轉換期間 shard_dir 可能被改成其他內容，取代前再確認一次
+            if not is_shard_dir(shard_dir):
+                raise FileExistsError(f"{shard_dir} 已存在且不是 shard 資料夾")
+            shutil.rmtree(shard_dir)
+        os.replace(work_dir, shard_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return meta
+
+
+class ShardDataset:
+    """
+    shard 的 map-style Dataset（可直接交給 torch DataLoader）
+
+    記憶體映射在每個 worker 第一次讀取時才開啟，不會隨 Dataset 一起被 pickle 到 worker
+
+    Args:
+        shard_dir: shard 資料夾
+        split: 'train' 或 'val'
+        transform: 套用在 PIL 圖片上的 transforms（與 ImageFolder 相同）
+    """
+
+    def __init__(self, shard_dir, split, transform=None):
+        with open(os.path.join(shard_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.shard_dir = shard_dir
+        self.split = split
+        self.transform = transform
+        self.classes = meta['classes']
+        self.samples = [tuple(sample) for sample in meta['splits'][split]['samples']]
+        self.images_path = os.path.join(shard_dir, f'{split}_images.npy')
+        self.labels_path = os.path.join(shard_dir, f'{split}_labels.npy')
+        self._images = None
+        self._labels = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = state['_labels'] = None
+        return state
+
+    def __getitem__(self, index):
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode='r')
+            self._labels = np.load(self.labels_path, mmap_mode='r')
+        image = Image.fromarray(np.asarray(self._images[index]))
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self._labels[index])
+
+    def signature(self):
+        """shard 內容與 transforms 的雜湊值（feature_cache 的快取 key 使用）"""
+        digest = hashlib.sha256(repr(self.transform).encode())
+        for path in (self.images_path, self.labels_path):
+            stat = os.stat(path)
+            digest.update(f'{os.path.abspath(path)};{stat.st_size};{stat.st_mtime_ns}\n'.encode())
+        return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='將 data/train 與 data/val 預先解碼成 uint8 shard',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=f"""
+使用範例:
+  python image_shards.py                           # data/ → {DEFAULT_SHARD_DIR}/
+  python train_resnet50.py --shards {DEFAULT_SHARD_DIR} --batch-size 32 --num-workers 4 --persistent-workers
+        """
+    )
+    parser.add_argument('--data-dir', type=str, default='data', help='資料集路徑 (預設: data)')
+    parser.add_argument('-o', '--output', type=str, default=DEFAULT_SHARD_DIR,
+                        help=f'shard 輸出資料夾，已存在時必須是先前產生的 shard (預設: {DEFAULT_SHARD_DIR})')
+    parser.add_argument('--train-size', type=int, default=TRAIN_SIZE,
+                        help=f'訓練圖片縮放後的邊長 (預設: {TRAIN_SIZE})')
+    parser.add_argument('--workers', type=int, default=default_num_workers(),
+                        help='解碼的執行緒數 (預設: CPU 核心數)')
+    args = parser.parse_args()
+
+    for split in ('train', 'val'):
+        if not os.path.isdir(os.path.join(args.data_dir, split)):
+            print(f"❌ 錯誤：找不到 {os.path.join(args.data_dir, split)}")
+            sys.exit(1)
+    if args.train_size < VAL_CROP:
+        print(f"❌ 錯誤：--train-size 不能小於 {VAL_CROP}")
+        sys.exit(1)
+
+    if os.path.lexists(args.output) and not is_shard_dir(args.output):
+        print(f"❌ 錯誤：{args.output} 已存在且不是 shard 資料夾，不會覆蓋；請指定其他輸出路徑")
+        sys.exit(1)
+
+    print(f"正在轉換 {args.data_dir} → {args.output} ...")
+    try:
+        meta = build_shards(args.data_dir, args.output, train_size=args.train_size, num_workers=args.workers)
+    except FileExistsError as e:
+        print(f"❌ 錯誤：{e}")
+        sys.exit(1)
+    print(f"✓ 完成，類別: {meta['classes']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,20 @@
 本地 ONNX 模型推論工具
 支持單張圖片、批量處理和詳細結果顯示
 """
-import onnxruntime as rt
 import numpy as np
-from PIL import Image
 import os
 import sys
 import argparse
 import glob
+import time
 from pathlib import Path
 
+from preprocessing import preprocess, load_image, normalize_into, new_batch
+from decode_pipeline import DecodePipeline, default_num_workers
+from tensor_cache import TensorCache, TENSOR_BYTES, DEFAULT_MAX_BYTES
+from result_writer import ResultWriter
+from ort_session import add_session_args, create_session, session_kwargs_from_args
+
 # 設置輸出編碼（Windows 兼容）
 if sys.platform == 'win32':
     import io
@@ -20,42 +25,38 @@ if sys.platform == 'win32':
 # 類別名稱
 CLASSES = ['Ant (螞蟻)', 'Bee (蜜蜂)']
 
-def preprocess(image_path):
+def postprocess(raw_result):
     """
-    預處理圖片：調整大小、中心裁切、標準化
-    與訓練時的預處理完全一致
+    將單張圖片的原始輸出轉為預測結果
+
+    Returns:
+        predicted_class, confidence, probabilities
     """
-    # 讀取圖片
-    img = Image.open(image_path).convert('RGB')
-    
-    # 預處理：調整大小 -> 中心裁切 -> 標準化
-    img = img.resize((256, 256))
-    
-    # Center Crop 224x224
-    left = (256 - 224) / 2
-    top = (256 - 224) / 2
-    right = (256 + 224) / 2
-    bottom = (256 + 224) / 2
-    img = img.crop((left, top, right, bottom))
-    
-    # 轉為 numpy array 並標準化
-    img_data = np.array(img).astype('float32') / 255.0
-    
-    # 標準化 (Normalize) mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-    mean = np.array([0.485, 0.456, 0.406], dtype='float32')
-    std = np.array([0.229, 0.224, 0.225], dtype='float32')
-    img_data = (img_data - mean) / std
-    
-    # 確保數據類型是 float32
-    img_data = img_data.astype('float32')
-    
-    # 調整維度 HWC -> CHW (3, 224, 224)
-    img_data = img_data.transpose(2, 0, 1)
+    # 計算 Softmax 得到概率
+    exp_result = np.exp(raw_result - np.max(raw_result))  # 數值穩定性
+    probabilities = exp_result / np.sum(exp_result)
     
-    # 增加 Batch 維度 -> (1, 3, 224, 224)
-    img_data = np.expand_dims(img_data, axis=0)
+    # 找出預測類別
+    predicted_idx = np.argmax(probabilities)
+    predicted_class = CLASSES[predicted_idx]
+    confidence = probabilities[predicted_idx]
     
-    return img_data
+    return predicted_class, confidence, probabilities
+
+def print_details(image_path, raw_result, probabilities):
+    """顯示單張圖片的詳細推論結果"""
+    predicted_idx = np.argmax(probabilities)
+    print(f"\n{'='*60}")
+    print(f"圖片: {image_path}")
+    print(f"{'='*60}")
+    print(f"原始輸出: {raw_result}")
+    print(f"概率分佈:")
+    for i, (cls, prob) in enumerate(zip(CLASSES, probabilities)):
+        marker = " ←" if i == predicted_idx else ""
+        print(f"  {cls}: {prob*100:.2f}%{marker}")
+    print(f"\n預測結果: {CLASSES[predicted_idx]}")
+    print(f"置信度: {probabilities[predicted_idx]*100:.2f}%")
+    print(f"{'='*60}\n")
 
 def run_inference(session, input_name, image_path, show_details=True):
     """
@@ -80,31 +81,69 @@ def run_inference(session, input_name, image_path, show_details=True):
     
     # 解析結果
     raw_result = output[0][0]  # 取得第一張圖的輸出
-    
-    # 計算 Softmax 得到概率
-    exp_result = np.exp(raw_result - np.max(raw_result))  # 數值穩定性
-    probabilities = exp_result / np.sum(exp_result)
-    
-    # 找出預測類別
-    predicted_idx = np.argmax(probabilities)
-    predicted_class = CLASSES[predicted_idx]
-    confidence = probabilities[predicted_idx]
+    predicted_class, confidence, probabilities = postprocess(raw_result)
     
     if show_details:
-        print(f"\n{'='*60}")
-        print(f"圖片: {image_path}")
-        print(f"{'='*60}")
-        print(f"原始輸出: {raw_result}")
-        print(f"概率分佈:")
-        for i, (cls, prob) in enumerate(zip(CLASSES, probabilities)):
-            marker = " ←" if i == predicted_idx else ""
-            print(f"  {cls}: {prob*100:.2f}%{marker}")
-        print(f"\n預測結果: {predicted_class}")
-        print(f"置信度: {confidence*100:.2f}%")
-        print(f"{'='*60}\n")
+        print_details(image_path, raw_result, probabilities)
     
     return predicted_class, confidence, raw_result
 
+def get_max_batch_size(session):
+    """
+    讀取模型輸入的 batch 維度
+
+    Returns:
+        固定 batch 的模型回傳該數值，動態 batch（如 'batch_size'）回傳 None
+    """
+    batch_dim = session.get_inputs()[0].shape[0]
+    return batch_dim if isinstance(batch_dim, int) and batch_dim > 0 else None
+
+def run_batch_inference(session, input_name, images, batch_buffer=None):
+    """
+    將多張已解碼的圖片組成一個 (N, 3, 224, 224) 張量，只呼叫一次 session.run
+
+    解碼失敗的圖片 (None) 不會進入 batch，對應結果為 None
+
+    Args:
+        session: ONNX Runtime Session
+        input_name: 輸入層名稱
+        images: uint8 HWC 圖片（見 preprocessing.load_image）或已預處理的
+                float32 CHW 張量（見 tensor_cache）列表，失敗者為 None
+        batch_buffer: 預先配置的 batch 陣列（至少 len(images) 格），
+                      None 時自動配置
+
+    Returns:
+        與 images 等長的列表，每項為 (predicted_class, confidence, raw_output)
+        或 None（解碼失敗）
+    """
+    if batch_buffer is None or len(batch_buffer) < len(images):
+        batch_buffer = new_batch(len(images))
+    
+    valid_indices = []
+    for idx, image in enumerate(images):
+        if image is None:
+            continue
+        # 直接寫入 batch 中的下一格，失敗的圖片不佔位置
+        slot = batch_buffer[len(valid_indices)]
+        if image.dtype == np.uint8:
+            normalize_into(image, slot)
+        else:
+            np.copyto(slot, image)
+        valid_indices.append(idx)
+    
+    results = [None] * len(images)
+    if not valid_indices:
+        return results
+    
+    # 一次推論整個 batch
+    batch = batch_buffer[:len(valid_indices)]
+    raw_results = session.run(None, {input_name: batch})[0]
+    
+    for idx, raw_result in zip(valid_indices, raw_results):
+        predicted_class, confidence, _ = postprocess(raw_result)
+        results[idx] = (predicted_class, confidence, raw_result)
+    return results
+
 def main():
     parser = argparse.ArgumentParser(
         description='使用訓練好的 ResNet50 模型進行螞蟻/蜜蜂分類推論',
@@ -117,11 +156,20 @@ def main():
   # 批量處理資料夾
   python inference_local.py -i data/val/ants/ --batch
   
+  # 每次推論 16 張圖片（需要動態 batch 模型，見 fix_onnx_export.py --dynamic-batch）
+  python inference_local.py -i data/val/ants/ --batch --batch-size 16 -m ants_bees_dynamic.onnx
+  
   # 使用特定模型
   python inference_local.py -i image.jpg -m ants_bees_opt_fixed.onnx
   
   # 簡潔輸出模式
   python inference_local.py -i image.jpg --quiet
+  
+  # 結果即時寫入 JSONL/CSV，中斷後以 --resume 接續
+  python inference_local.py -i data/val/ants/ --batch --quiet -o results.jsonl --resume
+  
+  # 調整 ONNX Runtime 執行緒數（優化後的計算圖預設快取在 .ort_cache/）
+  python inference_local.py -i data/val/ants/ --batch --intra-op-threads 4
         """
     )
     
@@ -145,6 +193,27 @@ def main():
         help='批量處理模式（當輸入是資料夾時）'
     )
     
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=8,
+        help='批量模式下每次 session.run 的圖片數量 (預設: 8，固定 batch 的模型會自動降為模型的 batch 大小)'
+    )
+    
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=default_num_workers(),
+        help='批量模式下平行解碼圖片的 worker 數量，0 表示與推論在同一執行緒 (預設: CPU 核心數)'
+    )
+    
+    parser.add_argument(
+        '--queue-depth',
+        type=int,
+        default=32,
+        help='批量模式下預先解碼、等待推論的圖片上限，用來限制記憶體用量 (預設: 32)'
+    )
+    
     parser.add_argument(
         '--quiet',
         action='store_true',
@@ -158,6 +227,36 @@ def main():
         help='批量處理時的文件擴展名 (預設: .jpg .jpeg .png .bmp)'
     )
     
+    parser.add_argument(
+        '--tensor-cache',
+        type=str,
+        default=None,
+        metavar='DIR',
+        help='批量模式下將預處理後的張量快取在 DIR，重複執行時不需重新解碼圖片 (預設: 不使用)'
+    )
+    
+    parser.add_argument(
+        '--tensor-cache-mb',
+        type=int,
+        default=DEFAULT_MAX_BYTES >> 20,
+        help=f'張量快取的大小上限 (MB)，超過時淘汰最久未使用的項目 (預設: {DEFAULT_MAX_BYTES >> 20})'
+    )
+    
+    parser.add_argument(
+        '-o', '--output',
+        type=str,
+        default=None,
+        help='批量模式下將每張圖片的結果即時寫入此檔 (.jsonl 或 .csv)'
+    )
+    
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='搭配 --output：跳過輸出檔中已成功完成的圖片，接續寫入（請使用相同的 -i 參數）'
+    )
+    
+    add_session_args(parser)
+    
     args = parser.parse_args()
     
     # 檢查模型文件
@@ -173,7 +272,7 @@ def main():
     # 載入模型
     print(f"📦 正在載入模型: {args.model}")
     try:
-        session = rt.InferenceSession(args.model)
+        session = create_session(args.model, **session_kwargs_from_args(args))
         input_name = session.get_inputs()[0].name
         print(f"✅ 模型載入成功")
         print(f"   輸入名稱: {input_name}")
@@ -217,43 +316,117 @@ def main():
             sys.exit(1)
         
         print(f"\n📁 找到 {len(image_files)} 張圖片")
+        
+        # 結果即時寫入輸出檔；resume 時跳過已完成的圖片
+        if args.resume and not args.output:
+            print(f"❌ 錯誤：--resume 需要搭配 --output")
+            sys.exit(1)
+        class_counts = {cls: 0 for cls in CLASSES}
+        error_count = 0
+        writer = None
+        if args.output:
+            writer = ResultWriter(args.output, len(CLASSES), resume=args.resume)
+            if writer.completed:
+                total_found = len(image_files)
+                image_files = [p for p in image_files if str(p) not in writer.completed]
+                for cls, count in writer.class_counts.items():
+                    class_counts[cls] = class_counts.get(cls, 0) + count
+                print(f"⏩ 接續執行：跳過 {total_found - len(image_files)} 張已完成的圖片")
+            print(f"📝 結果輸出: {args.output}")
+        
         print(f"🔍 開始批量推論...\n")
         
-        results = []
-        for i, img_path in enumerate(image_files, 1):
-            print(f"[{i}/{len(image_files)}] 處理: {img_path.name}")
-            try:
-                predicted_class, confidence, _ = run_inference(
-                    session, input_name, str(img_path),
-                    show_details=not args.quiet
-                )
-                results.append({
-                    'file': img_path.name,
-                    'class': predicted_class,
-                    'confidence': confidence
-                })
+        # 決定實際的 batch 大小
+        batch_size = max(1, args.batch_size)
+        max_batch = get_max_batch_size(session)
+        if max_batch is not None and batch_size > max_batch:
+            print(f"⚠️  模型輸入的 batch 維度固定為 {max_batch}，batch 大小由 {batch_size} 降為 {max_batch}")
+            print(f"   若要一次推論多張圖片，請使用 fix_onnx_export.py --dynamic-batch 匯出模型\n")
+            batch_size = max_batch
+        
+        queue_depth = max(args.queue_depth, batch_size)
+        loader = load_image
+        tensor_cache = None
+        if args.tensor_cache:
+            tensor_cache = TensorCache(args.tensor_cache, max_bytes=args.tensor_cache_mb << 20)
+            # 快取回傳的是 shard view，容量必須大於同時在處理中的圖片數量
+            if tensor_cache.capacity < queue_depth + batch_size:
+                min_mb = ((queue_depth + batch_size) * TENSOR_BYTES >> 20) + 1
+                print(f"❌ 錯誤：--tensor-cache-mb 太小，至少需要 {min_mb} MB")
+                sys.exit(1)
+            loader = tensor_cache.load
+            print(f"🗄️  張量快取: {args.tensor_cache} ({len(tensor_cache)}/{tensor_cache.capacity} 張)\n")
+        
+        # 整個批量處理共用同一個 batch 陣列；結果不保留在記憶體中，只累計統計
+        batch_buffer = new_batch(batch_size)
+        # 背景 worker 解碼圖片，推論迴圈依原始順序取出
+        with DecodePipeline(image_files, num_workers=args.workers,
+                            queue_depth=queue_depth, loader=loader) as pipeline:
+            decoded = iter(pipeline)
+            for start in range(0, len(image_files), batch_size):
+                batch_files = image_files[start:start + batch_size]
+                end = start + len(batch_files)
+                print(f"[{start + 1}-{end}/{len(image_files)}] 處理 {len(batch_files)} 張圖片")
                 
-                if args.quiet:
-                    print(f"  → {predicted_class} ({confidence*100:.1f}%)")
-            except Exception as e:
-                print(f"  ❌ 處理失敗: {e}")
-                results.append({
-                    'file': img_path.name,
-                    'class': 'ERROR',
-                    'confidence': 0.0
-                })
+                images = []
+                errors = []
+                for img_path, image, error in (next(decoded) for _ in batch_files):
+                    if error is not None:
+                        print(f"  ❌ 預處理失敗 {img_path.name}: {error}")
+                    images.append(image)
+                    errors.append(None if error is None else f"預處理失敗: {error}")
+                
+                start_time = time.perf_counter()
+                try:
+                    batch_results = run_batch_inference(
+                        session, input_name, images, batch_buffer=batch_buffer
+                    )
+                except Exception as e:
+                    print(f"  ❌ 推論失敗: {e}")
+                    batch_results = [None] * len(batch_files)
+                    errors = [f"推論失敗: {e}"] * len(batch_files)
+                num_valid = sum(1 for r in batch_results if r is not None)
+                infer_ms = (time.perf_counter() - start_time) * 1000 / max(1, num_valid)
+                
+                for img_path, result, error in zip(batch_files, batch_results, errors):
+                    if result is None:
+                        error_count += 1
+                        if writer is not None:
+                            writer.write(str(img_path), error=error or '未知錯誤')
+                        continue
+                    
+                    predicted_class, confidence, raw_result = result
+                    probabilities = postprocess(raw_result)[2]
+                    class_counts[predicted_class] += 1
+                    if writer is not None:
+                        writer.write(
+                            str(img_path), predicted_class, CLASSES.index(predicted_class), confidence,
+                            probabilities, raw_result, batch_size=num_valid, infer_ms=infer_ms
+                        )
+                    
+                    if args.quiet:
+                        print(f"  {img_path.name} → {predicted_class} ({confidence*100:.1f}%)")
+                    else:
+                        print_details(str(img_path), raw_result, probabilities)
+                
+                # 每個 batch 完成後立即寫入磁碟
+                if writer is not None:
+                    writer.flush()
         
-        # 統計結果
+        if writer is not None:
+            writer.close()
+        if tensor_cache is not None:
+            tensor_cache.close()
+            print(f"\n🗄️  張量快取命中: {tensor_cache.hits}，未命中: {tensor_cache.misses}")
+        
+        # 統計結果（含 resume 跳過的圖片）
+        total = sum(class_counts.values()) + error_count
         print(f"\n{'='*60}")
         print(f"📊 批量推論統計")
         print(f"{'='*60}")
-        ant_count = sum(1 for r in results if r['class'] == CLASSES[0])
-        bee_count = sum(1 for r in results if r['class'] == CLASSES[1])
-        error_count = sum(1 for r in results if r['class'] == 'ERROR')
-        
-        print(f"總計: {len(results)} 張圖片")
-        print(f"  {CLASSES[0]}: {ant_count} 張 ({ant_count/len(results)*100:.1f}%)")
-        print(f"  {CLASSES[1]}: {bee_count} 張 ({bee_count/len(results)*100:.1f}%)")
+        print(f"總計: {total} 張圖片")
+        for cls in CLASSES:
+            print(f"  {cls}: {class_counts[cls]} 張 ({class_counts[cls]/max(1, total)*100:.1f}%)")
         if error_count > 0:
             print(f"  錯誤: {error_count} 張")
         print(f"{'='*60}\n")
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+本地推論伺服器（asyncio + 動態 micro-batching）
+常駐載入模型，將同時到達的請求合併成一個 batch，只呼叫一次 session.run
+
+API:
+  POST /predict   請求內容為圖片檔的原始位元組 (JPEG/PNG/BMP)
+                  回傳 {"class", "confidence", "probabilities", "raw_output", "latency_ms"}
+  GET  /stats     佇列深度、請求/batch 計數與延遲統計
+  GET  /health    健康檢查
+
+只使用標準函式庫，不需要額外的 web 框架
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from preprocessing import load_image, normalize_into, new_batch
+from decode_pipeline import default_num_workers
+from inference_local import CLASSES, postprocess, get_max_batch_size
+from ort_session import add_session_args, create_session, session_kwargs_from_args
+
+# 請求內容大小上限，避免異常請求耗盡記憶體
+MAX_BODY_BYTES = 32 << 20
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+
+class ServerStats:
+    """伺服器計數器與延遲統計（最近 window 筆請求）"""
+
+    def __init__(self, window=1000):
+        self.started_at = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.images = 0
+        self.latencies_ms = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+
+    def percentile(self, q):
+        if not self.latencies_ms:
+            return 0.0
+        return float(np.percentile(np.fromiter(self.latencies_ms, dtype=np.float64), q))
+
+    def snapshot(self, queue_depth, max_batch_size, max_wait_ms):
+        return {
+            'uptime_s': round(time.time() - self.started_at, 3),
+            'queue_depth': queue_depth,
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'images': self.images,
+            'mean_batch_size': round(float(np.mean(self.batch_sizes)), 3) if self.batch_sizes else 0.0,
+            'latency_ms': {
+                'p50': round(self.percentile(50), 3),
+                'p90': round(self.percentile(90), 3),
+                'p99': round(self.percentile(99), 3),
+            },
+            'max_batch_size': max_batch_size,
+            'max_wait_ms': max_wait_ms,
+        }
+
+
+class MicroBatcher:
+    """
+    動態 micro-batching
+    收到第一個請求後最多再等待 max_wait_ms，或湊滿 max_batch_size 就送出一個 batch；
+    session.run 在專用執行緒中執行，event loop 持續接收新請求
+    """
+
+    def __init__(self, session, max_batch_size=16, max_wait_ms=5.0, stats=None):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        model_batch = get_max_batch_size(session)
+        if model_batch is not None and max_batch_size > model_batch:
+            print(f"⚠️  模型輸入的 batch 維度固定為 {model_batch}，max-batch-size 由 {max_batch_size} 降為 {model_batch}")
+            max_batch_size = model_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+        self.stats = stats or ServerStats()
+        self.queue = asyncio.Queue()
+        self._batch_buffer = new_batch(self.max_batch_size)
+        # 單一推論執行緒：batch 之間依序執行，且共用同一個 batch 陣列
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, image):
+        """送入一張 uint8 HWC 圖片，等待推論結果 (raw_output)"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def _collect(self):
+        """取得一個 batch：等待第一個請求，之後在 max_wait_ms 內盡量湊滿"""
+        items = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        while len(items) < self.max_batch_size:
+            try:
+                items.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    def _infer(self, images):
+        """在推論執行緒中：寫入 batch 陣列並執行 session.run"""
+        for i, image in enumerate(images):
+            normalize_into(image, self._batch_buffer[i])
+        batch = self._batch_buffer[:len(images)]
+        return self.session.run(None, {self.input_name: batch})[0]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self._collect()
+            images = [image for image, _ in items]
+            try:
+                outputs = await loop.run_in_executor(self._executor, self._infer, images)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats.batches += 1
+            self.stats.images += len(items)
+            self.stats.batch_sizes.append(len(items))
+            for (_, future), raw_output in zip(items, outputs):
+                if not future.done():
+                    future.set_result(raw_output)
+
+
+class InferenceServer:
+    """最小化的 HTTP/1.1 伺服器（支援 keep-alive）"""
+
+    def __init__(self, batcher, decode_workers):
+        self.batcher = batcher
+        self.stats = batcher.stats
+        self._decode_executor = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix='decode')
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload = await self._dispatch(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError as e:
+            self._write_response(writer, 400, {'error': str(e)}, keep_alive=False)
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """讀取一個 HTTP 請求，連線關閉時回傳 None"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise ValueError('無效的請求行')
+        method, path, _ = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_BYTES:
+            raise ValueError(f'請求內容超過 {MAX_BODY_BYTES} bytes')
+        body = await reader.readexactly(length) if length else b''
+        return method, path, headers, body
+
+    async def _dispatch(self, method, path, body):
+        path = path.split('?', 1)[0]
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path == '/stats':
+            return 200, self.stats.snapshot(
+                self.batcher.queue.qsize(), self.batcher.max_batch_size, self.batcher.max_wait_ms
+            )
+        if path != '/predict':
+            return 404, {'error': f'未知的路徑 {path}'}
+        if method != 'POST':
+            return 405, {'error': '/predict 只接受 POST'}
+        return await self._predict(body)
+
+    async def _predict(self, body):
+        start_time = time.perf_counter()
+        self.stats.requests += 1
+        if not body:
+            self.stats.errors += 1
+            return 400, {'error': '請求內容必須是圖片檔'}
+        loop = asyncio.get_running_loop()
+        try:
+            image = await loop.run_in_executor(self._decode_executor, load_image, io.BytesIO(body))
+        except Exception as e:
+            self.stats.errors += 1
+            return 400, {'error': f'無法解碼圖片: {e}'}
+        try:
+            raw_output = await self.batcher.submit(image)
+        except Exception as e:
+            self.stats.errors += 1
+            return 500, {'error': f'推論失敗: {e}'}
+
+        predicted_class, confidence, probabilities = postprocess(raw_output)
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        self.stats.latencies_ms.append(latency_ms)
+        return 200, {
+            'class': predicted_class,
+            'confidence': float(confidence),
+            'probabilities': {cls: float(p) for cls, p in zip(CLASSES, probabilities)},
+            'raw_output': [float(v) for v in raw_output],
+            'latency_ms': round(latency_ms, 3),
+        }
+
+    @staticmethod
+    def _write_response(writer, status, payload, keep_alive):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+
+    def close(self):
+        self._decode_executor.shutdown(wait=False)
+
+
+async def serve(args):
+    print(f"📦 正在載入模型: {args.model}")
+    session = create_session(args.model, **session_kwargs_from_args(args))
+    print(f"✅ 模型載入成功，輸入形狀: {session.get_inputs()[0].shape}")
+
+    batcher = MicroBatcher(session, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    batcher.start()
+    server = InferenceServer(batcher, decode_workers=args.decode_workers)
+    tcp_server = await asyncio.start_server(server.handle_connection, args.host, args.port)
+
+    print(f"🚀 推論伺服器已啟動: http://{args.host}:{args.port}")
+    print(f"   max-batch-size={batcher.max_batch_size}, max-wait-ms={batcher.max_wait_ms}")
+    print(f"   POST /predict (圖片原始位元組), GET /stats, GET /health")
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        await batcher.stop()
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='常駐的螞蟻/蜜蜂分類推論伺服器（動態 micro-batching）',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+使用範例:
+  # 啟動伺服器（需要動態 batch 模型才能合併請求，見 fix_onnx_export.py --dynamic-batch）
+  python inference_server.py -m ants_bees_dynamic.onnx --max-batch-size 16 --max-wait-ms 5
+
+  # 送出推論請求
+  curl --data-binary @data/val/ants/10308379_1b6c72e180.jpg http://127.0.0.1:8000/predict
+
+  # 查看佇列深度與延遲統計
+  curl http://127.0.0.1:8000/stats
+        """
+    )
+    parser.add_argument(
+        '-m', '--model',
+        type=str,
+        default='ants_bees_opt_fixed.onnx',
+        help='ONNX 模型文件路徑 (預設: ants_bees_opt_fixed.onnx)'
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='監聽位址 (預設: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='監聽埠號 (預設: 8000)')
+    parser.add_argument(
+        '--max-batch-size',
+        type=int,
+        default=16,
+        help='每個 micro-batch 最多合併的請求數 (預設: 16)'
+    )
+    parser.add_argument(
+        '--max-wait-ms',
+        type=float,
+        default=5.0,
+        help='收到第一個請求後最多等待多久以湊成 batch (毫秒，預設: 5)'
+    )
+    parser.add_argument(
+        '--decode-workers',
+        type=int,
+        default=default_num_workers(),
+        help='解碼圖片的執行緒數量 (預設: CPU 核心數)'
+    )
+    add_session_args(parser)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"❌ 錯誤：找不到模型文件 {args.model}")
+        sys.exit(1)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print("\n伺服器已停止")
+
+
+if __name__ == "__main__":
+    main()
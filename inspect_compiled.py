@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+靜態分析編譯輸出（command.txt / setup.txt / model_config.json）
+不需要 dongle：從指令流統計每一層的權重讀取 (GETW)、RDMA / WDMA 傳輸量與指令數，
+並整理 setup.txt 與 model_config.json 的 DRAM 配置，也可以比較兩次編譯的輸出
+
+command.txt 每行格式為 `[層] [佇列] [位址] 指令 [參數]`。CONF 設定的暫存器會一直沿用到
+下次被改寫，所以 GETW / RDMA / WDMA 的傳輸量要依執行當下的暫存器狀態計算：
+  GETW: NPU_GETW1.len 位元組（GETW [refetch] 另外統計）
+  RDMA: NPU_RDMA{bank}_SRC2.len × (NPU_RDMA{bank}_BLK.line + 1)
+  WDMA: NPU_WDMA0_DST2.len × (NPU_WDMA0_BLK.line + 1)
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from collections import Counter, OrderedDict
+
+DEFAULT_OUTPUT_DIR = 'ants_bees_opt_modelid_100'
+
+COMMAND_PATTERN = re.compile(
+    r'^\[(?P<layer>\d+)\]\s+(?:\[(?P<queue>\w+)\]\s+)?\[(?P<addr>0x[0-9a-fA-F]+)\]\s+'
+    r'(?P<op>\w+)\s*(?:\[(?P<arg>[^\]]*)\])?\s*$'
+)
+SORT_KEYS = {
+    'total': lambda s: s['getw_bytes'] + s['rdma_bytes'] + s['wdma_bytes'],
+    'getw': lambda s: s['getw_bytes'],
+    'rdma': lambda s: s['rdma_bytes'],
+    'wdma': lambda s: s['wdma_bytes'],
+    'conv': lambda s: s['ops'].get('CONV', 0),
+}
+
+
+def _parse_value(text):
+    text = text.strip()
+    try:
+        return int(text, 0)
+    except ValueError:
+        return text
+
+
+def parse_command_line(line):
+    """
+    解析 command.txt 的一行
+
+    Returns:
+        dict(layer, queue, addr, op, reg, fields, flag)；無法解析時回傳 None
+    """
+    match = COMMAND_PATTERN.match(line.rstrip('\n'))
+    if match is None:
+        return None
+    command = {
+        'layer': int(match.group('layer')),
+        'queue': match.group('queue'),
+        'addr': int(match.group('addr'), 16),
+        'op': match.group('op'),
+        'reg': None,
+        'fields': {},
+        'flag': None,
+    }
+    arg = match.group('arg')
+    if arg is None:
+        return command
+    if command['op'] == 'CONF':
+        reg, _, rest = arg.partition(',')
+        command['reg'] = reg.strip()
+        for item in rest.split(','):
+            key, sep, value = item.partition('=')
+            if sep:
+                command['fields'][key.strip()] = _parse_value(value)
+    elif ':' in arg:
+        # RDMA [bank: 2]、INTR [tgt: 81]
+        key, _, value = arg.partition(':')
+        command['fields'][key.strip()] = _parse_value(value)
+    else:
+        # GETW [refetch]、CONV [#12]、SYNC [bar]
+        command['flag'] = arg.strip()
+    return command
+
+
+def parse_command_file(path):
+    """
+    讀取 command.txt
+
+    Returns:
+        (commands, 無法解析的行號列表)
+    """
+    commands = []
+    unparsed = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            command = parse_command_line(line)
+            if command is None:
+                unparsed.append(line_number)
+            else:
+                commands.append(command)
+    return commands, unparsed
+
+
+def _new_layer_stats():
+    return {
+        'commands': 0,
+        'ops': Counter(),
+        'getw_bytes': 0,
+        'refetch_bytes': 0,
+        'rdma_bytes': 0,
+        'wdma_bytes': 0,
+        'fmap': None,
+    }
+
+
+def collect_layer_stats(commands):
+    """
+    依暫存器狀態模擬指令流，統計每層的傳輸量與指令數
+
+    Returns:
+        (OrderedDict[layer -> stats], 權重讀取記錄 [(sa, len)], DMA 記錄 [(kind, addr, bytes)])
+    """
+    registers = {}
+    layers = OrderedDict()
+    weight_fetches = []
+    transfers = []
+
+    def reg(name, key, default=0):
+        return registers.get(name, {}).get(key, default)
+
+    for command in commands:
+        stats = layers.get(command['layer'])
+        if stats is None:
+            stats = layers[command['layer']] = _new_layer_stats()
+        stats['commands'] += 1
+        op = command['op']
+        if op == 'CONF':
+            registers.setdefault(command['reg'], {}).update(command['fields'])
+            continue
+        if op != 'NOP':
+            stats['ops'][op] += 1
+
+        if op == 'GETW':
+            length = reg('NPU_GETW1', 'len')
+            if command['flag'] == 'refetch':
+                stats['refetch_bytes'] += length
+            else:
+                stats['getw_bytes'] += length
+                weight_fetches.append((reg('NPU_GETW0', 'sa'), length))
+        elif op == 'RDMA':
+            prefix = f"NPU_RDMA{command['fields'].get('bank', 0)}"
+            size = reg(f'{prefix}_SRC2', 'len') * (reg(f'{prefix}_BLK', 'line') + 1)
+            stats['rdma_bytes'] += size
+            transfers.append(('rdma', reg(f'{prefix}_SRC0', 'sa'), size))
+        elif op == 'WDMA':
+            size = reg('NPU_WDMA0_DST2', 'len') * (reg('NPU_WDMA0_BLK', 'line') + 1)
+            stats['wdma_bytes'] += size
+            transfers.append(('wdma', reg('NPU_WDMA0_DST0', 'da'), size))
+        elif op == 'CONV' and stats['fmap'] is None:
+            stats['fmap'] = (reg('NPU_FMAP0', 'row'), reg('NPU_FMAP0', 'col'), reg('NPU_FMAP1', 'ch'))
+    return layers, weight_fetches, transfers
+
+
+def parse_setup_file(path):
+    """
+    讀取 setup.txt：`section:` 之後是 `key = value`，`(layer_index = N)` 開始一筆新記錄
+
+    Returns:
+        {section: dict 或 dict 列表}
+    """
+    sections = OrderedDict()
+    current = None
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for raw in f:
+            line = raw.strip()
+            if not line:
+                continue
+            if line.endswith(':') and not raw[0].isspace():
+                current = line[:-1]
+                sections[current] = OrderedDict()
+                continue
+            if current is None:
+                continue
+            entry_match = re.match(r'^\((\w+)\s*=\s*(.+)\)$', line)
+            if entry_match:
+                if not isinstance(sections[current], list):
+                    sections[current] = []
+                sections[current].append(OrderedDict([(entry_match.group(1), _parse_value(entry_match.group(2)))]))
+                continue
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+            target = sections[current][-1] if isinstance(sections[current], list) else sections[current]
+            target[key.strip()] = _parse_value(value)
+    return sections
+
+
+def memory_map(header, config, transfers):
+    """
+    整理 DRAM 配置並檢查區段是否重疊
+
+    fmap 區段的實際使用量由 DMA 存取的最高位址推得
+
+    Returns:
+        (regions, warnings)
+    """
+    regions = []
+
+    def add(name, start, size, source):
+        if start is not None and size is not None:
+            regions.append({'name': name, 'start': start, 'size': size, 'end': start + size, 'source': source})
+
+    add('cmd', header.get('cmd_start'), header.get('cmd_size'), 'setup.txt')
+    add('weight', header.get('weight_start'), header.get('weight_size'), 'setup.txt')
+    add('input', header.get('input_start'), header.get('input_size'), 'setup.txt')
+
+    dram_start = header.get('dram_start')
+    dram_size = header.get('dram_size')
+    add('fmap', dram_start, dram_size, 'setup.txt')
+
+    output_addr = config.get('output_addr')
+    if output_addr is not None:
+        output_addr = _parse_value(str(output_addr))
+        written = [addr + size for kind, addr, size in transfers
+                   if kind == 'wdma' and addr >= output_addr and not (dram_start and addr >= dram_start)]
+        add('output', output_addr, max(written) - output_addr if written else 0, 'model_config.json + WDMA')
+
+    warnings = []
+    for name in ('cmd_addr', 'weight_addr', 'input_addr'):
+        region_name = name.split('_')[0]
+        if name in config:
+            expected = _parse_value(str(config[name]))
+            region = next((r for r in regions if r['name'] == region_name), None)
+            if region and region['start'] != expected:
+                warnings.append(f"{region_name} 起始位址 setup.txt 0x{region['start']:x} ≠ model_config.json 0x{expected:x}")
+
+    if dram_start is not None and dram_size is not None:
+        used_end = max((addr + size for _, addr, size in transfers
+                        if dram_start <= addr < dram_start + dram_size), default=dram_start)
+        fmap = next(r for r in regions if r['name'] == 'fmap')
+        fmap['used'] = used_end - dram_start
+        if used_end > dram_start + dram_size:
+            warnings.append(f"DMA 存取超出 fmap 區段: 0x{used_end:x} > 0x{dram_start + dram_size:x}")
+
+    ordered = sorted(regions, key=lambda r: r['start'])
+    for previous, region in zip(ordered, ordered[1:]):
+        if region['start'] < previous['end'] and region['size'] and previous['size']:
+            warnings.append(f"{previous['name']} 與 {region['name']} 區段重疊 "
+                            f"(0x{previous['start']:x}-0x{previous['end']:x} / 0x{region['start']:x}-0x{region['end']:x})")
+    return ordered, warnings
+
+
+def analyze_output(output_dir):
+    """
+    分析一個編譯輸出資料夾
+
+    Returns:
+        報告 dict
+    """
+    command_path = os.path.join(output_dir, 'command.txt')
+    setup_path = os.path.join(output_dir, 'setup.txt')
+    config_path = os.path.join(output_dir, 'model_config.json')
+
+    commands, unparsed = parse_command_file(command_path)
+    layers, weight_fetches, transfers = collect_layer_stats(commands)
+    setup = parse_setup_file(setup_path) if os.path.exists(setup_path) else {}
+    config = {}
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    header = setup.get('cnn_header_info', {})
+    regions, warnings = memory_map(header, config, transfers)
+
+    if unparsed:
+        warnings.append(f"command.txt 有 {len(unparsed)} 行無法解析（第一行: {unparsed[0]}）")
+    unique_weight_bytes = sum(length for _, length in set(weight_fetches))
+    if header.get('weight_size') is not None and unique_weight_bytes != header['weight_size']:
+        warnings.append(f"GETW 涵蓋的權重 {unique_weight_bytes:,} B ≠ setup.txt weight_size {header['weight_size']:,} B")
+
+    totals = {
+        'commands': len(commands),
+        'layers': len(layers),
+        'ops': dict(sum((s['ops'] for s in layers.values()), Counter())),
+        'getw_bytes': sum(s['getw_bytes'] for s in layers.values()),
+        'unique_weight_bytes': unique_weight_bytes,
+        'refetch_bytes': sum(s['refetch_bytes'] for s in layers.values()),
+        'rdma_bytes': sum(s['rdma_bytes'] for s in layers.values()),
+        'wdma_bytes': sum(s['wdma_bytes'] for s in layers.values()),
+    }
+    return {
+        'path': output_dir,
+        'model_id': config.get('model_id'),
+        'header': dict(header),
+        'input_info': setup.get('input_info', []),
+        'config': config,
+        'memory_map': regions,
+        'totals': totals,
+        'layers': {layer: dict(stats, ops=dict(stats['ops'])) for layer, stats in layers.items()},
+        'warnings': warnings,
+    }
+
+
+def diff_reports(base, other):
+    """
+    比較兩份報告，依層索引對齊
+
+    Returns:
+        {'totals': {key: (base, other)}, 'layers': [(layer, base_stats, other_stats)]}
+    """
+    totals = {}
+    for key in ('commands', 'layers', 'getw_bytes', 'unique_weight_bytes', 'refetch_bytes', 'rdma_bytes', 'wdma_bytes'):
+        totals[key] = (base['totals'][key], other['totals'][key])
+    layers = []
+    empty = dict(_new_layer_stats(), ops={})
+    for layer in sorted(set(base['layers']) | set(other['layers'])):
+        a = base['layers'].get(layer, empty)
+        b = other['layers'].get(layer, empty)
+        if SORT_KEYS['total'](a) != SORT_KEYS['total'](b) or a['ops'] != b['ops']:
+            layers.append((layer, a, b))
+    return {'totals': totals, 'layers': layers}
+
+
+def _kb(num_bytes):
+    if abs(num_bytes) < 1024:
+        return f"{num_bytes} B"
+    return f"{num_bytes / 1024:,.1f} KB"
+
+
+def print_report(report, top=15, sort='total'):
+    totals = report['totals']
+    header = report['header']
+    print(f"\n📦 {report['path']} (model_id {report['model_id']})")
+    if header:
+        print(f"  輸入 {header.get('input_row')}x{header.get('input_col')}x{header.get('input_channel')}，"
+              f"radix {header.get('input_radix')}，輸出 {header.get('output_num')} 個")
+    print(f"  指令 {totals['commands']:,} 行，{totals['layers']} 層: "
+          + ', '.join(f"{op} {count}" for op, count in sorted(totals['ops'].items(), key=lambda kv: -kv[1])))
+
+    print("\n  DRAM 配置:")
+    for region in report['memory_map']:
+        used = f"（DMA 實際使用 {_kb(region['used'])}）" if 'used' in region else ''
+        print(f"    {region['name']:<7} 0x{region['start']:08x} - 0x{region['end']:08x}  {_kb(region['size']):>14}{used}")
+
+    traffic = totals['getw_bytes'] + totals['rdma_bytes'] + totals['wdma_bytes']
+    print(f"\n  每次推論的 DRAM 傳輸: {_kb(traffic)}")
+    print(f"    GETW  {_kb(totals['getw_bytes']):>14}（不重複權重 {_kb(totals['unique_weight_bytes'])}，"
+          f"refetch {_kb(totals['refetch_bytes'])}）")
+    print(f"    RDMA  {_kb(totals['rdma_bytes']):>14}")
+    print(f"    WDMA  {_kb(totals['wdma_bytes']):>14}")
+
+    ranked = sorted(report['layers'].items(), key=lambda kv: -SORT_KEYS[sort](kv[1]))[:top]
+    if ranked:
+        print(f"\n  傳輸量最大的 {len(ranked)} 層 (依 {sort} 排序):")
+        print(f"    {'層':>5} {'GETW':>12} {'RDMA':>12} {'WDMA':>12} {'佔比':>7} {'CONV':>6}  FMAP (row, col, ch)")
+        for layer, stats in ranked:
+            share = SORT_KEYS['total'](stats) / traffic * 100 if traffic else 0.0
+            print(f"    {layer:>5} {_kb(stats['getw_bytes']):>12} {_kb(stats['rdma_bytes']):>12} "
+                  f"{_kb(stats['wdma_bytes']):>12} {share:>6.1f}% {stats['ops'].get('CONV', 0):>6}  {stats['fmap'] or ''}")
+
+    for warning in report['warnings']:
+        print(f"  ⚠️  {warning}")
+
+
+def print_diff(base, other, diff, top=15):
+    print(f"\n{'='*60}")
+    print(f"比較: {base['path']} → {other['path']}")
+    print("=" * 60)
+    for key, (a, b) in diff['totals'].items():
+        if key.endswith('_bytes'):
+            change = f"{(b - a) / a * 100:+.1f}%" if a else ''
+            print(f"  {key:<20} {_kb(a):>14} → {_kb(b):>14}  {change}")
+        else:
+            print(f"  {key:<20} {a:>14,} → {b:>14,}")
+
+    changed = sorted(diff['layers'], key=lambda item: -abs(SORT_KEYS['total'](item[2]) - SORT_KEYS['total'](item[1])))
+    if not changed:
+        print("\n  ✓ 各層傳輸量與指令數完全相同")
+        return
+    print(f"\n  {len(changed)} 層不同，差異最大的 {min(top, len(changed))} 層:")
+    for layer, a, b in changed[:top]:
+        delta = SORT_KEYS['total'](b) - SORT_KEYS['total'](a)
+        print(f"    層 {layer:>4}: {_kb(SORT_KEYS['total'](a)):>12} → {_kb(SORT_KEYS['total'](b)):>12} "
+              f"({'+' if delta >= 0 else '-'}{_kb(abs(delta))})，CONV {a['ops'].get('CONV', 0)} → {b['ops'].get('CONV', 0)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='靜態分析編譯輸出的指令流與 DRAM 配置',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=f"""
+使用範例:
+  python inspect_compiled.py                                  # 分析 {DEFAULT_OUTPUT_DIR}/
+  python inspect_compiled.py out_a --sort getw --top 20
+  python inspect_compiled.py out_a out_b                      # 比較兩次編譯
+  python inspect_compiled.py out_a --json report.json
+        """
+    )
+    parser.add_argument('output_dir', nargs='?', default=DEFAULT_OUTPUT_DIR,
+                        help=f'編譯輸出資料夾 (預設: {DEFAULT_OUTPUT_DIR})')
+    parser.add_argument('other_dir', nargs='?', default=None, help='要比較的另一個編譯輸出資料夾')
+    parser.add_argument('--top', type=int, default=15, help='列出的層數 (預設: 15)')
+    parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='total', help='排序依據 (預設: total)')
+    parser.add_argument('--json', type=str, default=None, help='將結果寫入 JSON 檔')
+    args = parser.parse_args()
+
+    for path in filter(None, (args.output_dir, args.other_dir)):
+        if not os.path.exists(os.path.join(path, 'command.txt')):
+            print(f"❌ 錯誤：找不到 {os.path.join(path, 'command.txt')}")
+            sys.exit(1)
+
+    report = analyze_output(args.output_dir)
+    print_report(report, top=args.top, sort=args.sort)
+
+    result = report
+    if args.other_dir:
+        other = analyze_output(args.other_dir)
+        print_report(other, top=args.top, sort=args.sort)
+        diff = diff_reports(report, other)
+        print_diff(report, other, diff, top=args.top)
+        result = {'base': report, 'other': other, 'diff': diff}
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"\n✓ 結果已保存到: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+快速檢查 ONNX 模型（不載入權重）
+只讀取計算圖 (load_external_data=False)，列出 IR / Opset 版本、運算子統計、輸入輸出形狀、
+參數數量，並標記 Kneron 工具鏈不支援的運算子與版本
+
+參數數量由 initializer 的 dims 計算，不需要讀取 .data 檔；
+可以一次檢查整個資料夾，各檔案平行讀取
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import onnx
+from onnx import helper
+
+# Kneron 工具鏈的限制（見 DEVELOPMENT_EXPERIENCE.md 的操作兼容性檢查）
+UNSUPPORTED_OPS = {'ReduceMean'}
+TOOLCHAIN_MAX_IR = 9
+TOOLCHAIN_MAX_OPSET = 11
+
+
+def _shape(value_info):
+    tensor_type = value_info.type.tensor_type
+    if not tensor_type.HasField('shape'):
+        return None
+    return [d.dim_value if d.HasField('dim_value') else (d.dim_param or '?') for d in tensor_type.shape.dim]
+
+
+def _elem_type(value_info):
+    return helper.tensor_dtype_to_np_dtype(value_info.type.tensor_type.elem_type).name
+
+
+def inspect_model(model_path, unsupported_ops=UNSUPPORTED_OPS,
+                  max_ir=TOOLCHAIN_MAX_IR, max_opset=TOOLCHAIN_MAX_OPSET):
+    """
+    檢查單一模型
+
+    Returns:
+        結果 dict；讀取失敗時含 'error'
+    """
+    start_time = time.perf_counter()
+    try:
+        model = onnx.load(model_path, load_external_data=False)
+    except Exception as e:
+        return {'path': model_path, 'error': str(e)}
+
+    graph = model.graph
+    initializer_names = {init.name for init in graph.initializer}
+    params = 0
+    param_bytes = 0
+    external_bytes = 0
+    for init in graph.initializer:
+        count = 1
+        for dim in init.dims:
+            count *= dim
+        params += count
+        nbytes = count * helper.tensor_dtype_to_np_dtype(init.data_type).itemsize
+        param_bytes += nbytes
+        if init.data_location == onnx.TensorProto.EXTERNAL:
+            external_bytes += nbytes
+
+    ops = Counter(node.op_type for node in graph.node)
+    opsets = {op.domain or 'ai.onnx': op.version for op in model.opset_import}
+
+    warnings = []
+    for op_type in sorted(set(ops) & set(unsupported_ops)):
+        warnings.append(f"不支援的運算子 {op_type} × {ops[op_type]}")
+    if max_ir and model.ir_version > max_ir:
+        warnings.append(f"IR 版本 {model.ir_version} > {max_ir}")
+    if max_opset and opsets.get('ai.onnx', 0) > max_opset:
+        warnings.append(f"Opset 版本 {opsets['ai.onnx']} > {max_opset}")
+    custom_domains = sorted(d for d in opsets if d not in ('ai.onnx', 'ai.onnx.ml'))
+    if custom_domains:
+        warnings.append(f"自訂 domain: {', '.join(custom_domains)}")
+
+    return {
+        'path': model_path,
+        'file_mb': os.path.getsize(model_path) / (1024 * 1024),
+        'ir_version': model.ir_version,
+        'opsets': opsets,
+        'producer': f"{model.producer_name} {model.producer_version}".strip(),
+        'inputs': [{'name': vi.name, 'shape': _shape(vi), 'dtype': _elem_type(vi)}
+                   for vi in graph.input if vi.name not in initializer_names],
+        'outputs': [{'name': vi.name, 'shape': _shape(vi), 'dtype': _elem_type(vi)} for vi in graph.output],
+        'num_nodes': len(graph.node),
+        'ops': dict(ops.most_common()),
+        'params': params,
+        'param_mb': param_bytes / (1024 * 1024),
+        'external_mb': external_bytes / (1024 * 1024),
+        'warnings': warnings,
+        'inspect_ms': (time.perf_counter() - start_time) * 1000,
+    }
+
+
+def collect_models(paths):
+    """展開資料夾，回傳所有 .onnx 檔案"""
+    models = []
+    for path in paths:
+        if os.path.isdir(path):
+            models.extend(sorted(str(p) for p in Path(path).rglob('*.onnx')))
+        else:
+            models.append(path)
+    return models
+
+
+def print_report(info, show_ops=True):
+    print(f"\n📦 {info['path']}")
+    if 'error' in info:
+        print(f"  ❌ 讀取失敗: {info['error']}")
+        return
+    opsets = ', '.join(f"{domain} {version}" for domain, version in info['opsets'].items())
+    print(f"  IR {info['ir_version']}，Opset {opsets}，{info['producer'] or '未知 producer'}")
+    print(f"  檔案 {info['file_mb']:.2f} MB，參數 {info['params']:,} ({info['param_mb']:.1f} MB，"
+          f"外部數據 {info['external_mb']:.1f} MB)，節點 {info['num_nodes']}")
+    for kind in ('inputs', 'outputs'):
+        for vi in info[kind]:
+            print(f"  {'輸入' if kind == 'inputs' else '輸出'}: {vi['name']} {vi['shape']} {vi['dtype']}")
+    if show_ops:
+        print("  運算子: " + ', '.join(f"{op} {count}" for op, count in info['ops'].items()))
+    for warning in info['warnings']:
+        print(f"  ⚠️  {warning}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='快速檢查 ONNX 模型（不載入權重）',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+使用範例:
+  python inspect_onnx.py ants_bees.onnx
+  python inspect_onnx.py .                      # 檢查資料夾下所有 .onnx
+  python inspect_onnx.py . --json inventory.json
+        """
+    )
+    parser.add_argument('paths', nargs='*', default=['.'], help='模型檔或資料夾 (預設: 目前資料夾)')
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1),
+                        help='平行讀取的執行緒數')
+    parser.add_argument('--unsupported', nargs='*', default=sorted(UNSUPPORTED_OPS),
+                        help=f'視為不支援的運算子 (預設: {" ".join(sorted(UNSUPPORTED_OPS))})')
+    parser.add_argument('--max-ir', type=int, default=TOOLCHAIN_MAX_IR,
+                        help=f'工具鏈支援的最高 IR 版本，0 表示不檢查 (預設: {TOOLCHAIN_MAX_IR})')
+    parser.add_argument('--max-opset', type=int, default=TOOLCHAIN_MAX_OPSET,
+                        help=f'工具鏈支援的最高 Opset，0 表示不檢查 (預設: {TOOLCHAIN_MAX_OPSET})')
+    parser.add_argument('--no-ops', action='store_true', help='不列出運算子統計')
+    parser.add_argument('--json', type=str, default=None, help='將結果寫入 JSON 檔')
+    args = parser.parse_args()
+
+    model_paths = collect_models(args.paths)
+    if not model_paths:
+        print("❌ 錯誤：找不到任何 .onnx 檔案")
+        sys.exit(1)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        results = list(executor.map(
+            lambda path: inspect_model(path, set(args.unsupported), args.max_ir, args.max_opset),
+            model_paths))
+    elapsed = time.perf_counter() - start_time
+
+    for info in results:
+        print_report(info, show_ops=not args.no_ops)
+
+    flagged = sum(1 for info in results if info.get('warnings') or 'error' in info)
+    print(f"\n✓ 檢查 {len(results)} 個模型，{flagged} 個有警告，耗時 {elapsed * 1000:.0f} ms")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"✓ 結果已保存到: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+Kneron 裝置介面與多裝置排程
+每個裝置都提供非同步的 send / receive（與 Kneron PLUS 的 generic_image_inference_send /
+receive 相同的管線化模式）：send 把圖片傳到裝置後就返回，receive 依送出的順序取回結果，
+所以同一個裝置上可以同時有多張圖片在傳輸、運算與回傳
+
+    LocalDevice - 本地替身：以 ONNX Runtime 執行參考模型（ants_bees_opt_fixed.onnx 等標準 ONNX），
+                  並模擬 USB 傳輸與 NPU 運算時間。編譯輸出的 debug.onnx 含 NpuFusion 等
+                  Kneron 專用節點且沒有 opset，ONNX Runtime 無法執行
+    KpDevice    - 真正的 dongle（需要 Kneron PLUS 的 kp 套件與 .nef）
+
+DeviceScheduler 把請求分派給目前未完成數最少的裝置，
+沒有硬體時也能先量測多 dongle 的吞吐量與延遲
+"""
+import argparse
+import asyncio
+import glob
+import itertools
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from preprocessing import CROP_SIZE, load_image, new_batch, normalize_into
+from ort_session import create_session
+
+DEFAULT_MODEL = 'ants_bees_opt_fixed.onnx'
+# model_config.json 的 input_fmt 為 rgba8：每個像素 4 bytes
+INPUT_BYTES_PER_PIXEL = 4
+# KL520 dongle 透過 USB 2.0 連線，實際可用頻寬約 30-40 MB/s
+DEFAULT_LINK_MBPS = 35.0
+DEFAULT_LINK_OVERHEAD_MS = 0.5
+# 每個裝置可同時排隊的圖片數（firmware 的輸入佇列）
+DEFAULT_QUEUE_DEPTH = 2
+SCHEDULING_POLICIES = ('least-loaded', 'round-robin')
+
+
+class DeviceOpenError(RuntimeError):
+    """裝置無法開啟（模型無法載入、dongle 連線失敗）"""
+
+
+def check_reference_model(model_path):
+    """
+    檢查模型能否作為本地替身的參考模型
+
+    Returns:
+        無法使用的原因，可以使用時為 None
+    """
+    import onnx
+    import onnx.defs
+
+    try:
+        model = onnx.load(model_path, load_external_data=False)
+    except Exception as e:
+        return f"無法解析 ONNX 檔案: {e}"
+    if not model.opset_import:
+        return "模型沒有 opset_import（編譯輸出的 debug.onnx？），ONNX Runtime 無法載入"
+    unknown = sorted({node.op_type for node in model.graph.node if not onnx.defs.has(node.op_type, node.domain)})
+    if unknown:
+        return f"模型含有非標準 ONNX 運算子: {', '.join(unknown[:5])}"
+    return None
+
+
+class DeviceStats:
+    """單一裝置的計數器"""
+
+    def __init__(self):
+        self.images = 0
+        self.busy_s = 0.0
+        self.transfer_s = 0.0
+
+    def snapshot(self, elapsed_s):
+        return {
+            'images': self.images,
+            'utilization': round(self.busy_s / elapsed_s, 3) if elapsed_s > 0 else 0.0,
+            'busy_s': round(self.busy_s, 3),
+            'transfer_s': round(self.transfer_s, 3),
+        }
+
+
+class LocalDevice:
+    """
+    本地替身裝置
+
+    管線分三段，各自只能同時處理一張圖片：
+      上傳（USB）→ 運算（NPU）→ 回傳（USB）
+    上傳與回傳共用同一條連線；運算時間取 ORT 實際執行時間與 compute_ms 的較大者
+
+    Args:
+        device_id: 裝置編號
+        model_path: 參考 ONNX 模型（batch 維度需為 1 或動態）
+        compute_ms: 模擬的 NPU 運算時間，None 表示使用 ORT 的實際執行時間
+        link_mbps: 模擬的 USB 頻寬 (MB/s)
+        link_overhead_ms: 每次傳輸的固定延遲
+        queue_depth: 裝置上同時排隊（已送出尚未取回）的圖片數上限
+    """
+
+    def __init__(self, device_id, model_path, compute_ms=None, link_mbps=DEFAULT_LINK_MBPS,
+                 link_overhead_ms=DEFAULT_LINK_OVERHEAD_MS, queue_depth=DEFAULT_QUEUE_DEPTH, session_kwargs=None):
+        self.device_id = device_id
+        self.name = f'local:{device_id}'
+        self.model_path = model_path
+        self.compute_s = compute_ms / 1000.0 if compute_ms is not None else None
+        self.link_bytes_per_s = link_mbps * 1024 * 1024
+        self.link_overhead_s = link_overhead_ms / 1000.0
+        self.queue_depth = max(1, queue_depth)
+        self.session_kwargs = session_kwargs or {}
+        self.stats = DeviceStats()
+        self.session = None
+        self._buffer = new_batch(1)
+        # 單一運算執行緒：同一個裝置的圖片依序執行，且共用同一個輸入陣列
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'device{device_id}')
+        self._tasks = []
+
+    def _transfer_time(self, num_bytes):
+        return self.link_overhead_s + num_bytes / self.link_bytes_per_s
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self.session = await loop.run_in_executor(
+                self._executor, lambda: create_session(self.model_path, **self.session_kwargs))
+        except Exception as e:
+            raise DeviceOpenError(f"{self.name}: ONNX Runtime 無法載入 {self.model_path}: {e}") from e
+        self.input_name = self.session.get_inputs()[0].name
+        self._slots = asyncio.Semaphore(self.queue_depth)
+        self._link = asyncio.Lock()
+        self._send_lock = asyncio.Lock()
+        self._compute_queue = asyncio.Queue()
+        self._download_queue = asyncio.Queue()
+        self._results = asyncio.Queue()
+        self._tasks = [loop.create_task(self._compute_loop()), loop.create_task(self._download_loop())]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def send(self, image):
+        """
+        上傳一張 uint8 HWC 圖片；裝置佇列已滿時等待
+
+        上傳完成即返回，結果由 receive() 依送出順序取得
+        """
+        async with self._send_lock:
+            await self._slots.acquire()
+            upload_s = self._transfer_time(image.shape[0] * image.shape[1] * INPUT_BYTES_PER_PIXEL)
+            async with self._link:
+                await asyncio.sleep(upload_s)
+            self.stats.transfer_s += upload_s
+            await self._compute_queue.put(image)
+
+    async def receive(self):
+        """取回下一個結果：(raw_output, 錯誤或 None)"""
+        return await self._results.get()
+
+    def _run(self, image):
+        start_time = time.perf_counter()
+        normalize_into(image, self._buffer[0])
+        output = self.session.run(None, {self.input_name: self._buffer})[0][0]
+        return output, time.perf_counter() - start_time
+
+    async def _compute_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            image = await self._compute_queue.get()
+            start_time = time.perf_counter()
+            try:
+                output, elapsed = await loop.run_in_executor(self._executor, self._run, image)
+                if self.compute_s is not None and self.compute_s > elapsed:
+                    await asyncio.sleep(self.compute_s - elapsed)
+                error = None
+            except Exception as e:
+                output, error = None, e
+            self.stats.busy_s += time.perf_counter() - start_time
+            await self._download_queue.put((output, error))
+
+    async def _download_loop(self):
+        while True:
+            output, error = await self._download_queue.get()
+            if output is not None:
+                download_s = self._transfer_time(output.nbytes)
+                async with self._link:
+                    await asyncio.sleep(download_s)
+                self.stats.transfer_s += download_s
+            self.stats.images += 1
+            self._slots.release()
+            await self._results.put((output, error))
+
+
+class KpDevice:
+    """
+    Kneron PLUS 連接的 dongle（需要安裝 kp 套件並接上裝置）
+
+    kp 的 send / receive 是阻塞呼叫，各用一個執行緒，與 LocalDevice 提供相同的非同步介面
+    """
+
+    def __init__(self, device_id, nef_path, port_id, queue_depth=DEFAULT_QUEUE_DEPTH):
+        import kp  # 只在安裝 Kneron PLUS 的環境中存在
+        self.kp = kp
+        self.device_id = device_id
+        self.name = f'kp:{port_id}'
+        self.nef_path = nef_path
+        self.port_id = port_id
+        self.queue_depth = max(1, queue_depth)
+        self.stats = DeviceStats()
+        self._send_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'kp-send{device_id}')
+        self._receive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'kp-recv{device_id}')
+
+    async def open(self):
+        kp = self.kp
+
+        def connect():
+            group = kp.core.connect_devices(usb_port_ids=[self.port_id])
+            descriptor = kp.core.load_model_from_file(device_group=group, file_path=self.nef_path)
+            return group, descriptor.models[0].id
+
+        try:
+            self.group, self.model_id = await asyncio.get_running_loop().run_in_executor(self._send_executor, connect)
+        except Exception as e:
+            raise DeviceOpenError(f"{self.name}: 無法連線或載入 {self.nef_path}: {e}") from e
+        self._slots = asyncio.Semaphore(self.queue_depth)
+        self._send_lock = asyncio.Lock()
+        self._sent_at = deque()
+
+    async def close(self):
+        self.kp.core.disconnect_devices(device_group=self.group)
+        self._send_executor.shutdown(wait=True)
+        self._receive_executor.shutdown(wait=True)
+
+    def _send(self, image):
+        kp = self.kp
+        rgba = np.concatenate([image, np.full(image.shape[:2] + (1,), 255, dtype=np.uint8)], axis=2)
+        descriptor = kp.GenericImageInferenceDescriptor(
+            model_id=self.model_id,
+            inference_number=0,
+            input_node_image_list=[kp.GenericInputNodeImage(
+                image=rgba, image_format=kp.ImageFormat.KP_IMAGE_FORMAT_RGBA8888)],
+        )
+        kp.inference.generic_image_inference_send(device_group=self.group,
+                                                  generic_inference_input_descriptor=descriptor)
+
+    def _receive(self):
+        kp = self.kp
+        raw_result = kp.inference.generic_image_inference_receive(device_group=self.group)
+        node = kp.inference.generic_inference_retrieve_float_node(
+            node_idx=0, generic_raw_result=raw_result, channels_ordering=kp.ChannelOrdering.KP_CHANNEL_ORDERING_CHW)
+        return np.asarray(node.ndarray, dtype=np.float32).reshape(-1)
+
+    async def send(self, image):
+        async with self._send_lock:
+            await self._slots.acquire()
+            await asyncio.get_running_loop().run_in_executor(self._send_executor, self._send, image)
+            self._sent_at.append(time.perf_counter())
+
+    async def receive(self):
+        try:
+            output = await asyncio.get_running_loop().run_in_executor(self._receive_executor, self._receive)
+            error = None
+        except Exception as e:
+            output, error = None, e
+        # 裝置端無法區分傳輸與運算，以送出到取回的時間作為忙碌時間的上限估計
+        if self._sent_at:
+            self.stats.busy_s += time.perf_counter() - self._sent_at.popleft()
+        self.stats.images += 1
+        self._slots.release()
+        return output, error
+
+
+class DeviceScheduler:
+    """
+    多裝置排程
+
+    submit() 依 policy 選擇裝置：least-loaded 選目前未完成（已送出尚未取回）最少的裝置，
+    round-robin 依序輪流。每個裝置有一個接收 task，依送出順序把結果交給對應的請求
+    """
+
+    def __init__(self, devices, policy='least-loaded'):
+        if policy not in SCHEDULING_POLICIES:
+            raise ValueError(f"未知的排程策略: {policy}")
+        self.devices = list(devices)
+        self.policy = policy
+        self.in_flight = [0] * len(self.devices)
+        self._waiting = [deque() for _ in self.devices]
+        self._round_robin = itertools.cycle(range(len(self.devices)))
+        self._tasks = []
+
+    async def start(self, warmup_image=None):
+        """開啟所有裝置；指定 warmup_image 時每個裝置先跑一張，排除冷啟動"""
+        await asyncio.gather(*(device.open() for device in self.devices))
+        if warmup_image is not None:
+            async def warmup(device):
+                await device.send(warmup_image)
+                await device.receive()
+                device.stats = DeviceStats()
+            await asyncio.gather(*(warmup(device) for device in self.devices))
+        # 送出完成才去接收，避免 receive 在沒有工作的裝置上阻塞
+        self._sent = [asyncio.Semaphore(0) for _ in self.devices]
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._receive_loop(i)) for i in range(len(self.devices))]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.gather(*(device.close() for device in self.devices))
+
+    def _pick(self):
+        if self.policy == 'round-robin':
+            return next(self._round_robin)
+        # 未完成數相同時選處理過最少圖片的裝置，避免總是落在第一個
+        return min(range(len(self.devices)), key=lambda i: (self.in_flight[i], self.devices[i].stats.images))
+
+    async def submit(self, image):
+        """送入一張 uint8 HWC 圖片，等待推論結果 (raw_output)"""
+        index = self._pick()
+        self.in_flight[index] += 1
+        future = asyncio.get_running_loop().create_future()
+        # 先登記再送出：send 的順序就是 receive 的順序
+        self._waiting[index].append(future)
+        try:
+            await self.devices[index].send(image)
+        except Exception:
+            self._waiting[index].remove(future)
+            self.in_flight[index] -= 1
+            raise
+        self._sent[index].release()
+        return await future
+
+    async def _receive_loop(self, index):
+        device = self.devices[index]
+        while True:
+            await self._sent[index].acquire()
+            output, error = await device.receive()
+            self.in_flight[index] -= 1
+            future = self._waiting[index].popleft()
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(output)
+
+
+async def run_load(scheduler, images, num_requests, concurrency):
+    """
+    以固定的並行請求數送出 num_requests 張圖片
+
+    Returns:
+        (每個請求的延遲秒數列表, 總耗時秒數, 失敗數)
+    """
+    latencies = []
+    errors = 0
+    counter = itertools.count()
+
+    async def client():
+        nonlocal errors
+        while True:
+            index = next(counter)
+            if index >= num_requests:
+                return
+            start_time = time.perf_counter()
+            try:
+                await scheduler.submit(images[index % len(images)])
+                latencies.append(time.perf_counter() - start_time)
+            except Exception as e:
+                errors += 1
+                print(f"  ⚠️  請求 {index} 失敗: {e}")
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(max(1, concurrency))))
+    return latencies, time.perf_counter() - start_time, errors
+
+
+def load_images(image_dir, limit):
+    """讀取資料夾中的圖片；沒有指定時產生隨機圖片"""
+    if image_dir:
+        paths = sorted(glob.glob(os.path.join(image_dir, '**', '*.jp*g'), recursive=True))[:limit]
+        if paths:
+            return [load_image(path) for path in paths]
+        print(f"⚠️  {image_dir} 中沒有圖片，改用隨機圖片")
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, (CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8) for _ in range(min(limit, 16))]
+
+
+def print_summary(scheduler, latencies, elapsed, errors):
+    print(f"\n{'='*60}")
+    print(f"完成 {len(latencies)} 個請求（失敗 {errors}），耗時 {elapsed:.2f} 秒，"
+          f"吞吐量 {len(latencies) / elapsed:.1f} 張/秒")
+    if latencies:
+        p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+        print(f"延遲 p50 {p50:.1f} ms，p90 {p90:.1f} ms，p99 {p99:.1f} ms")
+    print(f"\n{'裝置':<12} {'圖片':>7} {'使用率':>8} {'運算 (s)':>9} {'傳輸 (s)':>9}")
+    for device in scheduler.devices:
+        stats = device.stats.snapshot(elapsed)
+        print(f"{device.name:<12} {stats['images']:>7} {stats['utilization'] * 100:>7.1f}% "
+              f"{stats['busy_s']:>9.2f} {stats['transfer_s']:>9.2f}")
+    print("=" * 60)
+
+
+async def simulate(args):
+    compute_ms = args.compute_ms or [None]
+    if args.nef:
+        devices = [KpDevice(i, args.nef, port_id, queue_depth=args.queue_depth)
+                   for i, port_id in enumerate(args.port_ids)]
+    else:
+        devices = [LocalDevice(i, args.model, compute_ms=compute_ms[i % len(compute_ms)],
+                               link_mbps=args.link_mbps, link_overhead_ms=args.link_overhead_ms,
+                               queue_depth=args.queue_depth, session_kwargs={'intra_op_threads': args.threads})
+                   for i in range(args.devices)]
+    scheduler = DeviceScheduler(devices, policy=args.policy)
+    images = load_images(args.images, args.requests)
+
+    print(f"裝置: {len(devices)} 個 ({devices[0].name.split(':')[0]})，排程: {args.policy}，"
+          f"並行請求: {args.concurrency}，每裝置佇列: {args.queue_depth}")
+    await scheduler.start(warmup_image=images[0])
+    try:
+        latencies, elapsed, errors = await run_load(scheduler, images, args.requests, args.concurrency)
+    finally:
+        await scheduler.stop()
+    print_summary(scheduler, latencies, elapsed, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='多 Kneron 裝置的排程與吞吐量模擬（本地替身或真正的 dongle）',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+使用範例:
+  # 4 個本地替身裝置，NPU 運算各 40 ms
+  python kneron_device.py -m ants_bees_opt_fixed.onnx --devices 4 --compute-ms 40
+
+  # 速度不同的裝置，比較兩種排程
+  python kneron_device.py --devices 3 --compute-ms 30 30 90 --policy round-robin
+  python kneron_device.py --devices 3 --compute-ms 30 30 90 --policy least-loaded
+
+  # 真正的 dongle（需要 Kneron PLUS）
+  python kneron_device.py --nef ants_bees_opt_modelid_100/models_520.nef --port-ids 1 2
+        """
+    )
+    parser.add_argument('-m', '--model', type=str, default=DEFAULT_MODEL,
+                        help=f'本地替身使用的參考 ONNX 模型 (預設: {DEFAULT_MODEL})')
+    parser.add_argument('--devices', type=int, default=2, help='本地替身裝置數 (預設: 2)')
+    parser.add_argument('--compute-ms', type=float, nargs='*', default=None,
+                        help='模擬的 NPU 運算時間（毫秒），可給每個裝置不同的值；未指定時使用 ORT 實際時間')
+    parser.add_argument('--link-mbps', type=float, default=DEFAULT_LINK_MBPS,
+                        help=f'模擬的 USB 頻寬 MB/s (預設: {DEFAULT_LINK_MBPS})')
+    parser.add_argument('--link-overhead-ms', type=float, default=DEFAULT_LINK_OVERHEAD_MS,
+                        help=f'每次傳輸的固定延遲 (預設: {DEFAULT_LINK_OVERHEAD_MS} ms)')
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help=f'每個裝置同時排隊的圖片數 (預設: {DEFAULT_QUEUE_DEPTH})')
+    parser.add_argument('--threads', type=int, default=1, help='每個本地替身的 ORT 執行緒數 (預設: 1)')
+    parser.add_argument('--policy', choices=SCHEDULING_POLICIES, default='least-loaded',
+                        help='排程策略 (預設: least-loaded)')
+    parser.add_argument('--requests', type=int, default=200, help='總請求數 (預設: 200)')
+    parser.add_argument('--concurrency', type=int, default=8, help='同時送出的請求數 (預設: 8)')
+    parser.add_argument('--images', type=str, default=None, help='圖片資料夾，未指定時使用隨機圖片')
+    parser.add_argument('--nef', type=str, default=None, help='使用真正的 dongle 時的 .nef 檔')
+    parser.add_argument('--port-ids', type=int, nargs='*', default=[], help='dongle 的 USB port id')
+    args = parser.parse_args()
+
+    if args.nef:
+        if not args.port_ids:
+            print("❌ 錯誤：使用 --nef 時需要以 --port-ids 指定裝置")
+            sys.exit(1)
+        try:
+            import kp  # noqa: F401
+        except ImportError:
+            print("❌ 錯誤：找不到 Kneron PLUS (kp) 套件，請安裝後再使用 --nef，或改用本地替身")
+            sys.exit(1)
+    elif not os.path.exists(args.model):
+        print(f"❌ 錯誤：找不到模型文件 {args.model}")
+        sys.exit(1)
+    else:
+        reason = check_reference_model(args.model)
+        if reason:
+            print(f"❌ 錯誤：{args.model} 無法作為本地替身的參考模型：{reason}")
+            print("   請改用 ants_bees_opt_fixed.onnx 等標準 ONNX 模型")
+            sys.exit(1)
+
+    try:
+        asyncio.run(simulate(args))
+    except DeviceOpenError as e:
+        print(f"❌ 錯誤：{e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Kneron 工具鏈 (ktc) 呼叫的統一介面
+build_pipeline.py 與 batch_compile.py 透過這裡呼叫優化 / 定點分析 / 編譯，
+可以換成 LocalBackend，在沒有工具鏈容器的機器上測試整個流程
+
+    KtcBackend   - 真正的 ktc（只能在 Kneron 工具鏈容器中使用）
+    LocalBackend - 本地替身：優化使用 onnx_rewrite.py 的規則，
+                   定點分析與編譯只寫出記錄輸入內容的 JSON（不能部署到硬體）
+"""
+import json
+import os
+import shutil
+from pathlib import Path
+
+import onnx
+
+from preprocessing import IMAGE_EXTENSIONS
+from tensor_cache import file_digest
+
+DEFAULT_PLATFORM = '520'
+
+
+def load_input_params(input_params_path):
+    with open(input_params_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def calibration_images(input_params_path, limit=None):
+    """input_params.json 中 model_inputs 的校正圖片路徑（相對於 input_params.json 所在目錄）"""
+    params = load_input_params(input_params_path)
+    base_dir = Path(input_params_path).resolve().parent
+    images = {}
+    for model_input in params['model_info']['model_inputs']:
+        folder = base_dir / model_input['input_image_folder']
+        paths = sorted(str(p) for p in folder.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+        images[model_input['model_input_name']] = paths[:limit] if limit else paths
+    return images
+
+
+class KtcBackend:
+    """Kneron ktc API（需要在工具鏈容器中執行）"""
+    name = 'ktc'
+
+    def __init__(self, platform=DEFAULT_PLATFORM):
+        import ktc  # 只在工具鏈容器中存在
+        self.ktc = ktc
+        self.platform = platform
+
+    def optimize(self, onnx_path, output_path):
+        """ktc.onnx_optimizer.onnx2onnx_flow（與 ants_bees_convert.py 相同的 IR / opset 調整）"""
+        model = onnx.load(onnx_path)
+        if model.ir_version > 6:
+            model.ir_version = 6
+            for opset in model.opset_import:
+                if opset.version > 11:
+                    opset.version = 11
+        try:
+            optimized = self.ktc.onnx_optimizer.onnx2onnx_flow(model, eliminate_tail=False)
+        except Exception as e:
+            print(f"  ⚠️  {e}，改用預設參數")
+            optimized = self.ktc.onnx_optimizer.onnx2onnx_flow(model)
+        onnx.save(optimized, output_path)
+        return output_path
+
+    def analysis(self, onnx_path, input_params_path, output_dir, model_id=100, version='0000', threads=1):
+        """定點分析，回傳 .bie 路徑"""
+        from preprocessing import preprocess
+
+        config = self.ktc.ModelConfig(model_id, version, self.platform, onnx_path=onnx_path)
+        input_mapping = {
+            name: [preprocess(path) for path in paths]
+            for name, paths in calibration_images(input_params_path).items()
+        }
+        return config.analysis(input_mapping, output_dir=output_dir, threads=threads)
+
+    def compile(self, models, output_dir):
+        """
+        編譯成單一 .nef
+
+        Args:
+            models: [{'id', 'version', 'path'}]，path 為 .bie 或 .onnx
+        """
+        configs = []
+        for model in models:
+            kind = 'bie_path' if model['path'].endswith('.bie') else 'onnx_path'
+            configs.append(self.ktc.ModelConfig(model['id'], model['version'], self.platform,
+                                                **{kind: model['path']}))
+        return self.ktc.compile(configs, output_dir=output_dir,
+                                dedicated_output_buffer=True, weight_compress=False)
+
+
+class LocalBackend:
+    """
+    本地替身，用於在沒有工具鏈的機器上測試流程與快取
+    產生的 .bie / .nef 只是記錄輸入的 JSON，不能部署
+    """
+    name = 'local'
+
+    def __init__(self, platform=DEFAULT_PLATFORM):
+        self.platform = platform
+
+    def optimize(self, onnx_path, output_path):
+        from onnx_rewrite import run_passes, slim_passes
+
+        model = onnx.load(onnx_path)
+        run_passes(model, slim_passes(), base_dir=os.path.dirname(os.path.abspath(onnx_path)))
+        onnx.save(model, output_path)
+        return output_path
+
+    def analysis(self, onnx_path, input_params_path, output_dir, model_id=100, version='0000', threads=1):
+        os.makedirs(output_dir, exist_ok=True)
+        images = calibration_images(input_params_path)
+        bie_path = os.path.join(output_dir, f"{Path(onnx_path).stem}.{self.platform}.bie")
+        with open(bie_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'stand_in': True,
+                'model_id': model_id,
+                'version': version,
+                'platform': self.platform,
+                'onnx_sha256': file_digest(onnx_path),
+                'input_params': load_input_params(input_params_path),
+                'calibration_images': {name: len(paths) for name, paths in images.items()},
+                'threads': threads,
+            }, f, indent=2, ensure_ascii=False)
+        return bie_path
+
+    def compile(self, models, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        nef_path = os.path.join(output_dir, f"models_{self.platform}.nef")
+        with open(nef_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'stand_in': True,
+                'platform': self.platform,
+                'models': [dict(id=m['id'], version=m['version'], source=os.path.basename(m['path']),
+                                sha256=file_digest(m['path'])) for m in models],
+            }, f, indent=2, ensure_ascii=False)
+        return nef_path
+
+
+BACKENDS = {
+    'ktc': KtcBackend,
+    'local': LocalBackend,
+}
+
+
+def get_backend(name, platform=DEFAULT_PLATFORM):
+    """依名稱建立 backend；ktc 無法匯入時給出明確的錯誤"""
+    try:
+        return BACKENDS[name](platform)
+    except ImportError as e:
+        raise RuntimeError(f"無法使用 {name} backend ({e})，請在 Kneron 工具鏈容器中執行或改用 --backend local")
+
+
+def copy_output(path, output_dir):
+    """將產物複製到 output_dir，回傳新路徑"""
+    os.makedirs(output_dir, exist_ok=True)
+    target = os.path.join(output_dir, os.path.basename(path))
+    if os.path.abspath(path) != os.path.abspath(target):
+        shutil.copy2(path, target)
+    return target
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+逐層比對兩個 ONNX 模型的中間張量，找出第一個數值開始偏離的層
+（例如 ants_bees.onnx 與經 ktc 優化的 ants_bees_opt.onnx，見 MODEL_ACCURACY_ISSUE.md）
+
+做法:
+  1. 只讀取計算圖（不載入權重），依名稱或拓撲位置對齊兩個模型的中間張量
+  2. 把對齊到的張量都加為模型輸出，每個模型只對校正圖片跑一遍
+  3. 參考模型的中間張量串流寫入 memmap (.npy)；候選模型執行時逐 batch 與其比對並累積誤差
+  4. 依參考模型的拓撲順序列出相對誤差，回報第一個超過門檻的層
+
+拓撲對齊：優化器通常會改名、把 BN 折進 Conv、把 ReduceMean 換成 GlobalAveragePool，
+但不會改變「上游有幾個 Conv/Gemm、經過幾次 Add/Concat 合併」。以
+(上游運算層數量, 合併次數, 單張圖片的形狀) 作為對齊鍵，同鍵的多個張量取拓撲順序最後一個
+（即 Conv→BN→Relu 中的 Relu 輸出）
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import onnx
+
+from inference_local import get_max_batch_size
+from ort_session import create_session
+from preprocessing import IMAGE_EXTENSIONS, new_batch, preprocess_into
+
+# 計算拓撲對齊鍵時視為「一層」的運算子
+ANCHOR_OPS = {'Conv', 'ConvTranspose', 'Gemm', 'MatMul'}
+MERGE_OPS = {'Add', 'Concat', 'Sum', 'Mul'}
+FLOAT_TYPES = {onnx.TensorProto.FLOAT, onnx.TensorProto.FLOAT16, onnx.TensorProto.DOUBLE}
+
+
+def load_graph(model_path):
+    """只載入計算圖並推導形狀（不讀取外部權重）"""
+    model = onnx.load(model_path, load_external_data=False)
+    try:
+        model = onnx.shape_inference.infer_shapes(model)
+    except Exception as e:
+        print(f"  ⚠️  {model_path} shape inference 失敗，只能以名稱對齊: {e}")
+    return model
+
+
+def tensor_types(model):
+    """{張量名稱: (elem_type, 單張圖片的形狀或 None)}"""
+    types = {}
+    for vi in list(model.graph.value_info) + list(model.graph.output):
+        tensor_type = vi.type.tensor_type
+        shape = None
+        if tensor_type.HasField('shape'):
+            dims = [d.dim_value if d.HasField('dim_value') else None for d in tensor_type.shape.dim]
+            if dims and None not in dims[1:]:
+                shape = tuple(dims[1:])
+        types[vi.name] = (tensor_type.elem_type, shape)
+    return types
+
+
+def float_tensors(model):
+    """
+    依拓撲順序列出所有浮點中間張量
+
+    Returns:
+        [(張量名稱, 產生它的節點), ...]
+    """
+    types = tensor_types(model)
+    tensors = []
+    for node in model.graph.node:
+        for name in node.output:
+            if name and types.get(name, (None,))[0] in FLOAT_TYPES:
+                tensors.append((name, node))
+    return tensors
+
+
+def topology_keys(model):
+    """
+    每個張量的拓撲對齊鍵 (上游運算層數量, 合併次數, 單張圖片的形狀)
+
+    上游集合以 bitmask 記錄，所以分支（例如 ResNet 的 downsample）不會被重複計算
+    """
+    types = tensor_types(model)
+    anchors = {}
+    merges = {}
+    anchor_count = 0
+    merge_count = 0
+    keys = {}
+    for node in model.graph.node:
+        anchor_mask = 0
+        merge_mask = 0
+        for name in node.input:
+            anchor_mask |= anchors.get(name, 0)
+            merge_mask |= merges.get(name, 0)
+        if node.op_type in ANCHOR_OPS:
+            anchor_mask |= 1 << anchor_count
+            anchor_count += 1
+        elif node.op_type in MERGE_OPS and sum(1 for name in node.input if anchors.get(name)) > 1:
+            merge_mask |= 1 << merge_count
+            merge_count += 1
+        for name in node.output:
+            anchors[name] = anchor_mask
+            merges[name] = merge_mask
+            shape = types.get(name, (None, None))[1]
+            if shape is not None and anchor_mask:
+                keys[name] = (bin(anchor_mask).count('1'), bin(merge_mask).count('1'), shape)
+    return keys
+
+
+def align_tensors(reference, candidate):
+    """
+    對齊兩個模型的中間張量：名稱相同且形狀一致者優先，其餘以拓撲對齊鍵配對
+
+    Returns:
+        [(參考張量, 候選張量, 對齊方式), ...]，依參考模型的拓撲順序
+    """
+    ref_tensors = float_tensors(reference)
+    cand_tensors = float_tensors(candidate)
+    ref_types = tensor_types(reference)
+    cand_types = tensor_types(candidate)
+    cand_names = {name for name, _ in cand_tensors}
+
+    ref_keys = topology_keys(reference)
+    cand_keys = topology_keys(candidate)
+    # 同一個鍵取拓撲順序最後一個張量
+    ref_by_key = {ref_keys[name]: name for name, _ in ref_tensors if name in ref_keys}
+    cand_by_key = {cand_keys[name]: name for name, _ in cand_tensors if name in cand_keys}
+
+    pairs = []
+    used = set()
+    for name, _ in ref_tensors:
+        if name in cand_names and ref_types[name][1] == cand_types[name][1]:
+            pairs.append((name, name, 'name'))
+            used.add(name)
+            continue
+        key = ref_keys.get(name)
+        if key is not None and ref_by_key.get(key) == name:
+            cand_name = cand_by_key.get(key)
+            if cand_name is not None and cand_name not in used:
+                pairs.append((name, cand_name, 'topology'))
+                used.add(cand_name)
+    return pairs
+
+
+def build_probe_session(model_path, tensor_names):
+    """
+    建立把 tensor_names 都加為輸出的 Session（關閉 ORT 圖優化，避免中間張量被融合掉）
+
+    修改後的計算圖暫存在模型旁邊，外部權重檔的相對路徑才能正確解析
+    """
+    model = onnx.load(model_path, load_external_data=False)
+    existing = {o.name for o in model.graph.output}
+    for name in tensor_names:
+        if name not in existing:
+            model.graph.output.append(onnx.ValueInfoProto(name=name))
+
+    model_dir = os.path.dirname(os.path.abspath(model_path))
+    fd, probe_path = tempfile.mkstemp(suffix='.onnx', prefix='.probe_', dir=model_dir)
+    os.close(fd)
+    try:
+        onnx.save(model, probe_path)
+        return create_session(probe_path, graph_opt_level='disable', cache_dir=None)
+    finally:
+        os.remove(probe_path)
+
+
+def iter_batches(image_paths, batch_size):
+    """依 batch 大小產生預處理後的 (N, 3, 224, 224) 張量"""
+    for start in range(0, len(image_paths), batch_size):
+        paths = image_paths[start:start + batch_size]
+        batch = new_batch(len(paths))
+        for i, path in enumerate(paths):
+            preprocess_into(path, batch, i)
+        yield start, batch
+
+
+def run_model(session, tensor_names, image_paths, on_batch, batch_size):
+    """
+    對所有圖片執行一遍，每個 batch 的中間張量交給 on_batch(start, {名稱: 陣列})
+
+    固定 batch 的模型依模型的 batch 大小執行，動態 batch 的模型每次 batch_size 張
+    """
+    input_name = session.get_inputs()[0].name
+    output_names = [o.name for o in session.get_outputs()]
+    batch_size = get_max_batch_size(session) or batch_size
+    wanted = set(tensor_names)
+    for start, batch in iter_batches(image_paths, batch_size):
+        if batch_size > len(batch):
+            padded = new_batch(batch_size)
+            padded[:len(batch)] = batch
+            outputs = session.run(output_names, {input_name: padded})
+            outputs = [o[:len(batch)] for o in outputs]
+        else:
+            outputs = session.run(output_names, {input_name: batch})
+        on_batch(start, {name: value for name, value in zip(output_names, outputs) if name in wanted})
+
+
+def dump_reference(session, tensor_names, image_paths, work_dir, batch_size):
+    """
+    執行參考模型，把中間張量串流寫入 work_dir 下的 memmap
+
+    Returns:
+        {張量名稱: memmap}
+    """
+    memmaps = {}
+    file_index = {name: i for i, name in enumerate(tensor_names)}
+
+    def on_batch(start, tensors):
+        for name, value in tensors.items():
+            if name not in memmaps:
+                path = os.path.join(work_dir, f'{file_index[name]:04d}.npy')
+                memmaps[name] = np.lib.format.open_memmap(
+                    path, mode='w+', dtype=np.float32, shape=(len(image_paths),) + value.shape[1:])
+            memmaps[name][start:start + len(value)] = value
+
+    run_model(session, tensor_names, image_paths, on_batch, batch_size)
+    for memmap in memmaps.values():
+        memmap.flush()
+    return memmaps
+
+
+def compare_candidate(session, pairs, image_paths, reference, batch_size):
+    """
+    執行候選模型，逐 batch 與參考張量比較並累積誤差
+
+    Returns:
+        {參考張量名稱: {'rel_error', 'max_abs', 'cosine'}}
+    """
+    cand_to_ref = {cand: ref for ref, cand, _ in pairs if ref in reference}
+    sums = {ref: np.zeros(4, dtype=np.float64) for ref in cand_to_ref.values()}  # diff², ref², cand², ref·cand
+    max_abs = {ref: 0.0 for ref in cand_to_ref.values()}
+    skipped = set()
+
+    def on_batch(start, tensors):
+        for cand_name, value in tensors.items():
+            ref_name = cand_to_ref.get(cand_name)
+            if ref_name is None or ref_name in skipped:
+                continue
+            expected = np.asarray(reference[ref_name][start:start + len(value)], dtype=np.float64)
+            if value.size != expected.size:
+                skipped.add(ref_name)
+                continue
+            actual = value.reshape(expected.shape).astype(np.float64)
+            diff = actual - expected
+            sums[ref_name] += (np.dot(diff.ravel(), diff.ravel()), np.dot(expected.ravel(), expected.ravel()),
+                               np.dot(actual.ravel(), actual.ravel()), np.dot(expected.ravel(), actual.ravel()))
+            max_abs[ref_name] = max(max_abs[ref_name], float(np.abs(diff).max()))
+
+    run_model(session, list(cand_to_ref), image_paths, on_batch, batch_size)
+
+    stats = {}
+    for ref_name, (diff_sq, ref_sq, cand_sq, dot) in sums.items():
+        if ref_name in skipped:
+            continue
+        stats[ref_name] = {
+            'rel_error': float(np.sqrt(diff_sq) / (np.sqrt(ref_sq) + 1e-12)),
+            'max_abs': max_abs[ref_name],
+            'cosine': float(dot / (np.sqrt(ref_sq * cand_sq) + 1e-12)),
+        }
+    return stats
+
+
+def collect_images(image_dir, limit):
+    paths = sorted(str(p) for p in Path(image_dir).rglob('*') if p.suffix.lower() in IMAGE_EXTENSIONS)
+    return paths[:limit] if limit else paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='逐層比對兩個 ONNX 模型，找出第一個數值偏離的層',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+使用範例:
+  python layer_divergence.py ants_bees.onnx ants_bees_opt.onnx
+  python layer_divergence.py ants_bees.onnx ants_bees_opt.onnx --images data/val --num-images 0 -o divergence.json
+        """
+    )
+    parser.add_argument('reference', help='參考模型（例如 ants_bees.onnx）')
+    parser.add_argument('candidate', help='要檢查的模型（例如 ants_bees_opt.onnx）')
+    parser.add_argument('--images', type=str, default='data/val', help='校正圖片資料夾 (預設: data/val)')
+    parser.add_argument('--num-images', type=int, default=32,
+                        help='使用的圖片數量，0 表示全部 (預設: 32)')
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='動態 batch 模型每次推論的圖片數量 (預設: 8)')
+    parser.add_argument('--threshold', type=float, default=0.01,
+                        help='相對誤差 ||a-b|| / ||a|| 的門檻 (預設: 0.01)')
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='中間張量 memmap 的存放目錄 (預設: 暫存目錄，結束後刪除)')
+    parser.add_argument('--show-all', action='store_true', help='列出所有對齊的層')
+    parser.add_argument('-o', '--output', type=str, default=None, help='將逐層結果寫入 JSON 檔')
+    args = parser.parse_args()
+
+    image_paths = collect_images(args.images, args.num_images)
+    if not image_paths:
+        print(f"❌ 錯誤：在 {args.images} 中找不到圖片")
+        sys.exit(1)
+
+    print("=" * 80)
+    print("逐層數值比對")
+    print("=" * 80)
+    print(f"參考模型: {args.reference}")
+    print(f"候選模型: {args.candidate}")
+    print(f"校正圖片: {len(image_paths)} 張 ({args.images})")
+
+    reference_graph = load_graph(args.reference)
+    candidate_graph = load_graph(args.candidate)
+    pairs = align_tensors(reference_graph, candidate_graph)
+    by_name = sum(1 for _, _, how in pairs if how == 'name')
+    print(f"對齊 {len(pairs)} 個中間張量 (名稱 {by_name}，拓撲 {len(pairs) - by_name})")
+    if not pairs:
+        print("❌ 錯誤：兩個模型沒有可對齊的中間張量")
+        sys.exit(1)
+
+    producers = {name: node for name, node in float_tensors(reference_graph)}
+    cand_producers = {name: node for name, node in float_tensors(candidate_graph)}
+
+    with tempfile.TemporaryDirectory(prefix='divergence_') as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        os.makedirs(work_dir, exist_ok=True)
+
+        start_time = time.perf_counter()
+        ref_names = [ref for ref, _, _ in pairs]
+        reference = dump_reference(build_probe_session(args.reference, ref_names), ref_names,
+                                   image_paths, work_dir, args.batch_size)
+        print(f"參考模型完成 ({time.perf_counter() - start_time:.1f} 秒)")
+
+        start_time = time.perf_counter()
+        stats = compare_candidate(build_probe_session(args.candidate, [c for _, c, _ in pairs]),
+                                  pairs, image_paths, reference, args.batch_size)
+        print(f"候選模型完成 ({time.perf_counter() - start_time:.1f} 秒)")
+        del reference
+
+    rows = []
+    for ref_name, cand_name, how in pairs:
+        if ref_name not in stats:
+            continue
+        rows.append(dict(reference=ref_name, candidate=cand_name, align=how,
+                         op_type=producers[ref_name].op_type,
+                         candidate_op_type=cand_producers[cand_name].op_type,
+                         **stats[ref_name]))
+
+    first = next((row for row in rows if row['rel_error'] > args.threshold), None)
+
+    print(f"\n{'#':>4s} {'參考張量':30s} {'候選張量':30s} {'相對誤差':>10s} {'最大誤差':>10s} {'cos':>8s}")
+    for i, row in enumerate(rows):
+        if not args.show_all and row is not first and row['rel_error'] <= args.threshold and i != len(rows) - 1:
+            continue
+        mark = '❌' if row['rel_error'] > args.threshold else '  '
+        print(f"{i:>4d} {row['reference'][:30]:30s} {row['candidate'][:30]:30s} "
+              f"{row['rel_error']:>10.2e} {row['max_abs']:>10.2e} {row['cosine']:>8.5f} {mark}")
+
+    print(f"\n{'='*80}")
+    if first is None:
+        print(f"✅ 所有對齊的層相對誤差都在 {args.threshold} 以內")
+    else:
+        print(f"❌ 第一個偏離的層: {first['reference']} ({first['op_type']}) "
+              f"↔ {first['candidate']} ({first['candidate_op_type']})")
+        print(f"   相對誤差 {first['rel_error']:.3e}，最大絕對誤差 {first['max_abs']:.3e}，"
+              f"對齊方式: {first['align']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'threshold': args.threshold, 'num_images': len(image_paths),
+                       'first_divergence': first, 'layers': rows}, f, indent=2, ensure_ascii=False)
+        print(f"✓ 結果已保存到: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
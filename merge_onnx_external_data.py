@@ -1,25 +1,298 @@
 """
-合併 ONNX 模型的外部數據文件為單一文件
+合併 ONNX 模型的外部數據文件為單一文件，或將權重拆分到外部數據文件
+
+不使用 onnx.load() + save_model(save_as_external_data=False)：那樣會把整個模型（有時兩份）
+載入記憶體。這裡只載入計算圖，權重以 mmap 依 offset 串流複製:
+  - 合併: 直接寫出 protobuf，每個權重從 .data 檔以固定大小的區塊複製進輸出檔
+  - 拆分: 權重依 --align 對齊寫入 .data 檔（ONNX Runtime 可直接 mmap 載入），並記錄 SHA1 checksum
+兩種模式都會驗證外部數據中記錄的 checksum
 """
-import onnx
+import argparse
+import hashlib
+import mmap
+import os
 import sys
 
+import onnx
+from onnx import numpy_helper
+
+CHUNK_SIZE = 16 * 1024 * 1024
+# Windows 的 mmap offset 必須是 64 KB (allocation granularity) 的倍數
+DEFAULT_ALIGNMENT = 64 * 1024
+DEFAULT_SIZE_THRESHOLD = 1024
+PROTOBUF_LIMIT = 2 * 1024 * 1024 * 1024
+# shape / axes 等 INT64 常數一律留在模型內：ONNX Runtime 讀取這類輸入時不支援外部數據
+INLINE_DATA_TYPES = (onnx.TensorProto.INT64,)
+
+# protobuf 欄位標籤 (field_number << 3 | wire_type 2)
+MODEL_GRAPH_TAG = b'\x3a'         # ModelProto.graph = 7
+GRAPH_INITIALIZER_TAG = b'\x2a'   # GraphProto.initializer = 5
+TENSOR_RAW_DATA_TAG = b'\x4a'     # TensorProto.raw_data = 9
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field_size(payload_size):
+    """tag + 長度 varint + 內容 的總位元組數"""
+    return 1 + len(_varint(payload_size)) + payload_size
+
+
+def is_external(tensor):
+    return tensor.data_location == onnx.TensorProto.EXTERNAL
+
+
+def external_info(tensor):
+    """{location, offset, length, checksum}"""
+    info = {entry.key: entry.value for entry in tensor.external_data}
+    info['offset'] = int(info.get('offset', 0))
+    info['length'] = int(info['length']) if 'length' in info else None
+    return info
+
+
+class ExternalDataReader:
+    """以 mmap 讀取外部數據檔（同一個檔案只開啟一次）"""
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self._files = {}
+
+    def view(self, tensor):
+        """回傳 tensor 權重的 memoryview（不複製）"""
+        info = external_info(tensor)
+        path = os.path.join(self.base_dir, info['location'])
+        if path not in self._files:
+            f = open(path, 'rb')
+            self._files[path] = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        data = self._files[path][1]
+        end = len(data) if info['length'] is None else info['offset'] + info['length']
+        if end > len(data):
+            raise ValueError(f"{tensor.name}: 外部數據超出檔案範圍 ({info['location']} 只有 {len(data)} bytes)")
+        return memoryview(data)[info['offset']:end]
+
+    def close(self):
+        for f, data in self._files.values():
+            data.close()
+            f.close()
+        self._files.clear()
+
+
+def copy_payload(view, write, checksum=None, name=''):
+    """
+    將 view 以 CHUNK_SIZE 區塊寫出，並驗證 SHA1
+
+    Returns:
+        SHA1 hex digest
+    """
+    digest = hashlib.sha1()
+    for start in range(0, len(view), CHUNK_SIZE):
+        chunk = view[start:start + CHUNK_SIZE]
+        digest.update(chunk)
+        write(chunk)
+    if checksum and digest.hexdigest() != checksum:
+        raise ValueError(f"{name}: checksum 不符 (記錄 {checksum}，實際 {digest.hexdigest()})")
+    return digest.hexdigest()
+
+
 def merge_external_data(input_path, output_path):
-    """將外部數據合併到 ONNX 模型中"""
-    print(f"正在載入模型: {input_path}")
-    model = onnx.load(input_path)
-    
-    print("正在合併外部數據...")
-    # 使用 load_external_data_for_model 來加載外部數據
-    # 然後保存為單一文件
-    onnx.save_model(model, output_path, save_as_external_data=False)
-    
+    """將外部數據合併到 ONNX 模型中（串流寫出，不載入整個模型）"""
+    print(f"正在載入計算圖: {input_path}")
+    model = onnx.load(input_path, load_external_data=False)
+    reader = ExternalDataReader(os.path.dirname(os.path.abspath(input_path)))
+
+    try:
+        graph = onnx.GraphProto()
+        graph.CopyFrom(model.graph)
+        del graph.initializer[:]
+        head = model.__class__()
+        head.CopyFrom(model)
+        head.ClearField('graph')
+
+        # 先計算每個 initializer 序列化後的大小，才能寫出 graph 的長度
+        entries = []
+        graph_size = len(graph.SerializeToString())
+        for tensor in model.graph.initializer:
+            if is_external(tensor):
+                meta = onnx.TensorProto()
+                meta.CopyFrom(tensor)
+                del meta.external_data[:]
+                meta.ClearField('data_location')
+                meta_bytes = meta.SerializeToString()
+                view = reader.view(tensor)
+                size = len(meta_bytes) + _field_size(len(view))
+                entries.append((tensor, meta_bytes, view))
+            else:
+                meta_bytes = tensor.SerializeToString()
+                size = len(meta_bytes)
+                entries.append((tensor, meta_bytes, None))
+            graph_size += _field_size(size)
+
+        if graph_size >= PROTOBUF_LIMIT:
+            print(f"❌ 錯誤：合併後大小 {graph_size / 1024**3:.2f} GB 超過 protobuf 的 2 GB 上限，請保留外部數據")
+            sys.exit(1)
+
+        print(f"正在合併外部數據 ({sum(1 for e in entries if e[2] is not None)} 個權重，"
+              f"{graph_size / (1024 * 1024):.1f} MB)...")
+        with open(output_path, 'wb') as out:
+            out.write(head.SerializeToString())
+            out.write(MODEL_GRAPH_TAG + _varint(graph_size))
+            out.write(graph.SerializeToString())
+            for tensor, meta_bytes, view in entries:
+                if view is None:
+                    out.write(GRAPH_INITIALIZER_TAG + _varint(len(meta_bytes)) + meta_bytes)
+                    continue
+                tensor_size = len(meta_bytes) + _field_size(len(view))
+                out.write(GRAPH_INITIALIZER_TAG + _varint(tensor_size) + meta_bytes)
+                out.write(TENSOR_RAW_DATA_TAG + _varint(len(view)))
+                copy_payload(view, out.write, external_info(tensor).get('checksum'), tensor.name)
+                view.release()
+    finally:
+        reader.close()
+
     print(f"✓ 已保存為單一文件: {output_path}")
 
-if __name__ == "__main__":
-    input_path = "ants_bees.onnx"
-    output_path = "ants_bees_merged.onnx"
-    
-    merge_external_data(input_path, output_path)
+
+def split_external_data(input_path, output_path, alignment=DEFAULT_ALIGNMENT,
+                        size_threshold=DEFAULT_SIZE_THRESHOLD):
+    """
+    將大於 size_threshold 的權重寫到 <output>.data，每個權重的 offset 對齊 alignment
+    INT64 張量（shape、axes 等）不論大小都保留在模型內
+
+    輸入可以是單一文件或已有外部數據的模型（重新對齊 / 加上 checksum）
+    """
+    data_name = os.path.basename(output_path) + '.data'
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    data_path = os.path.join(output_dir, data_name)
+
+    print(f"正在載入模型: {input_path}")
+    model = onnx.load(input_path, load_external_data=False)
+    input_dir = os.path.dirname(os.path.abspath(input_path))
+    sources = {os.path.realpath(os.path.join(input_dir, external_info(t)['location']))
+               for t in model.graph.initializer if is_external(t)}
+    if os.path.realpath(data_path) in sources:
+        print(f"❌ 錯誤：輸出的外部數據檔 {data_path} 與輸入相同，請指定其他輸出路徑")
+        sys.exit(1)
+
+    reader = ExternalDataReader(input_dir)
+    count = 0
+    try:
+        with open(data_path, 'wb') as out:
+            for tensor in model.graph.initializer:
+                if is_external(tensor):
+                    view = reader.view(tensor)
+                    checksum = external_info(tensor).get('checksum')
+                elif tensor.HasField('raw_data'):
+                    view = memoryview(tensor.raw_data)
+                    checksum = None
+                else:
+                    view = memoryview(numpy_helper.to_array(tensor).tobytes())
+                    checksum = None
+                if tensor.data_type in INLINE_DATA_TYPES:
+                    if is_external(tensor):
+                        payload = bytearray()
+                        copy_payload(view, payload.extend, checksum, tensor.name)
+                        del tensor.external_data[:]
+                        tensor.data_location = onnx.TensorProto.DEFAULT
+                        tensor.raw_data = bytes(payload)
+                    view.release()
+                    continue
+                if len(view) < size_threshold and not is_external(tensor):
+                    continue
+
+                offset = out.tell()
+                if offset % alignment:
+                    out.write(b'\0' * (alignment - offset % alignment))
+                    offset = out.tell()
+                digest = copy_payload(view, out.write, checksum, tensor.name)
+                length = len(view)
+                view.release()
+
+                # 權重已寫出，立即釋放 protobuf 中的內容
+                for field in ('raw_data', 'float_data', 'int32_data', 'int64_data',
+                              'double_data', 'uint64_data', 'string_data'):
+                    tensor.ClearField(field)
+                del tensor.external_data[:]
+                tensor.data_location = onnx.TensorProto.EXTERNAL
+                for key, value in (('location', data_name), ('offset', offset),
+                                   ('length', length), ('checksum', digest)):
+                    entry = tensor.external_data.add()
+                    entry.key = key
+                    entry.value = str(value)
+                count += 1
+    finally:
+        reader.close()
+
+    onnx.save(model, output_path)
+    print(f"✓ 已拆分 {count} 個權重到 {data_path} (對齊 {alignment} bytes)")
+
+
+def verify_external_data(model_path, alignment=None):
+    """
+    檢查每個外部權重的範圍、對齊與 checksum
+
+    Returns:
+        是否全部通過
+    """
+    model = onnx.load(model_path, load_external_data=False)
+    reader = ExternalDataReader(os.path.dirname(os.path.abspath(model_path)))
+    ok = True
+    checked = 0
+    try:
+        for tensor in model.graph.initializer:
+            if not is_external(tensor):
+                continue
+            info = external_info(tensor)
+            try:
+                view = reader.view(tensor)
+                copy_payload(view, lambda chunk: None, info.get('checksum'), tensor.name)
+                view.release()
+            except Exception as e:
+                print(f"  ❌ {e}")
+                ok = False
+                continue
+            if alignment and info['offset'] % alignment:
+                print(f"  ⚠️  {tensor.name}: offset {info['offset']} 未對齊 {alignment}")
+            checked += 1
+    finally:
+        reader.close()
+    print(f"{'✓' if ok else '❌'} 已檢查 {checked} 個外部權重")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='合併 / 拆分 ONNX 模型的外部數據 (串流、不載入整個模型)')
+    parser.add_argument('input', nargs='?', default='ants_bees.onnx', help='輸入模型 (預設: ants_bees.onnx)')
+    parser.add_argument('output', nargs='?', default=None,
+                        help='輸出模型 (預設: 合併為 <輸入>_merged.onnx，拆分為 <輸入>_external.onnx)')
+    parser.add_argument('--split', action='store_true', help='拆分權重到 <output>.data（預設為合併）')
+    parser.add_argument('--align', type=int, default=DEFAULT_ALIGNMENT,
+                        help=f'拆分時每個權重的對齊位元組數 (預設: {DEFAULT_ALIGNMENT})')
+    parser.add_argument('--size-threshold', type=int, default=DEFAULT_SIZE_THRESHOLD,
+                        help=f'小於此大小的權重保留在模型內，INT64 張量一律保留 (預設: {DEFAULT_SIZE_THRESHOLD})')
+    parser.add_argument('--verify', action='store_true', help='只檢查輸入模型外部數據的範圍與 checksum')
+    args = parser.parse_args()
+
+    if args.verify:
+        sys.exit(0 if verify_external_data(args.input, args.align) else 1)
+
+    stem = os.path.splitext(args.input)[0]
+    if args.split:
+        output_path = args.output or f"{stem}_external.onnx"
+        split_external_data(args.input, output_path, args.align, args.size_threshold)
+    else:
+        output_path = args.output or f"{stem}_merged.onnx"
+        merge_external_data(args.input, output_path)
     print("完成！")
 
+
+if __name__ == "__main__":
+    main()
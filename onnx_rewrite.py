@@ -0,0 +1,623 @@
+"""
+ONNX 計算圖改寫引擎
+一次建立 producer / consumer / initializer / 形狀索引，之後每次比對與替換都是 O(1)，
+取代 replace_reducemean.py 與 fix_reducemean_properly.py 中
+「每個節點都線性掃描 value_info / initializer、用 list.index() 找插入位置」的做法
+
+使用方式:
+    model = onnx.load('ants_bees_opt.onnx')
+    run_passes(model, [ReduceMeanToGlobalAveragePool()])
+    onnx.save(model, 'ants_bees_opt_fixed.onnx')
+
+自訂改寫規則：繼承 RewritePass，設定 op_types，實作 match() 與 rewrite()。
+run_passes() 會重複套用所有規則直到計算圖不再改變 (fixed point)，最後只做一次 shape inference
+"""
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper
+
+
+def get_attr(node, name, default=None):
+    """讀取節點屬性，不存在時回傳 default"""
+    for attr in node.attribute:
+        if attr.name == name:
+            return helper.get_attribute_value(attr)
+    return default
+
+
+def _used_names(nodes):
+    """節點（含 If / Loop 子圖）使用到的所有張量名稱"""
+    used = set()
+    for node in nodes:
+        used.update(name for name in node.input if name)
+        for attr in node.attribute:
+            if attr.type == onnx.AttributeProto.GRAPH:
+                used |= _used_names(attr.g.node)
+            elif attr.type == onnx.AttributeProto.GRAPHS:
+                for graph in attr.graphs:
+                    used |= _used_names(graph.node)
+    return used
+
+
+def _node_inputs(node):
+    """節點的輸入名稱，包含子圖中引用的外層張量（去除重複）"""
+    names = dict.fromkeys(name for name in node.input if name)
+    if any(attr.type in (onnx.AttributeProto.GRAPH, onnx.AttributeProto.GRAPHS) for attr in node.attribute):
+        names.update(dict.fromkeys(_used_names([node])))
+    return list(names)
+
+
+class GraphIndex:
+    """
+    計算圖索引
+
+    Attributes:
+        model: 被改寫的 ModelProto
+        graph: model.graph
+    """
+
+    def __init__(self, model, base_dir=None):
+        self.model = model
+        self.graph = model.graph
+        self.base_dir = base_dir
+
+        # 節點順序：每一格是一個節點的列表（替換時整組換掉，最後再攤平）
+        self._order = [[node] for node in self.graph.node]
+        self._slot = {id(node): i for i, node in enumerate(self.graph.node)}
+        # 保留被移除節點的參照，避免 id() 被重複使用
+        self._removed = []
+
+        self._producers = {}
+        self._consumers = defaultdict(list)
+        self._by_type = defaultdict(list)
+        for node in self.graph.node:
+            self._index_node(node)
+
+        self._initializers = {init.name: init for init in self.graph.initializer}
+        self._shapes = {}
+        for vi in list(self.graph.input) + list(self.graph.value_info) + list(self.graph.output):
+            if vi.type.HasField('tensor_type') and vi.type.tensor_type.HasField('shape'):
+                self._shapes[vi.name] = [
+                    d.dim_value if d.HasField('dim_value') else (d.dim_param or None)
+                    for d in vi.type.tensor_type.shape.dim
+                ]
+        self._graph_inputs = {vi.name for vi in self.graph.input}
+        self._graph_outputs = {vi.name for vi in self.graph.output}
+        self._names = set(self._producers) | set(self._initializers) | self._graph_inputs
+        self._names.update(node.name for node in self.graph.node)
+
+    # ------------------------------------------------------------------
+    # 查詢
+    # ------------------------------------------------------------------
+    @property
+    def nodes(self):
+        """目前的節點（依拓撲順序）"""
+        return [node for group in self._order for node in group]
+
+    def nodes_of_type(self, op_type):
+        """目前存在、且 op_type 相符的節點（快照）"""
+        return [node for node in self._by_type.get(op_type, []) if self.alive(node)]
+
+    def alive(self, node):
+        return id(node) in self._slot
+
+    def producer(self, name):
+        return self._producers.get(name)
+
+    def consumers(self, name):
+        return list(self._consumers.get(name, ()))
+
+    def initializer(self, name):
+        return self._initializers.get(name)
+
+    def is_graph_input(self, name):
+        return name in self._graph_inputs
+
+    def is_graph_output(self, name):
+        return name in self._graph_outputs
+
+    def shape(self, name):
+        """張量形狀（維度為 int、符號名稱或 None），未知時回傳 None"""
+        return self._shapes.get(name)
+
+    def is_constant(self, name):
+        """張量是否為常數（不讀取數值）"""
+        if name in self._initializers:
+            return not self.is_graph_input(name)
+        node = self._producers.get(name)
+        return node is not None and node.op_type == 'Constant'
+
+    def const_value(self, name):
+        """
+        若張量是常數（initializer 或 Constant 節點的輸出）回傳 numpy 陣列，否則回傳 None
+        """
+        init = self._initializers.get(name)
+        if init is not None and not self.is_graph_input(name):
+            try:
+                return numpy_helper.to_array(init, self.base_dir or '')
+            except Exception:
+                return None
+        node = self._producers.get(name)
+        if node is not None and node.op_type == 'Constant':
+            value = get_attr(node, 'value')
+            if value is not None:
+                return numpy_helper.to_array(value)
+        return None
+
+    def unique_name(self, base):
+        """產生不重複的張量 / 節點名稱"""
+        name = base
+        i = 1
+        while name in self._names:
+            name = f"{base}_{i}"
+            i += 1
+        self._names.add(name)
+        return name
+
+    # ------------------------------------------------------------------
+    # 修改
+    # ------------------------------------------------------------------
+    def _index_node(self, node):
+        for output in node.output:
+            if output:
+                self._producers[output] = node
+        for name in _node_inputs(node):
+            self._consumers[name].append(node)
+        self._by_type[node.op_type].append(node)
+
+    def _unindex_node(self, node):
+        for output in node.output:
+            if self._producers.get(output) is node:
+                del self._producers[output]
+        for name in _node_inputs(node):
+            consumers = self._consumers.get(name)
+            if consumers is not None:
+                consumers[:] = [c for c in consumers if c is not node]
+
+    def replace_node(self, old, new_nodes):
+        """以 new_nodes（可為空列表）取代 old，保持原本的位置"""
+        slot = self._slot.pop(id(old))
+        group = self._order[slot]
+        position = next(i for i, node in enumerate(group) if node is old)
+        self._unindex_node(old)
+        self._removed.append(old)
+        group[position:position + 1] = list(new_nodes)
+        for node in new_nodes:
+            self._slot[id(node)] = slot
+            self._index_node(node)
+            self._names.update(o for o in node.output if o)
+            if node.name:
+                self._names.add(node.name)
+
+    def remove_node(self, node):
+        self.replace_node(node, [])
+
+    def rename_input(self, node, old_name, new_name):
+        """將 node 的輸入 old_name 改為 new_name"""
+        for i, name in enumerate(node.input):
+            if name == old_name:
+                node.input[i] = new_name
+        self._consumers[old_name] = [c for c in self._consumers[old_name] if c is not node]
+        self._consumers[new_name].append(node)
+
+    def can_bypass(self, node, input_name):
+        """bypass() 是否能安全執行"""
+        output = node.output[0]
+        if not self.is_graph_output(output):
+            return True
+        upstream = self.producer(input_name)
+        return (upstream is not None and not self.is_graph_output(input_name)
+                and len(self._consumers.get(input_name, ())) == 1)
+
+    def bypass(self, node, input_name):
+        """
+        移除單一輸出的節點，讓下游改用 input_name
+        輸出若為計算圖輸出，改為讓 input_name 的 producer 直接產生該輸出名稱
+
+        Returns:
+            是否成功（無法安全重新接線時回傳 False）
+        """
+        if not self.can_bypass(node, input_name):
+            return False
+        output = node.output[0]
+        if self.is_graph_output(output):
+            upstream = self.producer(input_name)
+            idx = list(upstream.output).index(input_name)
+            self._producers.pop(input_name, None)
+            upstream.output[idx] = output
+            self.remove_node(node)
+            self._producers[output] = upstream
+            if input_name in self._shapes:
+                self._shapes.setdefault(output, self._shapes[input_name])
+            return True
+        for consumer in self.consumers(output):
+            self.rename_input(consumer, output, input_name)
+        self.remove_node(node)
+        return True
+
+    def add_initializer(self, array, name):
+        """新增 initializer，回傳實際使用的名稱"""
+        name = self.unique_name(name)
+        tensor = numpy_helper.from_array(array, name)
+        self.graph.initializer.append(tensor)
+        self._initializers[name] = self.graph.initializer[-1]
+        self._shapes[name] = list(array.shape)
+        return name
+
+    def commit(self):
+        """
+        將節點寫回 graph，並移除不再使用的 initializer 與 value_info
+
+        Returns:
+            被移除的 initializer 數量
+        """
+        nodes = self.nodes
+        del self.graph.node[:]
+        self.graph.node.extend(nodes)
+
+        used = _used_names(nodes) | self._graph_outputs
+        removed = 0
+        for i in range(len(self.graph.initializer) - 1, -1, -1):
+            if self.graph.initializer[i].name not in used:
+                del self.graph.initializer[i]
+                removed += 1
+
+        produced = {name for node in nodes for name in node.output}
+        for i in range(len(self.graph.value_info) - 1, -1, -1):
+            if self.graph.value_info[i].name not in produced:
+                del self.graph.value_info[i]
+
+        # 重新建立索引，使 commit 之後仍可繼續使用
+        self.__init__(self.model, self.base_dir)
+        return removed
+
+
+class RewritePass:
+    """
+    宣告式改寫規則
+
+    子類別需設定:
+        name: 顯示名稱
+        op_types: 錨點節點的 op_type，None 表示所有節點
+    並實作:
+        match(node, index) -> 比對結果 (任意值) 或 None
+        rewrite(node, match, index) -> 取代 node 的新節點列表；
+            回傳 None 表示 rewrite 已自行透過 index 修改計算圖
+    """
+    name = 'RewritePass'
+    op_types = ()
+
+    def match(self, node, index):
+        raise NotImplementedError
+
+    def rewrite(self, node, match, index):
+        raise NotImplementedError
+
+
+def run_passes(model, passes, max_iterations=10, infer_shapes=True, base_dir=None, verbose=True):
+    """
+    重複套用改寫規則直到不再改變 (fixed point)，最後做一次 shape inference
+
+    Args:
+        model: ModelProto（原地修改）
+        passes: RewritePass 列表
+        max_iterations: 最多掃描幾輪
+        infer_shapes: 是否在結束時重新推導形狀
+        base_dir: 外部權重檔所在目錄（讀取常數值時使用）
+
+    Returns:
+        {規則名稱: 套用次數}
+    """
+    start_time = time.perf_counter()
+    index = GraphIndex(model, base_dir)
+    counts = {p.name: 0 for p in passes}
+
+    for iteration in range(max_iterations):
+        changed = 0
+        for rewrite_pass in passes:
+            if rewrite_pass.op_types is None:
+                candidates = index.nodes
+            else:
+                candidates = [node for op_type in rewrite_pass.op_types
+                              for node in index.nodes_of_type(op_type)]
+            for node in candidates:
+                if not index.alive(node):
+                    continue
+                match = rewrite_pass.match(node, index)
+                if match is None:
+                    continue
+                new_nodes = rewrite_pass.rewrite(node, match, index)
+                if new_nodes is not None:
+                    index.replace_node(node, new_nodes)
+                counts[rewrite_pass.name] += 1
+                changed += 1
+        if changed == 0:
+            break
+
+    removed = index.commit()
+
+    if infer_shapes:
+        try:
+            inferred = onnx.shape_inference.infer_shapes(model)
+            del model.graph.value_info[:]
+            model.graph.value_info.extend(inferred.graph.value_info)
+        except Exception as e:
+            if verbose:
+                print(f"  [WARNING] shape inference 失敗: {e}")
+
+    if verbose:
+        elapsed = (time.perf_counter() - start_time) * 1000
+        for name, count in counts.items():
+            print(f"  {name}: {count} 處")
+        if removed:
+            print(f"  移除未使用的 initializer: {removed} 個")
+        print(f"  改寫完成，共 {iteration + 1} 輪，耗時 {elapsed:.1f} ms")
+    return counts
+
+
+# ----------------------------------------------------------------------
+# 改寫規則
+# ----------------------------------------------------------------------
+class ReduceMeanToGlobalAveragePool(RewritePass):
+    """
+    ReduceMean(axes=[2, 3]) on NCHW → GlobalAveragePool
+    Kneron 編譯器不支援 ReduceMean；axes 可以是屬性 (opset < 18) 或常數輸入 (opset >= 18)，
+    keepdims=0 時另外接一個 Flatten(axis=1) 保持輸出形狀 [N, C]
+    """
+    name = 'ReduceMean→GlobalAveragePool'
+    op_types = ('ReduceMean',)
+
+    def match(self, node, index):
+        axes = get_attr(node, 'axes')
+        if axes is None and len(node.input) > 1 and node.input[1]:
+            value = index.const_value(node.input[1])
+            if value is None:
+                return None
+            axes = value.reshape(-1).tolist()
+        if not axes:
+            return None
+
+        # 輸入形狀未知時沿用舊腳本的假設：NCHW 四維
+        shape = index.shape(node.input[0])
+        rank = len(shape) if shape else 4
+        if rank != 4:
+            return None
+        if sorted(a % rank for a in axes) != [2, 3]:
+            return None
+        return {'keepdims': get_attr(node, 'keepdims', 1)}
+
+    def rewrite(self, node, match, index):
+        base = node.name.replace('ReduceMean', 'GAP') if 'ReduceMean' in node.name else (node.name or 'reducemean') + '_gap'
+        if match['keepdims']:
+            return [helper.make_node('GlobalAveragePool', [node.input[0]], [node.output[0]],
+                                     name=index.unique_name(base))]
+        pooled = index.unique_name(f"{node.output[0]}_gap")
+        return [
+            helper.make_node('GlobalAveragePool', [node.input[0]], [pooled], name=index.unique_name(base)),
+            helper.make_node('Flatten', [pooled], [node.output[0]], axis=1,
+                             name=index.unique_name(f"{base}_flatten")),
+        ]
+
+
+class FoldBatchNormIntoConv(RewritePass):
+    """
+    Conv → BatchNormalization (推論模式) 折疊為單一 Conv
+        W' = W * s,  b' = (b - mean) * s + beta,  s = gamma / sqrt(var + eps)
+    """
+    name = 'Conv+BatchNormalization 折疊'
+    op_types = ('BatchNormalization',)
+
+    def match(self, bn, index):
+        if get_attr(bn, 'training_mode', 0):
+            return None
+        if any(name and index.consumers(name) for name in bn.output[1:]):
+            return None
+        conv = index.producer(bn.input[0])
+        if conv is None or conv.op_type != 'Conv':
+            return None
+        if len(index.consumers(conv.output[0])) != 1 or index.is_graph_output(conv.output[0]):
+            return None
+        weight = index.const_value(conv.input[1])
+        params = [index.const_value(name) for name in bn.input[1:5]]
+        if weight is None or any(p is None for p in params):
+            return None
+        bias = None
+        if len(conv.input) > 2 and conv.input[2]:
+            bias = index.const_value(conv.input[2])
+            if bias is None:
+                return None
+        return {'conv': conv, 'weight': weight, 'bias': bias, 'params': params}
+
+    def rewrite(self, bn, match, index):
+        conv, weight, bias = match['conv'], match['weight'], match['bias']
+        gamma, beta, mean, var = (p.astype(np.float64) for p in match['params'])
+        scale = gamma / np.sqrt(var + get_attr(bn, 'epsilon', 1e-5))
+        if bias is None:
+            bias = np.zeros(weight.shape[0], dtype=np.float64)
+
+        new_weight = (weight.astype(np.float64) * scale.reshape(-1, *([1] * (weight.ndim - 1)))).astype(weight.dtype)
+        new_bias = ((bias.astype(np.float64) - mean) * scale + beta).astype(weight.dtype)
+        weight_name = index.add_initializer(new_weight, f"{conv.input[1]}_bnfold")
+        bias_name = index.add_initializer(new_bias, f"{conv.name or conv.input[1]}_bnfold_bias")
+
+        new_conv = helper.make_node('Conv', [conv.input[0], weight_name, bias_name], [bn.output[0]],
+                                    name=conv.name)
+        new_conv.attribute.extend(conv.attribute)
+        index.replace_node(conv, [new_conv])
+        return []
+
+
+class ReshapeToFlatten(RewritePass):
+    """
+    Gemm 前把 [N, C, 1, 1] 攤平成 [N, C] 的 Reshape 換成 Flatten(axis=1)
+    不需要 shape 常數，batch 維度也不再寫死
+    """
+    name = 'Reshape→Flatten (Gemm 輸入)'
+    op_types = ('Reshape',)
+
+    def match(self, node, index):
+        consumers = index.consumers(node.output[0])
+        if not consumers or any(c.op_type != 'Gemm' or c.input[0] != node.output[0] for c in consumers):
+            return None
+        target = index.const_value(node.input[1])
+        shape = index.shape(node.input[0])
+        if target is None or target.size != 2 or not shape or None in shape:
+            return None
+        if any(isinstance(d, str) for d in shape[1:]):
+            return None
+        features = int(np.prod(shape[1:]))
+        batch, width = (int(v) for v in target)
+        if batch == 0 and get_attr(node, 'allowzero', 0):
+            return None
+        if batch not in (-1, 0, shape[0]):
+            return None
+        if width not in (-1, features):
+            return None
+        return True
+
+    def rewrite(self, node, match, index):
+        return [helper.make_node('Flatten', [node.input[0]], [node.output[0]], axis=1,
+                                 name=node.name or index.unique_name('flatten'))]
+
+
+class FuseFlattenIntoGemm(RewritePass):
+    """輸入已經是二維時，Gemm 前的 Flatten(axis=1) 不做任何事，直接移除"""
+    name = 'Flatten+Gemm 融合'
+    op_types = ('Flatten',)
+
+    def match(self, node, index):
+        shape = index.shape(node.input[0])
+        if get_attr(node, 'axis', 1) != 1 or not shape or len(shape) != 2:
+            return None
+        if not index.can_bypass(node, node.input[0]):
+            return None
+        consumers = index.consumers(node.output[0])
+        if not consumers or any(c.op_type != 'Gemm' for c in consumers):
+            return None
+        return True
+
+    def rewrite(self, node, match, index):
+        index.bypass(node, node.input[0])
+        return None
+
+
+class RemoveIdentity(RewritePass):
+    """移除 Identity 與推論時不起作用的 Dropout"""
+    name = '移除 Identity'
+    op_types = ('Identity', 'Dropout')
+
+    def match(self, node, index):
+        if node.op_type == 'Dropout' and any(name and index.consumers(name) for name in node.output[1:]):
+            return None
+        if not index.can_bypass(node, node.input[0]):
+            return None
+        return True
+
+    def rewrite(self, node, match, index):
+        index.bypass(node, node.input[0])
+        return None
+
+
+class ConstantFolding(RewritePass):
+    """
+    所有輸入都是常數的節點直接計算成 initializer
+    使用 onnx.reference 逐節點求值，輸出超過 max_elements 的節點不折疊（避免模型膨脹）
+    """
+    name = '常數折疊'
+    op_types = None
+
+    SKIP_OPS = {'Constant', 'RandomNormal', 'RandomUniform', 'RandomNormalLike',
+                'RandomUniformLike', 'Multinomial', 'If', 'Loop', 'Scan'}
+
+    def __init__(self, max_elements=1 << 20):
+        self.max_elements = max_elements
+
+    def match(self, node, index):
+        if node.op_type in self.SKIP_OPS or node.domain not in ('', 'ai.onnx'):
+            return None
+        inputs = [name for name in node.input if name]
+        if not inputs or any(index.is_graph_output(name) for name in node.output):
+            return None
+        if not all(index.is_constant(name) for name in inputs):
+            return None
+        values = {}
+        for name in inputs:
+            value = index.const_value(name)
+            if value is None:
+                return None
+            values[name] = value
+
+        from onnx.reference import ReferenceEvaluator
+        opsets = {op.domain or '': op.version for op in index.model.opset_import}
+        try:
+            outputs = ReferenceEvaluator(node, opsets=opsets).run(None, values)
+        except Exception:
+            return None
+        outputs = [np.asarray(value) for value in outputs]
+        if sum(value.size for value in outputs) > self.max_elements:
+            return None
+        return outputs
+
+    def rewrite(self, node, outputs, index):
+        for name, value in zip(node.output, outputs):
+            if not name:
+                continue
+            new_name = index.add_initializer(value, name + '_folded')
+            for consumer in index.consumers(name):
+                index.rename_input(consumer, name, new_name)
+        return []
+
+
+class RemoveDeadNodes(RewritePass):
+    """移除輸出沒有被使用、也不是計算圖輸出的節點"""
+    name = '移除無用節點'
+    op_types = None
+
+    def match(self, node, index):
+        for name in node.output:
+            if name and (index.consumers(name) or index.is_graph_output(name)):
+                return None
+        return True
+
+    def rewrite(self, node, match, index):
+        return []
+
+
+def slim_passes():
+    """編譯前的計算圖精簡：折疊 BN、常數折疊、移除 Identity、Flatten/Gemm 融合、ReduceMean→GAP"""
+    return [
+        FoldBatchNormIntoConv(),
+        ConstantFolding(),
+        RemoveIdentity(),
+        ReduceMeanToGlobalAveragePool(),
+        ReshapeToFlatten(),
+        FuseFlattenIntoGemm(),
+        RemoveDeadNodes(),
+    ]
+
+
+def rewrite_model_file(input_path, output_path, passes, check=True):
+    """
+    載入模型、套用改寫規則並保存
+
+    Returns:
+        {規則名稱: 套用次數}
+    """
+    print(f"正在載入模型: {input_path}")
+    model = onnx.load(input_path)
+    counts = run_passes(model, passes, base_dir=os.path.dirname(os.path.abspath(input_path)))
+
+    print(f"\n正在保存修改後的模型: {output_path}")
+    onnx.save(model, output_path)
+
+    if check:
+        try:
+            onnx.checker.check_model(model)
+            print("[OK] 模型驗證通過")
+        except Exception as e:
+            print(f"[WARNING] 模型驗證警告: {e}")
+    return counts
@@ -1,34 +1,122 @@
 """
 簡單的 ONNX 優化腳本
 由於 Kneron 工具鏈容器中的 ONNX 版本兼容性問題，
-這個腳本提供基本的優化功能
+這個腳本提供基本的優化功能（不需要 ktc / 工具鏈容器）:
+  - BatchNormalization 折疊進 Conv 權重
+  - 常數折疊、移除 Identity / Dropout
+  - ReduceMean → GlobalAveragePool、Reshape/Flatten + Gemm 融合
+優化後以 ONNX Runtime（關閉 ORT 圖優化）比對原始模型與優化模型的輸出，確認數值等價
+
+使用方法: python optimize_onnx.py <input.onnx> <output.onnx> [--images data/val/ants]
 """
-import onnx
+import argparse
+import os
 import sys
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import onnx
+
+from onnx_rewrite import run_passes, slim_passes
+from ort_session import create_session
+
+
+def count_ops(model):
+    return Counter(node.op_type for node in model.graph.node)
+
+
+def print_op_changes(before, after):
+    """列出每種運算子的數量變化"""
+    print(f"\n{'運算子':20s} {'優化前':>8s} {'優化後':>8s}")
+    for op_type in sorted(set(before) | set(after)):
+        if before[op_type] != after[op_type]:
+            print(f"  {op_type:18s} {before[op_type]:>8d} {after[op_type]:>8d}")
+    print(f"  {'總計':18s} {sum(before.values()):>8d} {sum(after.values()):>8d}")
+
+
+def make_inputs(session, num_samples, image_dir=None, seed=0):
+    """
+    產生比對用的輸入：有 image_dir 時使用真實圖片，否則使用隨機張量
+    動態維度一律設為 1
+
+    Returns:
+        [{input_name: array}, ...]
+    """
+    model_inputs = session.get_inputs()
+    if image_dir:
+        from preprocessing import preprocess
+        paths = sorted(p for p in Path(image_dir).iterdir()
+                       if p.suffix.lower() in ('.jpg', '.jpeg', '.png', '.bmp'))[:num_samples]
+        return [{model_inputs[0].name: preprocess(str(p))} for p in paths]
+
+    rng = np.random.default_rng(seed)
+    samples = []
+    for _ in range(num_samples):
+        feed = {}
+        for model_input in model_inputs:
+            shape = [d if isinstance(d, int) and d > 0 else 1 for d in model_input.shape]
+            feed[model_input.name] = rng.standard_normal(shape, dtype=np.float32)
+        samples.append(feed)
+    return samples
+
+
+def check_equivalence(reference_path, candidate_path, num_samples=4, image_dir=None, rtol=1e-3, atol=1e-4):
+    """
+    比對兩個模型對相同輸入的輸出
+
+    Returns:
+        是否在容許誤差內（且 top-1 預測一致）
+    """
+    # 關閉 ORT 圖優化，比對的才是計算圖本身
+    reference = create_session(reference_path, graph_opt_level='disable', cache_dir=None)
+    candidate = create_session(candidate_path, graph_opt_level='disable', cache_dir=None)
+
+    samples = make_inputs(reference, num_samples, image_dir)
+    if not samples:
+        print("⚠️  沒有可用的比對輸入")
+        return False
+
+    max_diff = 0.0
+    mismatched = 0
+    close = True
+    for feed in samples:
+        expected = reference.run(None, feed)
+        actual = candidate.run(None, feed)
+        for e, a in zip(expected, actual):
+            max_diff = max(max_diff, float(np.abs(e - a).max()))
+            close = close and np.allclose(e, a, rtol=rtol, atol=atol)
+        if expected[0].ndim == 2:
+            mismatched += int((expected[0].argmax(axis=1) != actual[0].argmax(axis=1)).sum())
+
+    print(f"  比對 {len(samples)} 組輸入: 最大絕對誤差 {max_diff:.3e}，top-1 不一致 {mismatched} 個")
+    return close and mismatched == 0
+
 
 def optimize_onnx(input_path, output_path):
     """載入並優化 ONNX 模型"""
     print(f"正在載入模型: {input_path}")
     model = onnx.load(input_path)
-    
+
     print(f"模型 IR 版本: {model.ir_version}")
     print(f"模型 Opset 版本: {model.opset_import[0].version if model.opset_import else 'N/A'}")
-    
+
     # 檢查模型
     try:
         onnx.checker.check_model(model)
         print("✓ 模型驗證通過")
     except Exception as e:
         print(f"⚠ 模型驗證警告: {e}")
-    
-    # 基本優化：確保模型結構正確
-    # 注意：這裡只做基本的檢查和保存，實際的 Kneron 特定優化
-    # 需要在 Kneron 工具鏈中完成，但由於版本兼容性問題暫時跳過
-    
-    print(f"正在保存優化後的模型: {output_path}")
+
+    before = count_ops(model)
+    print("\n正在套用優化規則...")
+    run_passes(model, slim_passes(), base_dir=os.path.dirname(os.path.abspath(input_path)))
+    print_op_changes(before, count_ops(model))
+
+    print(f"\n正在保存優化後的模型: {output_path}")
     onnx.save(model, output_path)
     print("✓ 模型已保存")
-    
+
     # 驗證輸出模型
     try:
         output_model = onnx.load(output_path)
@@ -37,12 +125,36 @@ def optimize_onnx(input_path, output_path):
     except Exception as e:
         print(f"⚠ 輸出模型驗證警告: {e}")
 
-if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("使用方法: python optimize_onnx.py <input.onnx> <output.onnx>")
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 ONNX 計算圖精簡與數值等價驗證')
+    parser.add_argument('input', help='輸入模型路徑')
+    parser.add_argument('output', help='輸出模型路徑')
+    parser.add_argument('--no-check', action='store_true', help='不做數值等價驗證')
+    parser.add_argument('--images', type=str, default=None,
+                        help='使用此資料夾中的圖片做等價驗證 (預設: 隨機輸入)')
+    parser.add_argument('--samples', type=int, default=4, help='等價驗證的輸入數量 (預設: 4)')
+    parser.add_argument('--rtol', type=float, default=1e-3, help='相對誤差容許值 (預設: 1e-3)')
+    parser.add_argument('--atol', type=float, default=1e-4, help='絕對誤差容許值 (預設: 1e-4)')
+    args = parser.parse_args()
+
+    optimize_onnx(args.input, args.output)
+
+    if args.no_check:
+        return
+    print("\n正在驗證數值等價...")
+    try:
+        equivalent = check_equivalence(args.input, args.output, args.samples, args.images,
+                                       rtol=args.rtol, atol=args.atol)
+    except Exception as e:
+        print(f"❌ 等價驗證失敗: {e}")
+        sys.exit(1)
+    if equivalent:
+        print("✓ 優化前後輸出一致")
+    else:
+        print("❌ 優化前後輸出不一致")
         sys.exit(1)
-    
-    input_path = sys.argv[1]
-    output_path = sys.argv[2]
-    optimize_onnx(input_path, output_path)
 
+
+if __name__ == "__main__":
+    main()
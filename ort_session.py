@@ -0,0 +1,212 @@
+"""
+ONNX Runtime Session 工廠
+統一設定 SessionOptions（執行緒數、執行模式、圖優化等級、記憶體 arena），
+並將 ORT 優化後的計算圖存到磁碟，之後的執行直接載入，縮短冷啟動時間
+
+優化圖快取的 key 包含：模型檔內容、外部權重檔 (.data) 的大小與修改時間、
+onnxruntime 版本、圖優化等級、Execution Providers 與 CPU（架構、型號、指令集）；任何一項改變都會重新優化。
+ORT 序列化的優化圖可能含有硬體相關的優化，主機與 Docker 容器共用 .ort_cache 時也不會誤用對方的快取
+"""
+import hashlib
+import os
+import platform
+
+import onnxruntime as rt
+
+DEFAULT_CACHE_DIR = '.ort_cache'
+
+GRAPH_OPT_LEVELS = {
+    'disable': rt.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': rt.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    'sequential': rt.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': rt.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def add_session_args(parser):
+    """在 argparse parser 中加入 ONNX Runtime 相關參數"""
+    group = parser.add_argument_group('ONNX Runtime 設定')
+    group.add_argument(
+        '--intra-op-threads',
+        type=int,
+        default=0,
+        help='單一運算子內部使用的執行緒數，0 表示由 ORT 決定 (預設: 0)'
+    )
+    group.add_argument(
+        '--inter-op-threads',
+        type=int,
+        default=0,
+        help='運算子之間平行執行的執行緒數，僅在 --execution-mode parallel 時有效 (預設: 0)'
+    )
+    group.add_argument(
+        '--execution-mode',
+        choices=sorted(EXECUTION_MODES),
+        default='sequential',
+        help='計算圖執行模式 (預設: sequential)'
+    )
+    group.add_argument(
+        '--graph-opt-level',
+        choices=list(GRAPH_OPT_LEVELS),
+        default='all',
+        help='ORT 圖優化等級 (預設: all)'
+    )
+    group.add_argument(
+        '--no-mem-arena',
+        action='store_true',
+        help='停用 CPU 記憶體 arena（降低常駐記憶體，但配置較慢）'
+    )
+    group.add_argument(
+        '--no-mem-pattern',
+        action='store_true',
+        help='停用記憶體配置模式預測（輸入形狀經常變動時可使用）'
+    )
+    group.add_argument(
+        '--opt-cache-dir',
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help=f'ORT 優化圖快取目錄 (預設: {DEFAULT_CACHE_DIR})'
+    )
+    group.add_argument(
+        '--no-opt-cache',
+        action='store_true',
+        help='不使用優化圖快取，每次都重新優化'
+    )
+    return group
+
+
+def session_kwargs_from_args(args):
+    """將 add_session_args() 解析出的參數轉為 create_session() 的關鍵字參數"""
+    return {
+        'intra_op_threads': args.intra_op_threads,
+        'inter_op_threads': args.inter_op_threads,
+        'execution_mode': args.execution_mode,
+        'graph_opt_level': args.graph_opt_level,
+        'enable_mem_arena': not args.no_mem_arena,
+        'enable_mem_pattern': not args.no_mem_pattern,
+        'cache_dir': None if args.no_opt_cache else args.opt_cache_dir,
+    }
+
+
+def build_session_options(intra_op_threads=0, inter_op_threads=0, execution_mode='sequential',
+                          graph_opt_level='all', enable_mem_arena=True, enable_mem_pattern=True):
+    """建立 SessionOptions"""
+    options = rt.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = EXECUTION_MODES[execution_mode]
+    options.graph_optimization_level = GRAPH_OPT_LEVELS[graph_opt_level]
+    options.enable_cpu_mem_arena = enable_mem_arena
+    options.enable_mem_pattern = enable_mem_pattern
+    return options
+
+
+def _external_data_files(model_path):
+    """列出模型引用的外部權重檔（只讀取計算圖，不載入權重）"""
+    import onnx
+
+    model = onnx.load(model_path, load_external_data=False)
+    locations = set()
+    for tensor in model.graph.initializer:
+        for entry in tensor.external_data:
+            if entry.key == 'location':
+                locations.add(entry.value)
+    base_dir = os.path.dirname(os.path.abspath(model_path))
+    return [os.path.join(base_dir, location) for location in sorted(locations)]
+
+
+def cpu_fingerprint():
+    """目前 CPU 的描述字串：OS、架構、型號與指令集旗標（Linux 讀取 /proc/cpuinfo）"""
+    model = platform.processor()
+    flags = ''
+    try:
+        with open('/proc/cpuinfo', 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key in ('model name', 'Processor', 'CPU implementer', 'CPU part') and not model:
+                    model = value.strip()
+                elif key in ('flags', 'Features') and not flags:
+                    flags = ' '.join(sorted(value.split()))
+                if model and flags:
+                    break
+    except OSError:
+        pass
+    return f'{platform.system()};{platform.machine()};{model};{hashlib.sha256(flags.encode()).hexdigest()[:16]}'
+
+
+def optimized_cache_path(model_path, cache_dir, graph_opt_level='all', providers=None):
+    """計算模型對應的優化圖快取路徑"""
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    for data_path in _external_data_files(model_path):
+        if os.path.exists(data_path):
+            stat = os.stat(data_path)
+            digest.update(f'{os.path.basename(data_path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    digest.update(f'ort={rt.__version__};level={graph_opt_level}'.encode())
+    digest.update(f';providers={providers or []};cpu={cpu_fingerprint()}'.encode())
+
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, f'{stem}.{digest.hexdigest()[:16]}.{graph_opt_level}.onnx')
+
+
+def create_session(model_path, intra_op_threads=0, inter_op_threads=0, execution_mode='sequential',
+                   graph_opt_level='all', enable_mem_arena=True, enable_mem_pattern=True,
+                   cache_dir=DEFAULT_CACHE_DIR, providers=None):
+    """
+    建立 ONNX Runtime InferenceSession
+
+    cache_dir 不為 None 時：
+      - 快取存在：直接載入已優化的計算圖，並關閉 ORT 圖優化
+      - 快取不存在：正常優化，並透過 optimized_model_filepath 寫入快取
+
+    Args:
+        model_path: ONNX 模型路徑
+        cache_dir: 優化圖快取目錄，None 表示不使用快取
+        providers: Execution Providers，預設 ['CPUExecutionProvider']
+        其餘參數見 build_session_options()
+
+    Returns:
+        onnxruntime.InferenceSession
+    """
+    providers = providers or ['CPUExecutionProvider']
+    options_kwargs = dict(
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=inter_op_threads,
+        execution_mode=execution_mode,
+        enable_mem_arena=enable_mem_arena,
+        enable_mem_pattern=enable_mem_pattern,
+    )
+
+    if cache_dir is None or graph_opt_level == 'disable':
+        options = build_session_options(graph_opt_level=graph_opt_level, **options_kwargs)
+        return rt.InferenceSession(model_path, sess_options=options, providers=providers)
+
+    cache_path = optimized_cache_path(model_path, cache_dir, graph_opt_level, providers)
+    if os.path.exists(cache_path):
+        options = build_session_options(graph_opt_level='disable', **options_kwargs)
+        try:
+            return rt.InferenceSession(cache_path, sess_options=options, providers=providers)
+        except Exception as e:
+            print(f"⚠️  優化圖快取無法載入，重新優化: {e}")
+            os.remove(cache_path)
+
+    # 先寫到暫存檔，session 建立成功後再改名，避免中斷時留下不完整的快取
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    options = build_session_options(graph_opt_level=graph_opt_level, **options_kwargs)
+    options.optimized_model_filepath = tmp_path
+    try:
+        session = rt.InferenceSession(model_path, sess_options=options, providers=providers)
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return session
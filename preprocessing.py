@@ -0,0 +1,198 @@
+"""
+共用圖片預處理模組
+與訓練時 (train_resnet50.py 的 'val' transforms) 的預處理一致：
+調整大小 256x256 -> 中心裁切 224x224 -> 標準化 -> CHW
+
+標準化 (x / 255 - mean) / std 預先展開為 x * SCALE + BIAS，
+直接從 uint8 寫入呼叫端提供的 float32 batch 陣列，不產生額外的暫存陣列
+
+JPEG 預設使用縮小解碼 (draft)：解碼器直接輸出 1/2、1/4 或 1/8 尺寸中
+仍大於等於 256x256 的最小者，再做精確的 resize，大圖不必完整解碼。
+與完整解碼的差異可用以下指令驗證（容許誤差見 DRAFT_TOLERANCE）：
+    python preprocessing.py --verify-draft data/val [-m model.onnx]
+"""
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+RESIZE_SIZE = 256
+CROP_SIZE = 224
+
+# JPEG 縮小解碼 (draft)；False 時與舊版一樣完整解碼
+DRAFT_DECODE = True
+# 縮小解碼與完整解碼之間，每張圖片標準化後張量的平均絕對誤差上限
+# （約 3 個灰階值；data/ 上實測最大 0.042，99% 的圖片低於 0.015）
+DRAFT_TOLERANCE = 0.05
+
+# 標準化 (Normalize) mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
+MEAN = np.array([0.485, 0.456, 0.406], dtype='float32')
+STD = np.array([0.229, 0.224, 0.225], dtype='float32')
+
+# 預先計算的 scale/bias：(x / 255 - mean) / std = x * SCALE + BIAS
+SCALE = (1.0 / (255.0 * STD)).astype('float32')
+BIAS = (-MEAN / STD).astype('float32')
+
+# 圖片副檔名（全專案共用），與 torchvision.datasets.ImageFolder 相同 (torchvision.datasets.folder.IMG_EXTENSIONS)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+
+
+def preprocess_signature():
+    """
+    目前預處理參數的描述字串
+    任何會改變輸出張量的參數都必須列在這裡（tensor_cache 以此作為快取 key 的一部分）
+    """
+    return (f"resize={RESIZE_SIZE};crop={CROP_SIZE};draft={DRAFT_DECODE};"
+            f"mean={MEAN.tolist()};std={STD.tolist()};layout=CHW;dtype=float32")
+
+
+def load_image(image_path, draft=None):
+    """
+    讀取圖片並完成調整大小與中心裁切
+
+    Args:
+        image_path: 圖片路徑或檔案物件
+        draft: 是否使用 JPEG 縮小解碼，None 表示使用 DRAFT_DECODE
+
+    Returns:
+        uint8 陣列，形狀 (224, 224, 3)，HWC / RGB
+    """
+    img = Image.open(image_path)
+    if DRAFT_DECODE if draft is None else draft:
+        # 只對 JPEG 有效：以最小且兩邊都 >= 256 的縮放比例解碼，其他格式不受影響
+        img.draft('RGB', (RESIZE_SIZE, RESIZE_SIZE))
+    img = img.convert('RGB')
+    img = img.resize((RESIZE_SIZE, RESIZE_SIZE))
+
+    # Center Crop 224x224
+    left = (RESIZE_SIZE - CROP_SIZE) / 2
+    top = (RESIZE_SIZE - CROP_SIZE) / 2
+    right = (RESIZE_SIZE + CROP_SIZE) / 2
+    bottom = (RESIZE_SIZE + CROP_SIZE) / 2
+    img = img.crop((left, top, right, bottom))
+
+    return np.asarray(img, dtype=np.uint8)
+
+
+def normalize_into(img, out):
+    """
+    將 uint8 HWC 圖片標準化並以 CHW 寫入 out
+
+    Args:
+        img: uint8 陣列，形狀 (H, W, 3)
+        out: float32 陣列，形狀 (3, H, W)，通常是 batch 陣列中的一格 (batch[i])
+
+    Returns:
+        out
+    """
+    for c in range(3):
+        # 每個通道：一次乘法 (uint8 -> float32) + 一次原地加法
+        np.multiply(img[:, :, c], SCALE[c], out=out[c])
+        np.add(out[c], BIAS[c], out=out[c])
+    return out
+
+
+def new_batch(batch_size):
+    """建立 (batch_size, 3, 224, 224) 的 float32 batch 陣列（未初始化）"""
+    return np.empty((batch_size, 3, CROP_SIZE, CROP_SIZE), dtype=np.float32)
+
+
+def preprocess_into(image_path, batch, index):
+    """
+    讀取圖片並直接寫入 batch[index]
+
+    Returns:
+        batch[index]
+    """
+    return normalize_into(load_image(image_path), batch[index])
+
+
+def preprocess(image_path):
+    """
+    預處理單張圖片
+
+    Returns:
+        float32 陣列，形狀 (1, 3, 224, 224)
+    """
+    batch = new_batch(1)
+    preprocess_into(image_path, batch, 0)
+    return batch
+
+
+def verify_draft(image_paths, model_path=None, tolerance=DRAFT_TOLERANCE):
+    """
+    比較縮小解碼與完整解碼的預處理結果
+
+    Args:
+        image_paths: 圖片路徑列表
+        model_path: 若提供，另外比較兩者的模型預測是否一致
+        tolerance: 每張圖片平均絕對誤差的上限
+
+    Returns:
+        是否全部通過
+    """
+    session = None
+    if model_path:
+        from ort_session import create_session
+        session = create_session(model_path)
+        input_name = session.get_inputs()[0].name
+
+    full = new_batch(1)
+    reduced = new_batch(1)
+    errors = []
+    failures = []
+    mismatches = []
+    max_logit_diff = 0.0
+    for image_path in image_paths:
+        normalize_into(load_image(image_path, draft=False), full[0])
+        normalize_into(load_image(image_path, draft=True), reduced[0])
+        error = float(np.abs(full - reduced).mean())
+        errors.append(error)
+        if error > tolerance:
+            failures.append((image_path, error))
+        if session is not None:
+            logits_full = session.run(None, {input_name: full})[0][0]
+            logits_reduced = session.run(None, {input_name: reduced})[0][0]
+            max_logit_diff = max(max_logit_diff, float(np.abs(logits_full - logits_reduced).max()))
+            if logits_full.argmax() != logits_reduced.argmax():
+                mismatches.append(image_path)
+
+    errors = np.array(errors)
+    print(f"圖片數量: {len(errors)}")
+    print(f"平均絕對誤差: 平均 {errors.mean():.5f}，P99 {np.percentile(errors, 99):.5f}，"
+          f"最大 {errors.max():.5f} (容許 {tolerance})")
+    for image_path, error in failures:
+        print(f"  ✗ {image_path}: {error:.5f}")
+    if session is not None:
+        print(f"模型輸出最大差異: {max_logit_diff:.5f}，預測不一致: {len(mismatches)} 張")
+        for image_path in mismatches:
+            print(f"  ✗ {image_path}")
+
+    passed = not failures and not mismatches
+    print("✓ 驗證通過" if passed else "✗ 驗證失敗")
+    return passed
+
+
+if __name__ == "__main__":
+    # 設置輸出編碼（Windows 兼容）
+    if sys.platform == 'win32':
+        import io
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+
+    parser = argparse.ArgumentParser(description='驗證 JPEG 縮小解碼與完整解碼的預處理差異')
+    parser.add_argument('--verify-draft', required=True, metavar='DIR',
+                        help='圖片資料夾（遞迴搜尋 .jpg/.jpeg）')
+    parser.add_argument('-m', '--model', default=None, help='另外比較此模型的預測是否一致')
+    parser.add_argument('--tolerance', type=float, default=DRAFT_TOLERANCE,
+                        help=f'每張圖片平均絕對誤差的上限 (預設: {DRAFT_TOLERANCE})')
+    args = parser.parse_args()
+
+    paths = sorted(p for ext in ('jpg', 'jpeg', 'JPG', 'JPEG')
+                   for p in glob.glob(os.path.join(args.verify_draft, '**', f'*.{ext}'), recursive=True))
+    if not paths:
+        print(f"❌ 錯誤：在 {args.verify_draft} 中找不到 JPEG 圖片")
+        sys.exit(1)
+    sys.exit(0 if verify_draft(paths, args.model, args.tolerance) else 1)
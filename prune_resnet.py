@@ -0,0 +1,212 @@
+"""
+ResNet Bottleneck 的結構化通道剪枝
+只剪 Bottleneck 內部的寬度（conv1 / conv2 的輸出通道），block 的輸入輸出通道保持不變，
+所以殘差相加與 downsample 分支都不需要修改。被剪掉的通道會真的從權重中移除，
+匯出的 ONNX 檔案與運算量都會跟著變小
+
+通道重要性預設使用 BatchNorm 的 |gamma|（Network Slimming），
+每層先除以該層平均值再做全域排序，避免不同層的尺度差異影響選擇
+"""
+import copy
+
+import torch
+import torch.nn as nn
+from torchvision.models.resnet import Bottleneck
+
+# 依 flops_ratio 搜尋時稀疏度的上限
+MAX_SPARSITY = 0.95
+
+
+def count_flops(model, input_size=(1, 3, 224, 224)):
+    """
+    以 forward hook 計算 Conv2d 與 Linear 的乘加次數 (MACs)
+
+    Returns:
+        (MACs, 參數數量)
+    """
+    macs = 0
+
+    def conv_hook(module, inputs, output):
+        nonlocal macs
+        kernel = module.kernel_size[0] * module.kernel_size[1] * (module.in_channels // module.groups)
+        macs += output.numel() * kernel
+
+    def linear_hook(module, inputs, output):
+        nonlocal macs
+        macs += output.numel() * module.in_features
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros(input_size, device=device))
+    model.train(was_training)
+    for handle in handles:
+        handle.remove()
+    return macs, sum(p.numel() for p in model.parameters())
+
+
+def _prunable_layers(model):
+    """每個 Bottleneck 中可剪的 (conv, bn, 下一層 conv)"""
+    layers = []
+    for module in model.modules():
+        if isinstance(module, Bottleneck):
+            layers.append((module, 'conv1', 'bn1', 'conv2'))
+            layers.append((module, 'conv2', 'bn2', 'conv3'))
+    return layers
+
+
+def channel_importance(model, criterion='bn'):
+    """
+    每個可剪層的通道重要性（已除以該層平均值）
+
+    Args:
+        criterion: 'bn' 使用 |gamma|，'l1' 使用卷積核的 L1 norm
+    """
+    scores = []
+    for block, conv_name, bn_name, _ in _prunable_layers(model):
+        if criterion == 'bn':
+            score = getattr(block, bn_name).weight.detach().abs()
+        else:
+            score = getattr(block, conv_name).weight.detach().abs().sum(dim=(1, 2, 3))
+        scores.append(score / (score.mean() + 1e-12))
+    return scores
+
+
+def select_channels(scores, sparsity, min_channels=8, round_to=8):
+    """
+    依全域門檻決定每層保留的通道
+
+    保留數量至少 min_channels，並向上取整到 round_to 的倍數（NPU 以 8 通道為單位處理）
+
+    Returns:
+        每層保留的通道索引（已排序）
+    """
+    all_scores = torch.cat(scores)
+    num_pruned = int(len(all_scores) * sparsity)
+    threshold = all_scores.sort().values[num_pruned - 1] if num_pruned > 0 else -1.0
+
+    keep = []
+    for score in scores:
+        count = int((score > threshold).sum())
+        count = max(count, min_channels)
+        count = min(len(score), -(-count // round_to) * round_to)
+        keep.append(score.argsort(descending=True)[:count].sort().values)
+    return keep
+
+
+def _slice_conv(conv, out_index=None, in_index=None):
+    weight = conv.weight.detach()
+    if out_index is not None:
+        weight = weight[out_index]
+    if in_index is not None:
+        weight = weight[:, in_index]
+    new_conv = nn.Conv2d(weight.shape[1] * conv.groups, weight.shape[0], conv.kernel_size,
+                         stride=conv.stride, padding=conv.padding, dilation=conv.dilation,
+                         groups=conv.groups, bias=conv.bias is not None).to(weight.device)
+    new_conv.weight.data.copy_(weight)
+    if conv.bias is not None:
+        bias = conv.bias.detach()
+        new_conv.bias.data.copy_(bias[out_index] if out_index is not None else bias)
+    return new_conv
+
+
+def _slice_bn(bn, index):
+    new_bn = nn.BatchNorm2d(len(index), eps=bn.eps, momentum=bn.momentum).to(bn.weight.device)
+    new_bn.weight.data.copy_(bn.weight.detach()[index])
+    new_bn.bias.data.copy_(bn.bias.detach()[index])
+    new_bn.running_mean.copy_(bn.running_mean[index])
+    new_bn.running_var.copy_(bn.running_var[index])
+    new_bn.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return new_bn
+
+
+def apply_pruning(model, keep):
+    """依 select_channels() 的結果原地替換各層（權重實際變小）"""
+    for (block, conv_name, bn_name, next_name), index in zip(_prunable_layers(model), keep):
+        setattr(block, conv_name, _slice_conv(getattr(block, conv_name), out_index=index))
+        setattr(block, bn_name, _slice_bn(getattr(block, bn_name), index))
+        setattr(block, next_name, _slice_conv(getattr(block, next_name), in_index=index))
+    return model
+
+
+def min_flops_ratio(model, criterion='bn', min_channels=8, round_to=8):
+    """
+    以最大稀疏度 (MAX_SPARSITY) 剪枝時 MACs 與原本的比例，也就是 flops_ratio 能達到的下限
+    （stem 與 downsample 卷積不會被剪枝）
+    """
+    base_macs, _ = count_flops(model)
+    candidate = copy.deepcopy(model)
+    apply_pruning(candidate, select_channels(channel_importance(model, criterion), MAX_SPARSITY,
+                                             min_channels, round_to))
+    return count_flops(candidate)[0] / base_macs
+
+
+def prune_model(model, sparsity=None, flops_ratio=None, criterion='bn', min_channels=8, round_to=8):
+    """
+    剪枝到指定的通道稀疏度，或剪到 MACs 不超過原本的 flops_ratio 倍
+
+    指定 flops_ratio 時以二分搜尋找出最小的稀疏度
+
+    Returns:
+        (剪枝後的模型, 統計 dict)
+
+    Raises:
+        ValueError: flops_ratio 低於最大稀疏度能達到的比例（模型不會被修改）
+    """
+    if sparsity is None and flops_ratio is None:
+        raise ValueError("需要指定 sparsity 或 flops_ratio")
+
+    base_macs, base_params = count_flops(model)
+    scores = channel_importance(model, criterion)
+
+    def pruned_copy(target_sparsity):
+        candidate = copy.deepcopy(model)
+        apply_pruning(candidate, select_channels(scores, target_sparsity, min_channels, round_to))
+        return candidate
+
+    if sparsity is None:
+        lowest, _ = count_flops(pruned_copy(MAX_SPARSITY))
+        if lowest > base_macs * flops_ratio:
+            raise ValueError(f"無法剪到 MACs {flops_ratio:.0%}：稀疏度 {MAX_SPARSITY} 時仍為原本的 "
+                             f"{lowest / base_macs:.1%}（stem 與 downsample 卷積不剪枝）")
+        low, high = 0.0, MAX_SPARSITY
+        for _ in range(12):
+            middle = (low + high) / 2
+            macs, _ = count_flops(pruned_copy(middle))
+            if macs <= base_macs * flops_ratio:
+                high = middle
+            else:
+                low = middle
+        sparsity = high
+
+    keep = select_channels(scores, sparsity, min_channels, round_to)
+    apply_pruning(model, keep)
+    macs, params = count_flops(model)
+    total = sum(len(s) for s in scores)
+    stats = {
+        'sparsity': sparsity,
+        'channels_before': total,
+        'channels_after': sum(len(k) for k in keep),
+        'macs_before': base_macs,
+        'macs_after': macs,
+        'params_before': base_params,
+        'params_after': params,
+    }
+    return model, stats
+
+
+def print_pruning_stats(stats):
+    print(f"  通道: {stats['channels_before']} → {stats['channels_after']} "
+          f"(稀疏度 {stats['sparsity']:.2f})")
+    print(f"  MACs: {stats['macs_before'] / 1e9:.2f} G → {stats['macs_after'] / 1e9:.2f} G "
+          f"({stats['macs_after'] / stats['macs_before'] * 100:.1f}%)")
+    print(f"  參數: {stats['params_before'] / 1e6:.2f} M → {stats['params_after'] / 1e6:.2f} M "
+          f"({stats['params_after'] * 4 / (1024 * 1024):.1f} MB float32)")
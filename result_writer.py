@@ -0,0 +1,145 @@
+"""
+批量推論結果的串流輸出 (JSONL / CSV)
+每完成一個 batch 就寫入並 flush，程式中途中斷也只會遺失最後一個 batch；
+--resume 時讀取既有的輸出檔，跳過已成功完成的圖片，並接續寫在檔案後面
+
+輸出欄位:
+    file          圖片路徑
+    class         預測類別名稱（失敗時為 ERROR）
+    class_index   預測類別索引（失敗時為 -1）
+    confidence    置信度 (0-1)
+    probabilities 各類別概率（CSV 展開為 prob_0, prob_1, ...）
+    logits        原始輸出（CSV 展開為 logit_0, logit_1, ...）
+    batch_size    該圖片所在 batch 的圖片數
+    infer_ms      session.run 時間平均到每張圖片 (毫秒)
+    error         錯誤訊息（成功時為空）
+"""
+import csv
+import json
+import os
+
+ERROR_CLASS = 'ERROR'
+
+
+def detect_format(path):
+    """依副檔名判斷輸出格式：.csv 為 CSV，其他為 JSONL"""
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def _truncate_partial_line(path):
+    """移除檔案結尾不完整的一行（上次寫到一半被中斷）"""
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        # 往前找最後一個換行
+        pos = size - 1
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            idx = chunk.rfind(b'\n')
+            if idx >= 0:
+                f.truncate(pos - step + idx + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+
+class ResultWriter:
+    """
+    逐行寫出推論結果
+
+    Args:
+        path: 輸出檔路徑（.jsonl 或 .csv）
+        num_classes: 類別數量
+        resume: True 時保留既有內容並載入已完成的圖片，False 時覆寫
+
+    Attributes:
+        completed: 已成功完成的圖片路徑集合（resume 時從檔案載入）
+        class_counts: 已成功完成的各類別數量（含 resume 載入的部分）
+    """
+
+    def __init__(self, path, num_classes, resume=False):
+        self.path = path
+        self.format = detect_format(path)
+        self.num_classes = num_classes
+        self.completed = set()
+        self.class_counts = {}
+        self.error_count = 0
+
+        resuming = resume and os.path.exists(path) and os.path.getsize(path) > 0
+        if resuming:
+            _truncate_partial_line(path)
+            self._load_completed()
+        self._file = open(path, 'a' if resuming else 'w', encoding='utf-8', newline='')
+        if self.format == 'csv':
+            self._csv = csv.writer(self._file)
+            if not resuming or os.path.getsize(path) == 0:
+                self._csv.writerow(self._csv_header())
+
+    def _csv_header(self):
+        return (['file', 'class', 'class_index', 'confidence']
+                + [f'prob_{i}' for i in range(self.num_classes)]
+                + [f'logit_{i}' for i in range(self.num_classes)]
+                + ['batch_size', 'infer_ms', 'error'])
+
+    def _load_completed(self):
+        """讀取既有輸出，記錄已成功的圖片（失敗的圖片會重新處理）"""
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            if self.format == 'csv':
+                rows = csv.DictReader(f)
+            else:
+                rows = (json.loads(line) for line in f if line.strip())
+            for row in rows:
+                if row['class'] == ERROR_CLASS:
+                    continue
+                self.completed.add(row['file'])
+                self.class_counts[row['class']] = self.class_counts.get(row['class'], 0) + 1
+
+    def write(self, file, predicted_class=None, class_index=-1, confidence=0.0,
+              probabilities=(), logits=(), batch_size=0, infer_ms=0.0, error=None):
+        """寫出一張圖片的結果；predicted_class 為 None 或 error 不為空時視為失敗"""
+        if error is not None or predicted_class is None:
+            predicted_class = ERROR_CLASS
+            self.error_count += 1
+        else:
+            self.class_counts[predicted_class] = self.class_counts.get(predicted_class, 0) + 1
+        probabilities = [float(p) for p in probabilities]
+        logits = [float(v) for v in logits]
+
+        if self.format == 'csv':
+            pad = [''] * (self.num_classes - len(probabilities))
+            self._csv.writerow(
+                [file, predicted_class, int(class_index), float(confidence)]
+                + probabilities + pad + logits + [''] * (self.num_classes - len(logits))
+                + [int(batch_size), round(float(infer_ms), 4), error or '']
+            )
+        else:
+            self._file.write(json.dumps({
+                'file': file,
+                'class': predicted_class,
+                'class_index': int(class_index),
+                'confidence': float(confidence),
+                'probabilities': probabilities,
+                'logits': logits,
+                'batch_size': int(batch_size),
+                'infer_ms': round(float(infer_ms), 4),
+                'error': error,
+            }, ensure_ascii=False) + '\n')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
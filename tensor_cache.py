@@ -0,0 +1,186 @@
+"""
+預處理張量的磁碟快取（content-addressed）
+以「圖片檔內容的 SHA-256 + 預處理參數」作為 key，
+將最終的 (3, 224, 224) float32 張量存在記憶體映射的 .npy shard 中，
+重複評估時直接從 page cache 讀取，不需重新解碼 JPEG
+
+檔案結構 (cache_dir/):
+    tensors.npy  (capacity, 3, 224, 224) float32，每格存放一張圖片的張量
+    keys.npy     (capacity,) S64，每格目前存放的 key（空字串表示空格）
+    index.json   LRU 順序與 shard 設定
+
+keys.npy 是每一格內容的唯一依據：寫入新張量前先清除該格的 key，
+寫入完成後再填入，因此中途中斷也不會讀到錯誤的張量；
+index.json 只記錄 LRU 順序，遺失時會從 keys.npy 重建
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from preprocessing import CROP_SIZE, load_image, normalize_into, preprocess_signature
+
+DEFAULT_CACHE_DIR = '.tensor_cache'
+DEFAULT_MAX_BYTES = 256 << 20  # 256 MB，約 440 張 224x224 張量
+
+TENSOR_SHAPE = (3, CROP_SIZE, CROP_SIZE)
+TENSOR_BYTES = int(np.prod(TENSOR_SHAPE)) * 4
+
+
+def file_digest(path):
+    """計算檔案內容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TensorCache:
+    """
+    大小有上限、LRU 淘汰的預處理張量快取
+
+    Args:
+        cache_dir: 快取目錄
+        max_bytes: shard 大小上限，決定可存放的張量數量
+
+    get() / load() 回傳的是 shard 的記憶體映射 view（不複製），
+    在之後又寫入 capacity 張新張量之前都保持有效；需要長期保存請自行複製
+
+    同一個快取目錄同時只能由一個程序使用；同一程序內可由多個執行緒共用
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.capacity = max(1, max_bytes // TENSOR_BYTES)
+        self.signature = preprocess_signature()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._tensors_path = os.path.join(cache_dir, 'tensors.npy')
+        self._keys_path = os.path.join(cache_dir, 'keys.npy')
+        self._index_path = os.path.join(cache_dir, 'index.json')
+        self._open_shard()
+
+    # ------------------------------------------------------------------
+    # shard 與 index
+    # ------------------------------------------------------------------
+    def _open_shard(self):
+        """開啟（或重建）記憶體映射 shard，並依 index.json 還原 LRU 順序"""
+        shape = (self.capacity,) + TENSOR_SHAPE
+        try:
+            tensors = np.lib.format.open_memmap(self._tensors_path, mode='r+')
+            keys = np.lib.format.open_memmap(self._keys_path, mode='r+')
+            if tensors.shape != shape or tensors.dtype != np.float32 or keys.shape != (self.capacity,):
+                raise ValueError('shard 大小與設定不符')
+        except (OSError, ValueError):
+            # 不存在或設定改變：重建空的 shard
+            tensors = np.lib.format.open_memmap(self._tensors_path, mode='w+', dtype=np.float32, shape=shape)
+            keys = np.lib.format.open_memmap(self._keys_path, mode='w+', dtype='S64', shape=(self.capacity,))
+            keys[:] = b''
+        self._tensors = tensors
+        self._keys = keys
+
+        # key -> slot，依 LRU 順序排列（最前面最久未使用）
+        stored = {k.decode(): slot for slot, k in enumerate(keys.tolist()) if k}
+        order = []
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                order = json.load(f).get('lru', [])
+        except (OSError, ValueError):
+            pass
+        self._lru = OrderedDict()
+        for key in order:
+            if key in stored:
+                self._lru[key] = stored.pop(key)
+        for key, slot in stored.items():
+            self._lru[key] = slot
+            self._lru.move_to_end(key, last=False)
+        used = set(self._lru.values())
+        self._free = [slot for slot in range(self.capacity - 1, -1, -1) if slot not in used]
+
+    def flush(self):
+        """將 shard 寫回磁碟並保存 LRU 順序"""
+        with self._lock:
+            self._tensors.flush()
+            self._keys.flush()
+            index = {
+                'capacity': self.capacity,
+                'signature': self.signature,
+                'lru': list(self._lru),
+            }
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._lru)
+
+    # ------------------------------------------------------------------
+    # 存取
+    # ------------------------------------------------------------------
+    def key_for(self, image_path):
+        """快取 key：圖片內容雜湊 + 預處理參數"""
+        digest = hashlib.sha256(f'{file_digest(image_path)}|{self.signature}'.encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """取得快取的張量 view，不存在時回傳 None"""
+        with self._lock:
+            slot = self._lru.get(key)
+            if slot is None or self._keys[slot].decode() != key:
+                return None
+            self._lru.move_to_end(key)
+            return self._tensors[slot]
+
+    def put(self, key, tensor):
+        """寫入張量（必要時淘汰最久未使用的項目），回傳 shard 中的 view"""
+        with self._lock:
+            slot = self._lru.pop(key, None)
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                else:
+                    _, slot = self._lru.popitem(last=False)
+            self._keys[slot] = b''
+            self._tensors[slot] = tensor
+            self._keys[slot] = key.encode()
+            self._lru[key] = slot
+            return self._tensors[slot]
+
+    def load(self, image_path):
+        """
+        取得圖片的預處理張量：命中時直接回傳 shard view，
+        未命中時解碼、預處理並寫入快取
+
+        Returns:
+            float32 陣列，形狀 (3, 224, 224)
+        """
+        key = self.key_for(image_path)
+        tensor = self.get(key)
+        if tensor is not None:
+            self.hits += 1
+            return tensor
+        self.misses += 1
+        tensor = normalize_into(load_image(image_path), np.empty(TENSOR_SHAPE, dtype=np.float32))
+        return self.put(key, tensor)
+
+    def load_into(self, image_path, batch, index):
+        """將圖片的預處理張量複製到 batch[index]"""
+        np.copyto(batch[index], self.load(image_path))
+        return batch[index]
@@ -2,12 +2,13 @@
 簡單的推論測試腳本
 用於快速驗證模型是否正常工作
 """
-import onnxruntime as rt
 import numpy as np
-from PIL import Image
 import os
 import sys
 
+from preprocessing import preprocess
+from ort_session import create_session
+
 # 設置輸出編碼（Windows 兼容）
 if sys.platform == 'win32':
     import io
@@ -40,7 +41,7 @@ if not os.path.exists(TEST_IMAGE):
 
 print(f"\n📦 正在載入模型: {MODEL_PATH}")
 try:
-    session = rt.InferenceSession(MODEL_PATH)
+    session = create_session(MODEL_PATH)
     input_name = session.get_inputs()[0].name
     print(f"✅ 模型載入成功")
     print(f"   輸入名稱: {input_name}")
@@ -53,29 +54,8 @@ except Exception as e:
 
 print(f"\n🖼️  正在讀取圖片: {TEST_IMAGE}")
 try:
-    # 預處理
-    img = Image.open(TEST_IMAGE).convert('RGB')
-    img = img.resize((256, 256))
-    
-    # Center Crop 224x224
-    left = (256 - 224) / 2
-    top = (256 - 224) / 2
-    right = (256 + 224) / 2
-    bottom = (256 + 224) / 2
-    img = img.crop((left, top, right, bottom))
-    
-    # 轉為 numpy array 並標準化
-    img_data = np.array(img).astype('float32') / 255.0
-    
-    # 標準化
-    mean = np.array([0.485, 0.456, 0.406], dtype='float32')
-    std = np.array([0.229, 0.224, 0.225], dtype='float32')
-    img_data = (img_data - mean) / std
-    img_data = img_data.astype('float32')
-    
-    # 調整維度 HWC -> CHW -> BCHW
-    img_data = img_data.transpose(2, 0, 1)
-    img_data = np.expand_dims(img_data, axis=0)
+    # 預處理 (調整大小 -> 中心裁切 -> 標準化 -> BCHW)
+    img_data = preprocess(TEST_IMAGE)
     
     print(f"✅ 圖片預處理完成")
     print(f"   圖片形狀: {img_data.shape}")
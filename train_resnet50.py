@@ -4,63 +4,184 @@ import torch.optim as optim
 from torch.optim import lr_scheduler
 import torchvision
 from torchvision import datasets, models, transforms
+import argparse
 import os
-import copy
+import sys
 import time
 
+from checkpointing import DEFAULT_CHECKPOINT_DIR, AsyncCheckpointer, config_mismatch, load_model_state, \
+    resume_training, save_epoch, snapshot_state, trainable_state_names
+from distill import DEFAULT_ALPHA, DEFAULT_TEMPERATURE, STUDENTS, build_student, distillation_loss, \
+    measure_latency
+from feature_cache import DEFAULT_FEATURE_DIR, DEFAULT_VIEWS, build_feature_store, load_feature_store, \
+    train_fc_on_features
+
 # ==========================================
 # 設定區
 # ==========================================
 # 資料集路徑 (請確認您的資料夾名稱是 data)
-data_dir = 'data'
-# 設定運算裝置 (有 GPU 用 GPU，沒有用 CPU)
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-print(f"使用運算裝置: {device}")
+DATA_DIR = 'data'
+# 匯出的 ONNX 檔名
+ONNX_FILE_NAME = 'ants_bees.onnx'
+PRUNED_ONNX_FILE_NAME = 'ants_bees_pruned.onnx'
+# --bf16-parity：bf16 與 fp32 兩次訓練使用相同的亂數種子（fc 初始化與資料順序相同）
+PARITY_SEED = 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='微調 ResNet50 (螞蟻/蜜蜂) 並匯出 ONNX')
+    parser.add_argument('--data-dir', type=str, default=DATA_DIR, help=f'資料集路徑 (預設: {DATA_DIR})')
+    parser.add_argument('--epochs', type=int, default=5, help='訓練 epoch 數 (預設: 5)')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help=f'ONNX 輸出路徑 (預設: {ONNX_FILE_NAME}，剪枝時為 {PRUNED_ONNX_FILE_NAME}，'
+                             f'蒸餾時為 ants_bees_<student>.onnx)')
+    parser.add_argument('--dynamic-batch', action='store_true', help='匯出動態 batch 維度的 ONNX')
+
+    loader = parser.add_argument_group('資料載入')
+    loader.add_argument('--shards', type=str, default=None,
+                        help='使用 image_shards.py 預先解碼的 shard 資料夾，取代逐張解碼 JPEG')
+    loader.add_argument('--batch-size', type=int, default=4, help='batch 大小 (預設: 4)')
+    loader.add_argument('--num-workers', type=int, default=0, help='DataLoader worker 數 (預設: 0)')
+    loader.add_argument('--persistent-workers', action='store_true',
+                        help='epoch 之間保留 worker 程序（需要 --num-workers > 0）')
+    loader.add_argument('--prefetch-factor', type=int, default=None,
+                        help='每個 worker 預先載入的 batch 數（需要 --num-workers > 0）')
+
+    precision = parser.add_argument_group('混合精度 (選用)')
+    precision.add_argument('--bf16', action='store_true',
+                           help='訓練與評估使用 bfloat16 autocast + channels_last（CPU 需支援 AVX512-BF16/AMX 才會變快）')
+    precision.add_argument('--bf16-parity', action='store_true',
+                           help='另外以 fp32 重新訓練一次（相同亂數種子），比較 bf16 訓練後的驗證準確度（訓練時間加倍）')
+    precision.add_argument('--bf16-tolerance', type=float, default=0.01,
+                           help='--bf16-parity 時 bf16 與 fp32 訓練結果的驗證準確度容許差距 (預設: 0.01)')
+
+    checkpoint = parser.add_argument_group('checkpoint')
+    checkpoint.add_argument('--checkpoint-dir', type=str, default=DEFAULT_CHECKPOINT_DIR,
+                            help=f'checkpoint 目錄（best.pt / last.pt，剪枝微調在 prune/ 子目錄）(預設: {DEFAULT_CHECKPOINT_DIR})')
+    checkpoint.add_argument('--no-checkpoint', action='store_true', help='不寫出 checkpoint')
+    checkpoint.add_argument('--resume', action='store_true', help='從 checkpoint 目錄的 last.pt 接續訓練')
+
+    distill = parser.add_argument_group('知識蒸餾 (選用)')
+    distill.add_argument('--distill', choices=STUDENTS, default=None,
+                         help='以微調好的 ResNet50 為 teacher 蒸餾出較小的 student，並匯出 student')
+    distill.add_argument('--distill-epochs', type=int, default=10, help='蒸餾的 epoch 數 (預設: 10)')
+    distill.add_argument('--distill-lr', type=float, default=0.001, help='蒸餾的學習率 (預設: 0.001)')
+    distill.add_argument('--distill-temperature', type=float, default=DEFAULT_TEMPERATURE,
+                         help=f'soft target 的溫度 (預設: {DEFAULT_TEMPERATURE})')
+    distill.add_argument('--distill-alpha', type=float, default=DEFAULT_ALPHA,
+                         help=f'soft target loss 的權重，其餘為真實標籤的 CE (預設: {DEFAULT_ALPHA})')
+
+    features = parser.add_argument_group('特徵快取 (選用)')
+    features.add_argument('--cached-features', action='store_true',
+                          help='backbone 特徵只算一次並快取，fc 直接在特徵上訓練')
+    features.add_argument('--feature-views', type=int, default=DEFAULT_VIEWS,
+                          help=f'每張訓練圖片預先抽樣的增強 view 數 (預設: {DEFAULT_VIEWS})')
+    features.add_argument('--feature-dir', type=str, default=DEFAULT_FEATURE_DIR,
+                          help=f'特徵快取目錄 (預設: {DEFAULT_FEATURE_DIR})')
+
+    prune = parser.add_argument_group('結構化剪枝 (選用)')
+    target = prune.add_mutually_exclusive_group()
+    target.add_argument('--prune-sparsity', type=float, default=None,
+                        help='剪掉 Bottleneck 內部通道的比例，例如 0.5')
+    target.add_argument('--prune-flops', type=float, default=None,
+                        help='剪到 MACs 不超過原本的比例，例如 0.5')
+    prune.add_argument('--prune-criterion', choices=['bn', 'l1'], default='bn',
+                       help='通道重要性：bn 為 BatchNorm |gamma|，l1 為卷積核 L1 norm (預設: bn)')
+    prune.add_argument('--prune-epochs', type=int, default=5, help='剪枝後微調的 epoch 數 (預設: 5)')
+    prune.add_argument('--prune-lr', type=float, default=0.001, help='剪枝後微調的學習率 (預設: 0.001)')
+    return parser.parse_args()
+
 
 # ==========================================
 # 1. 資料預處理與載入
 # ==========================================
-print("正在載入圖片資料...")
-
-data_transforms = {
-    'train': transforms.Compose([
-        transforms.RandomResizedCrop(224),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ]),
-    'val': transforms.Compose([
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ]),
-}
-
-image_datasets = {x: datasets.ImageFolder(os.path.join(data_dir, x),
-                                          data_transforms[x])
+def build_dataloaders(data_dir, batch_size=4, num_workers=0, persistent_workers=False, prefetch_factor=None,
+                      shard_dir=None):
+    print("正在載入圖片資料...")
+
+    data_transforms = {
+        'train': transforms.Compose([
+            transforms.RandomResizedCrop(224),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        ]),
+        'val': transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        ]),
+    }
+
+    if shard_dir:
+        # shard 中的圖片已縮放（val 已完成 Resize + CenterCrop），只需要剩下的 transforms
+        from image_shards import ShardDataset
+        data_transforms['val'] = transforms.Compose(data_transforms['val'].transforms[2:])
+        image_datasets = {x: ShardDataset(shard_dir, x, data_transforms[x]) for x in ['train', 'val']}
+    else:
+        image_datasets = {x: datasets.ImageFolder(os.path.join(data_dir, x),
+                                                  data_transforms[x])
+                          for x in ['train', 'val']}
+
+    loader_kwargs = {'batch_size': batch_size, 'num_workers': num_workers}
+    if num_workers > 0:
+        loader_kwargs['persistent_workers'] = persistent_workers
+        if prefetch_factor is not None:
+            loader_kwargs['prefetch_factor'] = prefetch_factor
+    dataloaders = {x: torch.utils.data.DataLoader(image_datasets[x], shuffle=True, **loader_kwargs)
                   for x in ['train', 'val']}
-dataloaders = {x: torch.utils.data.DataLoader(image_datasets[x], batch_size=4,
-                                             shuffle=True, num_workers=0)
-              for x in ['train', 'val']}
-dataset_sizes = {x: len(image_datasets[x]) for x in ['train', 'val']}
-class_names = image_datasets['train'].classes
+    dataset_sizes = {x: len(image_datasets[x]) for x in ['train', 'val']}
+    class_names = image_datasets['train'].classes
+
+    print(f"資料載入完成。類別: {class_names}")
+    print(f"訓練集數量: {dataset_sizes['train']}, 驗證集數量: {dataset_sizes['val']}")
+    return dataloaders, dataset_sizes, class_names
 
-print(f"資料載入完成。類別: {class_names}")
-print(f"訓練集數量: {dataset_sizes['train']}, 驗證集數量: {dataset_sizes['val']}")
 
 # ==========================================
 # 2. 定義訓練函數
 # ==========================================
-def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
+def autocast(device, mixed_precision):
+    """mixed_precision 時前向傳播以 bfloat16 執行（loss 等數值敏感的運算由 autocast 自動維持 float32）"""
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=mixed_precision)
+
+
+def to_device(inputs, device, mixed_precision):
+    """mixed_precision 時輸入轉為 channels_last，與模型的記憶體格式一致"""
+    memory_format = torch.channels_last if mixed_precision else torch.contiguous_format
+    return inputs.to(device, memory_format=memory_format)
+
+
+def train_model(model, criterion, optimizer, scheduler, dataloaders, dataset_sizes, device, num_epochs=25,
+                mixed_precision=False, checkpointer=None, resume=False, config=None):
+    """
+    訓練並載入驗證準確度最佳的權重
+
+    checkpointer 不為 None 時，每個 epoch 在背景寫出 last.pt，準確度提升時寫出 best.pt；
+    resume 時從 last.pt 接續（模型、optimizer、scheduler 與最佳準確度），
+    last.pt 記錄的 config 必須與目前相同
+    """
     since = time.time()
 
-    best_model_wts = copy.deepcopy(model.state_dict())
+    # 只快照 optimizer 會更新的參數與 buffer（凍結 backbone 時只有 fc 與 BN 統計量）
+    names, partial = trainable_state_names(model, optimizer)
+    best_model_wts = snapshot_state(model, names)
     best_acc = 0.0
+    best_epoch = -1
+    start_epoch = 0
+
+    if resume and checkpointer is not None:
+        resumed = resume_training(checkpointer, model, optimizer, scheduler, names, config)
+        if resumed is None:
+            print(f"⚠️  {checkpointer.path('last')} 不存在，從頭開始訓練")
+        else:
+            start_epoch, best_acc, best_epoch, best_model_wts = resumed
 
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         print(f'\nEpoch {epoch + 1}/{num_epochs}')
         print('-' * 10)
+        improved = False
 
         # 每個 epoch 都有訓練和驗證階段
         for phase in ['train', 'val']:
@@ -74,13 +195,13 @@ def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
 
             # 批次讀取資料
             for inputs, labels in dataloaders[phase]:
-                inputs = inputs.to(device)
+                inputs = to_device(inputs, device, mixed_precision)
                 labels = labels.to(device)
 
                 optimizer.zero_grad()
 
                 # 前向傳播
-                with torch.set_grad_enabled(phase == 'train'):
+                with torch.set_grad_enabled(phase == 'train'), autocast(device, mixed_precision):
                     outputs = model(inputs)
                     _, preds = torch.max(outputs, 1)
                     loss = criterion(outputs, labels)
@@ -92,7 +213,7 @@ def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
 
                 running_loss += loss.item() * inputs.size(0)
                 running_corrects += torch.sum(preds == labels.data)
-            
+
             if phase == 'train':
                 scheduler.step()
 
@@ -103,72 +224,400 @@ def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
 
             # 紀錄最佳模型
             if phase == 'val' and epoch_acc > best_acc:
-                best_acc = epoch_acc
-                best_model_wts = copy.deepcopy(model.state_dict())
+                best_acc = float(epoch_acc)
+                best_epoch = epoch
+                best_model_wts = snapshot_state(model, names)
+                improved = True
+
+        if checkpointer is not None:
+            save_epoch(checkpointer, model, optimizer, scheduler, names, partial, epoch, best_acc, best_epoch,
+                       best_state=best_model_wts if improved else None, config=config)
 
     time_elapsed = time.time() - since
     print(f'\n訓練完成，花費時間: {time_elapsed // 60:.0f}分 {time_elapsed % 60:.0f}秒')
     print(f'最佳驗證準確度: {best_acc:4f}')
 
     # 載入最佳權重
-    model.load_state_dict(best_model_wts)
+    load_model_state(model, best_model_wts, partial)
+    if checkpointer is not None:
+        checkpointer.wait()
     return model
 
+
+def evaluate(model, dataloader, device, mixed_precision=False):
+    """計算驗證集準確度"""
+    model.eval()
+    corrects = 0
+    total = 0
+    with torch.no_grad(), autocast(device, mixed_precision):
+        for inputs, labels in dataloader:
+            outputs = model(to_device(inputs, device, mixed_precision))
+            corrects += (outputs.argmax(1).cpu() == labels).sum().item()
+            total += labels.size(0)
+    return corrects / max(total, 1)
+
+
+def check_bf16_inference(model, dataloader, device):
+    """
+    同一組權重分別以 fp32 與 bf16 autocast 推論同一批驗證資料
+
+    只反映推論時 bf16 的數值誤差與速度；bf16 訓練對收斂的影響由 check_bf16_training_parity 檢查
+    """
+    model.eval()
+    corrects = {'fp32': 0, 'bf16': 0}
+    elapsed = {'fp32': 0.0, 'bf16': 0.0}
+    agree = 0
+    total = 0
+    max_diff = 0.0
+    with torch.no_grad():
+        for inputs, labels in dataloader:
+            outputs = {}
+            for name, mixed_precision in (('fp32', False), ('bf16', True)):
+                start_time = time.time()
+                with autocast(device, mixed_precision):
+                    outputs[name] = model(to_device(inputs, device, mixed_precision)).float().cpu()
+                elapsed[name] += time.time() - start_time
+                corrects[name] += (outputs[name].argmax(1) == labels).sum().item()
+            agree += (outputs['fp32'].argmax(1) == outputs['bf16'].argmax(1)).sum().item()
+            max_diff = max(max_diff, (outputs['fp32'] - outputs['bf16']).abs().max().item())
+            total += labels.size(0)
+
+    total = max(total, 1)
+    acc = {name: count / total for name, count in corrects.items()}
+    print(f"\n[BF16 推論] 驗證準確度 fp32 {acc['fp32']:.4f} / bf16 {acc['bf16']:.4f}，"
+          f"預測一致 {agree / total * 100:.1f}%，logits 最大差異 {max_diff:.4f}")
+    print(f"[BF16 推論] 評估時間 fp32 {elapsed['fp32']:.1f} 秒 / bf16 {elapsed['bf16']:.1f} 秒 "
+          f"({elapsed['fp32'] / max(elapsed['bf16'], 1e-9):.2f}x)")
+
+
+def check_bf16_training_parity(bf16_acc, args, dataloaders, dataset_sizes, device):
+    """
+    以相同設定與亂數種子重新做一次 fp32 訓練（不寫 checkpoint），
+    比較 bf16 訓練（bf16 推論）與 fp32 訓練（fp32 推論）的驗證準確度
+
+    Returns:
+        是否在 --bf16-tolerance 範圍內
+    """
+    print("\n[BF16 對照] 以 fp32 重新訓練作為基準...")
+    torch.manual_seed(PARITY_SEED)
+    baseline = fine_tune(build_model(device), args, dataloaders, dataset_sizes, device, mixed_precision=False)
+    fp32_acc = evaluate(baseline, dataloaders['val'], device)
+    del baseline
+
+    print(f"[BF16 對照] 驗證準確度 fp32 訓練 {fp32_acc:.4f} / bf16 訓練 {bf16_acc:.4f}")
+    if fp32_acc - bf16_acc > args.bf16_tolerance:
+        print(f"⚠️  bf16 訓練的準確度比 fp32 低 {fp32_acc - bf16_acc:.4f}，超過容許值 {args.bf16_tolerance}")
+        return False
+    print("✓ bf16 與 fp32 訓練的準確度一致")
+    return True
+
+
 # ==========================================
 # 3. 設定模型 (ResNet50)
 # ==========================================
-print("\n正在下載並設定 ResNet50 模型...")
-
-# 修改點 A: 使用 resnet50 (配合 Part-04 講義)
-# 使用新的 weights 參數（適用於 torchvision >= 0.13.0）
-# 如果您的版本較舊，可以改回 pretrained=True
-try:
-    model_ft = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
-except AttributeError:
-    # 向後兼容舊版本
-    model_ft = models.resnet50(pretrained=True)
-num_ftrs = model_ft.fc.in_features
+def build_model(device):
+    print("\n正在下載並設定 ResNet50 模型...")
+
+    # 修改點 A: 使用 resnet50 (配合 Part-04 講義)
+    # 使用新的 weights 參數（適用於 torchvision >= 0.13.0）
+    # 如果您的版本較舊，可以改回 pretrained=True
+    try:
+        model_ft = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
+    except AttributeError:
+        # 向後兼容舊版本
+        model_ft = models.resnet50(pretrained=True)
+    num_ftrs = model_ft.fc.in_features
+
+    # 修改點 B: 設定輸出類別為 2 (螞蟻/蜜蜂)
+    model_ft.fc = nn.Linear(num_ftrs, 2)
+
+    return model_ft.to(device)
+
+
+def stage_config(args, stage):
+    """各階段 checkpoint 記錄的訓練設定（--resume 時必須與 last.pt 相同）"""
+    if stage == 'prune':
+        return {'stage': 'prune', 'sparsity': args.prune_sparsity, 'flops': args.prune_flops,
+                'criterion': args.prune_criterion}
+    if stage == 'distill':
+        return {'stage': 'distill', 'arch': args.distill, 'temperature': args.distill_temperature,
+                'alpha': args.distill_alpha}
+    return {'stage': 'fc'}
+
+
+def stage_checkpoint_dir(args, stage):
+    """各階段的 checkpoint 目錄（剪枝後與 student 的模型形狀不同，另外存放）"""
+    if stage == 'prune':
+        return os.path.join(args.checkpoint_dir, 'prune')
+    if stage == 'distill':
+        return os.path.join(args.checkpoint_dir, f'distill_{args.distill}')
+    return args.checkpoint_dir
+
+
+def checkpoint_stages(args):
+    """這次執行會寫 checkpoint 的階段（--cached-features 的 fc 訓練不寫）"""
+    stages = [] if args.cached_features else ['fc']
+    if args.prune_sparsity is not None or args.prune_flops is not None:
+        stages.append('prune')
+    if args.distill:
+        stages.append('distill')
+    return stages
+
+
+def close_checkpointer(checkpointer):
+    """等待寫檔完成；有寫出 checkpoint 時才顯示目錄"""
+    if checkpointer is None:
+        return
+    checkpointer.close()
+    if checkpointer.written:
+        print(f"✓ checkpoint 已保存到: {checkpointer.directory} ({', '.join(sorted(checkpointer.written))})")
+
+
+def fine_tune(model, args, dataloaders, dataset_sizes, device, mixed_precision, checkpointer=None, resume=False):
+    """只微調最後一層 (fc)：--cached-features 時在快取的 backbone 特徵上訓練，否則以 train_model 訓練"""
+    if args.cached_features:
+        # backbone 凍結：特徵算一次，fc 在快取的特徵上訓練
+        image_datasets = {x: dataloaders[x].dataset for x in ['train', 'val']}
+        store_dir = build_feature_store(model, image_datasets, device, feature_dir=args.feature_dir,
+                                        views=args.feature_views, num_workers=args.num_workers,
+                                        mixed_precision=mixed_precision)
+        model.fc = train_fc_on_features(model.fc, load_feature_store(store_dir), num_epochs=args.epochs,
+                                        batch_size=args.batch_size).to(device)
+        return model
+
+    criterion = nn.CrossEntropyLoss()
+    # 這裡我們只微調最後一層 (fc)，這樣訓練速度比較快
+    optimizer = optim.SGD(model.fc.parameters(), lr=0.001, momentum=0.9)
+    scheduler = lr_scheduler.StepLR(optimizer, step_size=7, gamma=0.1)
+    print("開始訓練 (這可能需要幾分鐘)...")
+    # 為了示範快速完成，預設只訓練 5 個 Epoch (講義通常建議更多，但 5 就足夠產生模型了)
+    return train_model(model, criterion, optimizer, scheduler, dataloaders, dataset_sizes, device,
+                       num_epochs=args.epochs, mixed_precision=mixed_precision,
+                       checkpointer=checkpointer, resume=resume, config=stage_config(args, 'fc'))
 
-# 修改點 B: 設定輸出類別為 2 (螞蟻/蜜蜂)
-model_ft.fc = nn.Linear(num_ftrs, 2)
 
-model_ft = model_ft.to(device)
-
-criterion = nn.CrossEntropyLoss()
+# ==========================================
+# 4. 結構化剪枝 (選用)
+# ==========================================
+def prune_and_finetune(model, args, dataloaders, dataset_sizes, device, checkpointer=None):
+    """剪掉 Bottleneck 內部低重要性的通道，再以全部參數微調恢復準確度"""
+    from prune_resnet import prune_model, print_pruning_stats
+
+    mixed_precision = args.bf16
+    acc_before = evaluate(model, dataloaders['val'], device, mixed_precision)
+    print(f"\n[Prune] 剪枝前驗證準確度: {acc_before:.4f}")
+
+    model, stats = prune_model(model, sparsity=args.prune_sparsity, flops_ratio=args.prune_flops,
+                               criterion=args.prune_criterion)
+    print_pruning_stats(stats)
+    if mixed_precision:
+        # 剪枝後的新層是預設記憶體格式
+        model = model.to(memory_format=torch.channels_last)
+    print(f"[Prune] 剪枝後（未微調）驗證準確度: {evaluate(model, dataloaders['val'], device, mixed_precision):.4f}")
+
+    # backbone 的形狀改變了，所有參數一起微調
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.SGD(model.parameters(), lr=args.prune_lr, momentum=0.9)
+    scheduler = lr_scheduler.StepLR(optimizer, step_size=7, gamma=0.1)
+    model = train_model(model, criterion, optimizer, scheduler, dataloaders, dataset_sizes, device,
+                        num_epochs=args.prune_epochs, mixed_precision=mixed_precision,
+                        checkpointer=checkpointer, resume=args.resume, config=stage_config(args, 'prune'))
+
+    acc_after = evaluate(model, dataloaders['val'], device, mixed_precision)
+    print(f"[Prune] 微調後驗證準確度: {acc_after:.4f} (剪枝前 {acc_before:.4f})")
+    return model
 
-# 這裡我們只微調最後一層 (fc)，這樣訓練速度比較快
-optimizer_ft = optim.SGD(model_ft.fc.parameters(), lr=0.001, momentum=0.9)
-exp_lr_scheduler = lr_scheduler.StepLR(optimizer_ft, step_size=7, gamma=0.1)
 
 # ==========================================
-# 4. 開始訓練
+# 5. 知識蒸餾 (選用)
 # ==========================================
-print("開始訓練 (這可能需要幾分鐘)...")
-# 為了示範快速完成，我們只訓練 5 個 Epoch (講義通常建議更多，但 5 就足夠產生模型了)
-model_ft = train_model(model_ft, criterion, optimizer_ft, exp_lr_scheduler, num_epochs=5)
+def distill_student(teacher, args, dataloaders, dataset_sizes, device, checkpointer=None):
+    """
+    以 teacher 的 soft logits 訓練 student（所有參數），回傳驗證準確度最佳的 student
+    """
+    from prune_resnet import count_flops
+
+    mixed_precision = args.bf16
+    teacher.eval()
+    student = build_student(args.distill, num_classes=teacher.fc.out_features).to(device)
+    if mixed_precision:
+        student = student.to(memory_format=torch.channels_last)
+    print(f"\n[Distill] teacher: ResNet50 → student: {args.distill} "
+          f"(T={args.distill_temperature}, alpha={args.distill_alpha})")
+
+    optimizer = optim.SGD(student.parameters(), lr=args.distill_lr, momentum=0.9)
+    scheduler = lr_scheduler.StepLR(optimizer, step_size=7, gamma=0.1)
+    names, partial = trainable_state_names(student, optimizer)
+    config = stage_config(args, 'distill')
+    best_model_wts = snapshot_state(student, names)
+    best_acc = 0.0
+    best_epoch = -1
+    start_epoch = 0
+
+    if args.resume and checkpointer is not None:
+        resumed = resume_training(checkpointer, student, optimizer, scheduler, names, config)
+        if resumed is None:
+            print(f"⚠️  {checkpointer.path('last')} 不存在，從頭開始蒸餾")
+        else:
+            start_epoch, best_acc, best_epoch, best_model_wts = resumed
+
+    since = time.time()
+    for epoch in range(start_epoch, args.distill_epochs):
+        student.train()
+        running_loss = 0.0
+        running_corrects = 0
+        for inputs, labels in dataloaders['train']:
+            inputs = to_device(inputs, device, mixed_precision)
+            labels = labels.to(device)
+            with torch.no_grad(), autocast(device, mixed_precision):
+                teacher_logits = teacher(inputs)
+            optimizer.zero_grad()
+            with autocast(device, mixed_precision):
+                outputs = student(inputs)
+            loss = distillation_loss(outputs, teacher_logits, labels, args.distill_temperature, args.distill_alpha)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * inputs.size(0)
+            running_corrects += (outputs.argmax(1) == labels).sum().item()
+        scheduler.step()
+
+        val_acc = evaluate(student, dataloaders['val'], device, mixed_precision)
+        print(f"Epoch {epoch + 1}/{args.distill_epochs}  train Loss: {running_loss / dataset_sizes['train']:.4f} "
+              f"Acc: {running_corrects / dataset_sizes['train']:.4f}  val Acc: {val_acc:.4f}")
+        improved = val_acc > best_acc
+        if improved:
+            best_acc, best_epoch = val_acc, epoch
+            best_model_wts = snapshot_state(student, names)
+        if checkpointer is not None:
+            save_epoch(checkpointer, student, optimizer, scheduler, names, partial, epoch, best_acc, best_epoch,
+                       best_state=best_model_wts if improved else None, config=config)
+
+    time_elapsed = time.time() - since
+    print(f'\n蒸餾完成，花費時間: {time_elapsed // 60:.0f}分 {time_elapsed % 60:.0f}秒')
+    load_model_state(student, best_model_wts, partial)
+    if checkpointer is not None:
+        checkpointer.wait()
+
+    # teacher 與 student 的比較
+    teacher_acc = evaluate(teacher, dataloaders['val'], device, mixed_precision)
+    student_acc = evaluate(student, dataloaders['val'], device, mixed_precision)
+    latency_label = f"{device.type.upper()} 延遲"
+    print(f"\n{'':<14} {'驗證準確度':>10} {'MACs':>10} {'參數':>10} {latency_label:>10}")
+    for name, model, acc in (('ResNet50', teacher, teacher_acc), (args.distill, student, student_acc)):
+        macs, params = count_flops(model)
+        latency = measure_latency(model, device)
+        print(f"{name:<14} {acc:>10.4f} {macs / 1e9:>8.2f} G {params / 1e6:>8.2f} M {latency:>7.1f} ms")
+    return student
+
 
 # ==========================================
-# 5. 匯出 ONNX (Part-04 的核心目標)
+# 6. 匯出 ONNX (Part-04 的核心目標)
 # ==========================================
-print("\n[Start] Exporting to ONNX...")
-
-# 切換到推論模式
-model_ft.eval() 
-
-# 建立虛擬輸入 (Batch size=1, RGB 3通道, 224x224)
-dummy_input = torch.randn(1, 3, 224, 224, device=device)
-onnx_file_name = "ants_bees.onnx"
-
-# 匯出
-torch.onnx.export(
-    model_ft,
-    dummy_input,
-    onnx_file_name,
-    verbose=False,
-    input_names=['input'],   # 輸入節點命名為 input
-    output_names=['output'], # 輸出節點命名為 output
-    opset_version=11         # 建議使用 opset 11
-)
-
-print(f"匯出成功！檔案已儲存為: {onnx_file_name}")
-print("請繼續進行 Part-05 的 Docker 轉換步驟。")
\ No newline at end of file
+def export_onnx(model, onnx_file_name, device, dynamic_batch=False):
+    print("\n[Start] Exporting to ONNX...")
+
+    # 切換到推論模式（匯出時使用預設記憶體格式的 float32 模型）
+    model.eval()
+    model = model.to(memory_format=torch.contiguous_format)
+
+    # 建立虛擬輸入 (Batch size=1, RGB 3通道, 224x224)
+    dummy_input = torch.randn(1, 3, 224, 224, device=device)
+
+    # 匯出
+    torch.onnx.export(
+        model,
+        dummy_input,
+        onnx_file_name,
+        verbose=False,
+        input_names=['input'],   # 輸入節點命名為 input
+        output_names=['output'], # 輸出節點命名為 output
+        opset_version=11,        # 建議使用 opset 11
+        dynamic_axes={'input': {0: 'batch_size'}, 'output': {0: 'batch_size'}} if dynamic_batch else None
+    )
+
+    print(f"匯出成功！檔案已儲存為: {onnx_file_name}")
+
+
+def main():
+    args = parse_args()
+
+    # 設定運算裝置 (有 GPU 用 GPU，沒有用 CPU)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    print(f"使用運算裝置: {device}")
+
+    if args.num_workers == 0 and (args.persistent_workers or args.prefetch_factor is not None):
+        print("⚠️  --persistent-workers / --prefetch-factor 需要 --num-workers > 0，將被忽略")
+    if args.bf16_parity and not args.bf16:
+        print("⚠️  --bf16-parity 需要 --bf16，將被忽略")
+    if args.shards and not os.path.exists(os.path.join(args.shards, 'meta.json')):
+        print(f"❌ 錯誤：找不到 shard {args.shards}，請先執行 python image_shards.py -o {args.shards}")
+        sys.exit(1)
+    if args.resume and not args.no_checkpoint:
+        # 訓練前先確認每個階段的 last.pt 都能接續，避免前面的階段訓練完才失敗
+        for stage in checkpoint_stages(args):
+            last_path = os.path.join(stage_checkpoint_dir(args, stage), 'last.pt')
+            if not os.path.exists(last_path):
+                continue
+            mismatch = config_mismatch(torch.load(last_path, map_location='cpu'), stage_config(args, stage))
+            if mismatch:
+                print(f"❌ 錯誤：無法從 {last_path} 接續：{mismatch}")
+                print("   請使用相同的設定，或刪除該 checkpoint / 改用其他 --checkpoint-dir 重新訓練")
+                sys.exit(1)
+
+    dataloaders, dataset_sizes, class_names = build_dataloaders(
+        args.data_dir, batch_size=args.batch_size, num_workers=args.num_workers,
+        persistent_workers=args.persistent_workers, prefetch_factor=args.prefetch_factor, shard_dir=args.shards)
+    parity = args.bf16 and args.bf16_parity
+    if parity:
+        torch.manual_seed(PARITY_SEED)
+    model_ft = build_model(device)
+    if args.prune_flops is not None:
+        # 訓練前先確認剪枝目標可以達成（只取決於模型結構）
+        from prune_resnet import min_flops_ratio
+        lowest = min_flops_ratio(model_ft, args.prune_criterion)
+        if args.prune_flops < lowest:
+            print(f"❌ 錯誤：--prune-flops {args.prune_flops} 無法達成，最多只能剪到原本 MACs 的 {lowest:.1%}"
+                  f"（stem 與 downsample 卷積不剪枝）")
+            sys.exit(1)
+    if args.bf16:
+        model_ft = model_ft.to(memory_format=torch.channels_last)
+        print("使用 bfloat16 autocast + channels_last")
+
+    # --cached-features 的 fc 訓練只需幾秒，不寫 checkpoint
+    checkpointer = None if args.no_checkpoint or args.cached_features else AsyncCheckpointer(
+        stage_checkpoint_dir(args, 'fc'))
+
+    # ==========================================
+    # 開始訓練
+    # ==========================================
+    model_ft = fine_tune(model_ft, args, dataloaders, dataset_sizes, device, mixed_precision=args.bf16,
+                         checkpointer=checkpointer, resume=args.resume)
+    if parity:
+        bf16_acc = evaluate(model_ft, dataloaders['val'], device, mixed_precision=True)
+        check_bf16_training_parity(bf16_acc, args, dataloaders, dataset_sizes, device)
+
+    pruning = args.prune_sparsity is not None or args.prune_flops is not None
+    if pruning:
+        prune_checkpointer = None if args.no_checkpoint else AsyncCheckpointer(stage_checkpoint_dir(args, 'prune'))
+        model_ft = prune_and_finetune(model_ft, args, dataloaders, dataset_sizes, device, prune_checkpointer)
+        close_checkpointer(prune_checkpointer)
+    if args.distill:
+        distill_checkpointer = None if args.no_checkpoint else AsyncCheckpointer(stage_checkpoint_dir(args, 'distill'))
+        model_ft = distill_student(model_ft, args, dataloaders, dataset_sizes, device, distill_checkpointer)
+        close_checkpointer(distill_checkpointer)
+    close_checkpointer(checkpointer)
+
+    if args.bf16:
+        check_bf16_inference(model_ft, dataloaders['val'], device)
+
+    if args.distill:
+        default_name = f'ants_bees_{args.distill}.onnx'
+    else:
+        default_name = PRUNED_ONNX_FILE_NAME if pruning else ONNX_FILE_NAME
+    onnx_file_name = args.output or default_name
+    export_onnx(model_ft, onnx_file_name, device, dynamic_batch=args.dynamic_batch)
+    print("請繼續進行 Part-05 的 Docker 轉換步驟。")
+
+
+if __name__ == "__main__":
+    main()